@@ -1,20 +1,50 @@
 import jinja2
 import os
-from celery import Celery
-from flask import render_template, Flask
+import threading
+from celery.local import PromiseProxy
+from flask import render_template, url_for, Flask
 from flask_login import LoginManager
-from flask_mail import Mail
-from flask_sqlalchemy import SQLAlchemy
+from flask_redis import FlaskRedis
+from werkzeug.utils import import_string
 from config import config
+from app.database import RoutingSQLAlchemy
+from app.media_tree import MediaTree
+from app.user_cache import UserCache
+from app.password_hasher import PasswordHasher
+from app.rate_limiter import RateLimiter
+from app.query_stats import QueryStats
+from app.metrics import Metrics
+from app.log_pipeline import LogPipeline
 
 login_manager = LoginManager()
 login_manager.session_protection = "strong"
 login_manager.login_view = "auth.login"
-db = SQLAlchemy()
-mail = Mail()
+db = RoutingSQLAlchemy()
+media_tree = MediaTree()
+# short timeouts, redis only holds caches and the application carries on without it
+redis_store = FlaskRedis(socket_timeout=1, socket_connect_timeout=1)
+user_cache = UserCache(redis_store)
+password_hasher = PasswordHasher()
+rate_limiter = RateLimiter(redis_store)
+query_stats = QueryStats()
+metrics = Metrics()
+log_pipeline = LogPipeline()
 
-# create global instance of celery and delay its configuration until create_app is initialized
-celery = Celery(__name__, broker=os.environ.get("CELERY_BROKER_URL"))
+
+def _create_celery():
+    from celery import Celery
+    return Celery(__name__, broker=os.environ.get("CELERY_BROKER_URL"))
+
+
+def _create_mail():
+    from flask_mail import Mail
+    return Mail()
+
+
+# celery and flask mail take a good part of the start up time and most processes never queue a task or send a
+# mail, they are imported on first use. Work queued with __then__ runs once they are created
+celery = PromiseProxy(_create_celery)
+mail = PromiseProxy(_create_mail)
 
 
 class PiCloudApp(Flask):
@@ -36,6 +66,9 @@ class PiCloudApp(Flask):
             self.jinja_loader,
             jinja2.PrefixLoader({}, delimiter=".")
         ])
+        # import names of the blueprints that are registered on first use, see load_blueprints
+        self.lazy_blueprints = []
+        self._blueprints_lock = threading.Lock()
 
     def create_global_jinja_loader(self):
         return self.jinja_loader
@@ -44,6 +77,30 @@ class PiCloudApp(Flask):
         Flask.register_blueprint(self, blueprint, **options)
         self.jinja_loader.loaders[1].mapping[blueprint.name] = blueprint.jinja_loader
 
+    def load_blueprints(self):
+        """
+        Imports and registers the lazy blueprints. Importing the views pulls in the forms, celery, mail and
+        the image libraries, thus commands that handle no request do not pay for it. This is done on the first
+        request, servers that fork workers call it beforehand so that the workers share the loaded modules
+        """
+        if not self.lazy_blueprints:
+            return
+        with self._blueprints_lock:
+            for import_name in self.lazy_blueprints:
+                self.register_blueprint(import_string(import_name))
+            self.lazy_blueprints = []
+
+    def wsgi_app(self, environ, start_response):
+        self.load_blueprints()
+        return Flask.wsgi_app(self, environ, start_response)
+
+    def handle_url_build_error(self, error, endpoint, values):
+        # url_for outside of a request, e.g. in a shell or a task, may ask for a view that is not loaded yet
+        if self.lazy_blueprints:
+            self.load_blueprints()
+            return url_for(endpoint, **values)
+        return Flask.handle_url_build_error(self, error, endpoint, values)
+
 
 def create_app(config_name):
     """
@@ -59,8 +116,11 @@ def create_app(config_name):
     # app configurations, considering config is a dictionary, we pass in the key that we will receive
     app.config.from_object(config[config_name])
 
-    # CONFIGURE celery
-    celery.conf.update(app.config)
+    # log through a queue written by a background thread, as JSON lines and throttled mail to the admins
+    log_pipeline.init_app(app)
+
+    # CONFIGURE celery, once it is created
+    celery.__then__(_configure_celery, app.config)
 
     # initialize the application with the login manager
     login_manager.init_app(app)
@@ -68,8 +128,27 @@ def create_app(config_name):
     # initialize the db
     db.init_app(app)
 
-    # initialize flask mail
-    mail.init_app(app)
+    # initialize flask mail, once it is created
+    mail.__then__(_init_mail, app)
+
+    # initialize the persistent index of the media tree
+    media_tree.init_app(app)
+
+    # initialize redis and the cache of the users loaded by the login manager
+    redis_store.init_app(app)
+    user_cache.init_app(app)
+
+    # initialize the pool that hashes passwords off the request threads
+    password_hasher.init_app(app)
+
+    # initialize the limiter that throttles expensive requests
+    rate_limiter.init_app(app)
+
+    # count and time the SQL statements of every request
+    query_stats.init_app(app)
+
+    # record the latency, status and size of every request and expose them on /metrics
+    metrics.init_app(app)
 
     request_handlers(app, db)
 
@@ -81,6 +160,14 @@ def create_app(config_name):
     return app
 
 
+def _configure_celery(config):
+    celery.conf.update(config)
+
+
+def _init_mail(app):
+    mail.init_app(app)
+
+
 def error_handlers(app):
     """
     Function that will handle the erros encountered in the application
@@ -126,62 +213,13 @@ def register_blueprints(app_):
     """
     Registers all the blueprints in the application
     Whenever a new module is created, ensure that it is registered here for it to work
+    The blueprints are imported on first use, see PiCloudApp.load_blueprints
     :param app: Current flask application object
     """
-    from app.mod_auth import auth
-    from app.mod_home import home
-    from app.mod_dashboard import dashboard
-    from app.mod_api import api
-    from app.mod_media import media
-
-    app_.register_blueprint(media)
-    app_.register_blueprint(auth)
-    app_.register_blueprint(home)
-    app_.register_blueprint(dashboard)
-    app_.register_blueprint(api)
-
-
-def set_logger(app, config_name):
-    """
-    Sets logging of error messages in case they occur in the application. This will send an email to
-    any of the administrators, or all of the administrators.
-    This should work when the application is in production
-    Will also record any errors to a log file
-    RotatingFileHandler is used to limit the number of logs to 1MB and limit the backup to 10 files
-    logging.formatter will enable us to format the log messages and get the line number that brought up the issue as
-    well as the stack trace.
-    :param app: current Flask app
-    :param config_name: the configuration to use this, normally in Production
-    """
-    import logging
-    from logging.handlers import SMTPHandler, RotatingFileHandler
-    MAIL_SERVER = app.config.get("MAIL_SERVER")
-
-    if config_name == "production":
-        if not app.debug and MAIL_SERVER != "":
-            credentials = None
-
-            MAIL_USERNAME = app.config.get("MAIL_USERNAME")
-            MAIL_PASSWORD = app.config.get("MAIL_PASSWORD")
-
-            if MAIL_USERNAME or MAIL_PASSWORD:
-                credentials = (MAIL_USERNAME, MAIL_PASSWORD)
-
-            mail_handler = SMTPHandler(mailhost=(MAIL_SERVER, app.config.get("MAIL_HOST")),
-                                       fromaddr="no-reply@" + MAIL_SERVER,
-                                       toaddrs=app.config.get("ADMINS"),
-                                       subject="PiCloud app failure",
-                                       credentials=credentials)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if not app.debug and os.environ.get("HEROKU") is None:
-            # log file will be saved in the tmp directory
-            file_handler = RotatingFileHandler(filename="tmp/picloud.log", mode="a", maxBytes=1 * 1024 * 1024,
-                                               backupCount=10)
-            file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%('
-                                                        'lineno)d]'))
-            app.logger.setLevel(logging.INFO)
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-            app.logger.info("PiCloud")
+    app_.lazy_blueprints.extend([
+        "app.mod_media:media",
+        "app.mod_auth:auth",
+        "app.mod_home:home",
+        "app.mod_dashboard:dashboard",
+        "app.mod_api:api",
+    ])
@@ -0,0 +1,163 @@
+"""
+Celery tasks tracked with an AsyncOperation, so that users can follow long running work that happens off the
+request path.
+A view starts a tracked task with start, which records a pending operation for the user and queues the task
+with the id of the operation as its first argument. The task reports its progress with update_progress, the
+start and end of the task, its return value or its error are recorded by the base class. Clients follow the
+operation through the api blueprint, either by long polling or with Server-Sent Events, see wait_for_change.
+"""
+import json
+import time
+from datetime import datetime
+
+from celery.utils import uuid
+
+from app import celery, db
+from app.mod_auth.models import AsyncOperation
+
+
+class TrackedTask(celery.Task):
+    """
+    Base of the tracked tasks, e.g.
+        @celery.task(base=TrackedTask, bind=True)
+        def copy_folder(self, operation_id, source, target):
+            ...
+            self.update_progress(operation_id, copied, total)
+    :cvar operation_name: kind of operation recorded for the task, defaults to the name of the task function
+    :cvar progress_interval: minimum seconds between two progress updates written to the database
+    """
+    operation_name = None
+    progress_interval = 1.0
+
+    # when the progress of each running operation was last written, by operation id
+    _last_updates = {}
+
+    def start(self, user_profile_id, *args, **kwargs):
+        """
+        Records a pending operation for a user and queues the task
+        :param user_profile_id: the user that started the operation and may follow it
+        :param args: arguments of the task after the id of the operation
+        :param kwargs: keyword arguments of the task, target and total are recorded on the operation instead
+        :return: the operation tracking the task
+        :rtype: AsyncOperation
+        """
+        task_id = uuid()
+        operation = AsyncOperation(operation=self.operation_name or self.name.rpartition(".")[2],
+                                   user_profile_id=user_profile_id, target=kwargs.pop("target", None),
+                                   total=kwargs.pop("total", None), completed=0, task_id=task_id,
+                                   async_operation_status_id=AsyncOperation.status_id("pending"))
+        db.session.add(operation)
+        db.session.commit()
+
+        self.apply_async(args=(operation.id,) + args, kwargs=kwargs, task_id=task_id)
+        return operation
+
+    def __call__(self, operation_id, *args, **kwargs):
+        _update(operation_id, started_at=datetime.utcnow())
+        return celery.Task.__call__(self, operation_id, *args, **kwargs)
+
+    def update_progress(self, operation_id, completed, total=None):
+        """
+        Records how much of the operation is done, at most once every progress_interval seconds so that a
+        tight loop does not turn into a stream of writes
+        :param operation_id: id of the operation, the first argument of the task
+        :param completed: amount of work done so far
+        :param total: amount of work to do, if it was not known when the operation started
+        :return: True if the progress has been written
+        :rtype: bool
+        """
+        now = time.monotonic()
+        if now - self._last_updates.get(operation_id, 0) < self.progress_interval and completed != total:
+            return False
+        self._last_updates[operation_id] = now
+        values = dict(completed=completed)
+        if total is not None:
+            values["total"] = total
+        _update(operation_id, **values)
+        return True
+
+    def on_success(self, retval, task_id, args, kwargs):
+        _update(args[0], async_operation_status_id=AsyncOperation.status_id("ok"), finished_at=datetime.utcnow(),
+                result=json.dumps(dict(value=retval), default=str))
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        # the task may have failed on a database error, which leaves its transaction unusable
+        db.session.rollback()
+        _update(args[0], async_operation_status_id=AsyncOperation.status_id("error"),
+                finished_at=datetime.utcnow(), result=json.dumps(dict(error=str(exc))))
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        self._last_updates.pop(args[0], None)
+        # the worker keeps one application context for its lifetime, thus every task starts with a new session,
+        # an eager task shares the session of the request that queued it
+        if not self.request.is_eager:
+            db.session.remove()
+
+
+def _update(operation_id, **values):
+    # written with an UPDATE of its own so that a task does not have to load the operation
+    AsyncOperation.query.filter_by(id=operation_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def operation_to_json(operation):
+    """
+    :param operation: an AsyncOperation
+    :return: the state of the operation
+    :rtype: dict
+    """
+    result = json.loads(operation.result) if operation.result else {}
+    return dict(id=operation.id, operation=operation.operation, target=operation.target,
+                status=operation.status_code, total=operation.total, completed=operation.completed,
+                progress=operation.progress, created=_isoformat(operation.date_created),
+                started=_isoformat(operation.started_at), finished=_isoformat(operation.finished_at),
+                result=result.get("value"), error=result.get("error"),
+                version="{}:{}:{}".format(operation.status_code, operation.completed, operation.total))
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def load_operation(operation_id, user_profile_id):
+    """
+    Loads the current state of an operation and ends the transaction, so that a client waiting for changes
+    does not hold a database connection in between two looks
+    :param operation_id: id of the operation
+    :param user_profile_id: the user that must own the operation
+    :return: the state of the operation, None if the user has no such operation
+    :rtype: dict
+    """
+    operation = AsyncOperation.query.populate_existing() \
+        .filter_by(id=operation_id, user_profile_id=user_profile_id).first()
+    state = None if operation is None else operation_to_json(operation)
+    db.session.rollback()
+    return state
+
+
+def is_finished(state):
+    """
+    :param state: state of an operation as returned by operation_to_json
+    :return: True if the operation will not change anymore
+    :rtype: bool
+    """
+    return state["status"] in ("ok", "error")
+
+
+def wait_for_change(operation_id, user_profile_id, version, timeout, interval):
+    """
+    Waits until the state of an operation differs from a version the client has already seen
+    :param operation_id: id of the operation
+    :param user_profile_id: the user that must own the operation
+    :param version: version of the state the client has, None to return the current state right away
+    :param timeout: seconds to wait at most
+    :param interval: seconds between two looks at the operation
+    :return: the state of the operation, None if the user has no such operation
+    :rtype: dict
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        state = load_operation(operation_id, user_profile_id)
+        if state is None or state["version"] != version or is_finished(state) or time.monotonic() >= deadline:
+            return state
+        time.sleep(interval)
@@ -0,0 +1,81 @@
+"""
+Flask-SQLAlchemy with the pool and timeouts of the engines taken from the configuration and with reads
+routed to a replica.
+Every gunicorn worker has its own pool, thus a server holds up to workers * (SQLALCHEMY_POOL_SIZE +
+SQLALCHEMY_MAX_OVERFLOW) connections to each database, which has to stay under max_connections of PostgreSQL.
+If the replica bind is configured in SQLALCHEMY_BINDS, the queries of GET and HEAD requests are sent to the
+replica until the request writes, after which it reads its own writes from the primary. Everything else, such as
+the other requests, flushes, SELECT ... FOR UPDATE and the celery tasks, uses the primary.
+"""
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+# name of the replica in SQLALCHEMY_BINDS
+REPLICA_BIND = "replica"
+
+# requests that only read and may thus be served by the replica
+READ_ONLY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# pool options that SQLite's pools do not take
+POOL_SIZE_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the reads of read only requests to the replica
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.wrote = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            # read the writes of this request back from the primary, the replica may lag behind
+            self.wrote = True
+        elif self._reads_from_replica(clause):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _reads_from_replica(self, clause):
+        if self.wrote or not isinstance(clause, Select) or clause._for_update_arg is not None:
+            return False
+        if REPLICA_BIND not in (self.app.config.get("SQLALCHEMY_BINDS") or {}):
+            return False
+        return has_request_context() and request.method in READ_ONLY_METHODS
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Creates routing sessions and configures the engines with SQLALCHEMY_POOL_PRE_PING,
+    SQLALCHEMY_STATEMENT_TIMEOUT and DATABASE_CONNECT_OPTIONS on top of the pool options of Flask-SQLAlchemy
+    """
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_pool_defaults(self, app, options):
+        SQLAlchemy.apply_pool_defaults(self, app, options)
+        if app.config.get("SQLALCHEMY_POOL_PRE_PING"):
+            # a connection that was dropped by the server, e.g. while it restarted, is replaced on checkout
+            options["pool_pre_ping"] = True
+
+    def apply_driver_hacks(self, app, info, options):
+        connect_args = dict(app.config.get("DATABASE_CONNECT_OPTIONS") or {})
+        if info.drivername.startswith("sqlite"):
+            # SQLite gets a NullPool or StaticPool, which have no size
+            for option in POOL_SIZE_OPTIONS:
+                options.pop(option, None)
+            options.pop("pool_pre_ping", None)
+        elif info.drivername.startswith("postgresql"):
+            statement_timeout = app.config.get("SQLALCHEMY_STATEMENT_TIMEOUT")
+            if statement_timeout:
+                # a runaway query is cancelled by the server instead of holding a worker and a connection
+                connect_args["options"] = "{} -c statement_timeout={}".format(
+                    connect_args.get("options", ""), int(statement_timeout)).strip()
+        if connect_args:
+            options["connect_args"] = connect_args
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
@@ -0,0 +1,275 @@
+"""
+Logging that never holds up a request.
+The handler attached to the loggers of the application only puts records on a queue, a background thread takes
+them off and writes them as JSON lines to stderr and LOG_FILE, and mails errors to LOG_MAIL_ADMINS. Mail is
+throttled, an error that repeats within LOG_MAIL_INTERVAL seconds is counted instead of mailed again and at most
+LOG_MAIL_BURST mails are sent per interval, thus a failing page does not flood the administrators. When the
+queue is full records are dropped and counted rather than waited on.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import has_request_context, request
+
+# the attributes every record has, anything else was passed with extra and is written with the record
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line of JSON, with the request it was logged in and its traceback
+    """
+
+    def format(self, record):
+        entry = dict(
+            time=datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+            location="{}:{}".format(record.pathname, record.lineno),
+            process=record.process,
+            thread=record.threadName,
+        )
+        if getattr(record, "request", None):
+            entry["request"] = record.request
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class ThrottledMailHandler(logging.Handler):
+    """
+    Mails records to the administrators from the background thread. The first record of an error is mailed, its
+    repeats within the interval are counted and reported with the next mail sent for it. An error is told apart
+    by where it was logged and the type of its exception
+    :cvar interval: seconds after which an error is mailed again
+    :cvar burst: mails sent at most per interval, whatever the errors
+    """
+
+    def __init__(self, host, port, sender, recipients, credentials=None, use_ssl=False, use_tls=False,
+                 interval=600, burst=5, timeout=10):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = list(recipients)
+        self.credentials = credentials
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.interval = interval
+        self.burst = burst
+        self.timeout = timeout
+        # fingerprint of an error -> when it was last mailed and the repeats since
+        self._errors = {}
+        self._sent = []
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"))
+
+    @staticmethod
+    def fingerprint(record):
+        exception = record.exc_info[0].__name__ if record.exc_info else None
+        return record.name, record.pathname, record.lineno, exception
+
+    def emit(self, record):
+        now = time.monotonic()
+        key = self.fingerprint(record)
+        last_sent, repeats = self._errors.get(key, (None, 0))
+        self._sent = [sent for sent in self._sent if now - sent < self.interval]
+        if (last_sent is not None and now - last_sent < self.interval) or len(self._sent) >= self.burst:
+            self._errors[key] = (last_sent, repeats + 1)
+            return
+
+        if len(self._errors) > 1000:
+            self._errors = {fingerprint: error for fingerprint, error in self._errors.items()
+                            if error[0] is not None and now - error[0] < self.interval}
+        self._errors[key] = (now, 0)
+        self._sent.append(now)
+        try:
+            self.send(record, repeats)
+        except Exception:
+            self.handleError(record)
+
+    def send(self, record, repeats):
+        """
+        Mails a record
+        :param record: the record to send
+        :param repeats: number of times it was logged since it was last mailed
+        """
+        # imported on first use, like the other heavy modules, see app/startup_profile.py
+        import smtplib
+        from email.message import EmailMessage
+        message = EmailMessage()
+        message["Subject"] = "PiCloud app failure: {}".format(record.getMessage().splitlines()[0][:100])
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        body = self.format(record)
+        if repeats:
+            body = "Logged {} more times since the last mail\n\n{}".format(repeats, body)
+        message.set_content(body)
+
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        with smtp_class(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.credentials:
+                smtp.login(*self.credentials)
+            smtp.send_message(message)
+
+
+class PipelineQueueHandler(QueueHandler):
+    """
+    Puts the records of the application on the queue of the pipeline, the record is copied with the request it
+    was logged in as the request is gone by the time the background thread formats it
+    """
+
+    def __init__(self, pipeline):
+        QueueHandler.__init__(self, None)
+        self.pipeline = pipeline
+
+    def enqueue(self, record):
+        self.pipeline.put(record)
+
+    def prepare(self, record):
+        # the message is merged with its arguments now as they may change once the call returns, the traceback
+        # is left to the background thread
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if has_request_context():
+            record.request = dict(method=request.method, path=request.path, remote_addr=request.remote_addr)
+        return record
+
+
+class PipelineListener(QueueListener):
+    """
+    Waits for the queue to have room for the sentinel, so that stopping writes every queued record
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app. The background thread is started in the process that logs, a gunicorn worker forked from the
+    master starts its own on its first record
+    :cvar dropped: records dropped since the last one that was queued, as the queue was full
+    """
+
+    def __init__(self, app=None):
+        self.handlers = []
+        self.loggers = []
+        self.dropped = 0
+        self._queue_size = 0
+        self._handler = PipelineQueueHandler(self)
+        self._queue = None
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Replaces the handlers of the application logger, and of the PiCloud logger used outside requests, with
+        the queue of the pipeline
+        :param app: current flask application
+        """
+        from flask.logging import default_handler
+        self.stop()
+        for logger in self.loggers:
+            logger.removeHandler(self._handler)
+
+        config = app.config
+        self._queue_size = config.get("LOG_QUEUE_SIZE", 10000)
+        self.handlers = create_handlers(app)
+        self.loggers = [app.logger, logging.getLogger("PiCloud")]
+        for logger in self.loggers:
+            logger.removeHandler(default_handler)
+            logger.addHandler(self._handler)
+            if config.get("LOG_LEVEL"):
+                logger.setLevel(config["LOG_LEVEL"])
+        app.extensions["log_pipeline"] = self
+
+    def put(self, record):
+        """
+        Queues a record without waiting, it is dropped if the queue is full
+        :param record: the record prepared by the queue handler
+        """
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            if self.dropped:
+                self._queue.put_nowait(logging.makeLogRecord(dict(
+                    name=__name__, levelno=logging.WARNING, levelname="WARNING", pathname=__file__,
+                    msg="{} log records were dropped as the queue was full".format(self.dropped))))
+                self.dropped = 0
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # a forked process has the queue of its parent but not its thread
+            self._queue = queue.Queue(self._queue_size)
+            self._listener = PipelineListener(self._queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Writes the queued records and stops the background thread
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._listener is not None:
+                self._listener.stop()
+            self._listener = self._pid = None
+
+
+def create_handlers(app):
+    """
+    :param app: current flask application
+    :return: the handlers the background thread writes records to
+    :rtype: list
+    """
+    config = app.config
+    handlers = []
+    if config.get("LOG_STREAM"):
+        handlers.append(logging.StreamHandler(sys.stderr))
+
+    if config.get("LOG_FILE"):
+        directory = os.path.dirname(config["LOG_FILE"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handlers.append(RotatingFileHandler(config["LOG_FILE"], maxBytes=config.get("LOG_FILE_MAX_BYTES", 0),
+                                            backupCount=config.get("LOG_FILE_BACKUPS", 0)))
+    for handler in handlers:
+        handler.setFormatter(JsonFormatter())
+
+    if config.get("LOG_MAIL_ADMINS") and config.get("MAIL_SERVER") and not app.debug:
+        username, password = config.get("MAIL_USERNAME"), config.get("MAIL_PASSWORD")
+        handlers.append(ThrottledMailHandler(
+            config["MAIL_SERVER"], config.get("MAIL_PORT"),
+            config.get("MAIL_DEFAULT_SENDER") or "no-reply@" + config["MAIL_SERVER"], config["LOG_MAIL_ADMINS"],
+            credentials=(username, password) if username or password else None,
+            use_ssl=config.get("MAIL_USE_SSL", False), use_tls=config.get("MAIL_USE_TLS", False),
+            interval=config.get("LOG_MAIL_INTERVAL", 600), burst=config.get("LOG_MAIL_BURST", 5)))
+    return handlers
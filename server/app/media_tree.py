@@ -0,0 +1,723 @@
+"""
+Persistent index of the media tree mounted under MEDIA_PATH.
+Walking multi terabyte drives on every request is too slow, so the tree is scanned once with
+os.scandir and stored in a small sqlite database on disk. Subsequent refreshes only stat the directories
+and re-list the ones whose mtime has changed since they were last indexed.
+Every process (web workers, the manage.py commands) opens the same index file, so a refresh in one
+of them is visible to all the others.
+The names in the index are also indexed with a trigram full text index, which is what file searches use.
+"""
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+import uuid
+
+# bumped whenever the schema changes, the index is a cache of the filesystem so an index created with an
+# older schema is simply dropped and rebuilt
+SCHEMA_VERSION = 3
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS node (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        parent TEXT,
+        name TEXT NOT NULL,
+        ext TEXT NOT NULL DEFAULT '',
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        file_count INTEGER NOT NULL DEFAULT 0,
+        mtime REAL NOT NULL DEFAULT -1
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS node_parent_name ON node (parent, name)",
+    "CREATE INDEX IF NOT EXISTS node_parent_size ON node (parent, size, name)",
+    "CREATE INDEX IF NOT EXISTS node_parent_mtime ON node (parent, mtime, name)",
+    "CREATE INDEX IF NOT EXISTS node_name ON node (name COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS node_ext ON node (ext, path)",
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """,
+)
+
+# trigram index of the names in the tree used for substring and glob searches, it is kept in sync with the
+# node table by triggers. Requires sqlite 3.34 or later, older versions fall back to scanning the names
+SEARCH_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS node_search USING fts5 (name, content='node', content_rowid='id', "
+    "tokenize='trigram')",
+    """
+    CREATE TRIGGER IF NOT EXISTS node_search_insert AFTER INSERT ON node BEGIN
+        INSERT INTO node_search (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS node_search_delete AFTER DELETE ON node BEGIN
+        INSERT INTO node_search (node_search, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS node_search_update AFTER UPDATE OF name ON node BEGIN
+        INSERT INTO node_search (node_search, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO node_search (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+)
+
+# the trigram index can only be used for search terms of at least this many characters
+TRIGRAM_LENGTH = 3
+
+# modes of matching names when searching
+SEARCH_MODES = ("substring", "prefix", "glob")
+
+
+def join_path(parent, name):
+    """
+    Joins a relative index path with a child name, the root of the tree is the empty string
+    :param parent: relative path of the parent directory
+    :param name: name of the child
+    :return: relative path of the child
+    :rtype: str
+    """
+    return name if not parent else parent + "/" + name
+
+
+def descendant_range(path):
+    """
+    Range of index paths that are below the given path. '0' is the character that comes right after '/'
+    which allows descendants to be fetched with an index range scan instead of a LIKE query
+    :param path: relative path of a directory
+    :return: tuple with the lower and upper bounds
+    :rtype: tuple
+    """
+    if not path:
+        return "", "\U0010ffff"
+    return path + "/", path + "0"
+
+
+def extension(name):
+    """
+    :param name: name of a file
+    :return: lower case extension of the file without the dot, empty if it has none
+    :rtype: str
+    """
+    return os.path.splitext(name)[1][1:].lower()
+
+
+def glob_literals(pattern):
+    """
+    Splits a glob pattern into the literal runs between its wildcards
+    :param pattern: glob pattern with *, ? and [...] wildcards
+    :return: the literal parts of the pattern
+    :rtype: list
+    """
+    literals, current, index = [], "", 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char in "*?[":
+            if current:
+                literals.append(current)
+            current = ""
+            if char == "[":
+                close = pattern.find("]", index + 2)
+                index = len(pattern) if close < 0 else close
+        else:
+            current += char
+        index += 1
+    if current:
+        literals.append(current)
+    return literals
+
+
+def escape_like(term):
+    """
+    Escapes the wildcards of a LIKE pattern, the query must use ESCAPE '\\'
+    :rtype: str
+    """
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# directories used by PiCloud itself inside the media path, these are never indexed
+UPLOADS_DIR_NAME = ".picloud-uploads"
+STORE_DIR_NAME = ".picloud-store"
+IGNORED_NAMES = frozenset([UPLOADS_DIR_NAME, STORE_DIR_NAME])
+
+# columns that directory listings can be sorted by
+SORT_KEYS = dict(name="name", size="size", mtime="mtime")
+
+
+class MediaTree(object):
+    """
+    Index of the directories and files in the media path. Follows the flask extension pattern, thus a
+    global instance is created in app/__init__.py and configured with init_app
+    :cvar root_path: the media path that is indexed
+    :cvar index_path: location of the sqlite database holding the index
+    :cvar max_age: seconds after which a request will trigger an incremental refresh, None disables it
+    """
+
+    def __init__(self, app=None):
+        self.root_path = None
+        self.index_path = None
+        self.max_age = None
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the media tree with the application configuration
+        :param app: current flask application
+        """
+        self.root_path = app.config.get("MEDIA_PATH")
+        self.index_path = app.config.get("MEDIA_INDEX_PATH")
+        self.max_age = app.config.get("MEDIA_INDEX_MAX_AGE")
+        app.extensions["media_tree"] = self
+
+    @property
+    def connection(self):
+        """
+        sqlite connections can not be shared between threads, thus each thread gets its own connection
+        to the index. The connection is recreated if the index path has changed
+        :return: connection to the index database
+        :rtype: sqlite3.Connection
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.path != self.index_path:
+            directory = os.path.dirname(self.index_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema(conn)
+            self._local.conn = conn
+            self._local.path = self.index_path
+            self._local.searchable = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'node_search'").fetchone() is not None
+        return conn
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                for table in ("node_search", "node", "meta"):
+                    conn.execute("DROP TABLE IF EXISTS {}".format(table))
+            for statement in SCHEMA:
+                conn.execute(statement)
+            try:
+                for statement in SEARCH_SCHEMA:
+                    conn.execute(statement)
+            except sqlite3.OperationalError:
+                # sqlite was built without fts5 or is too old for the trigram tokenizer
+                pass
+            # identifies this index in its etags, the generation starts over when the index is rebuilt
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('index_id', ?)", (uuid.uuid4().hex[:12],))
+            conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def full_path(self, path):
+        """
+        :param path: relative index path
+        :return: absolute path of the node on the filesystem
+        :rtype: str
+        """
+        return os.path.join(self.root_path, *path.split("/")) if path else self.root_path
+
+    @staticmethod
+    def normalize(path):
+        """
+        Normalizes a path received from a client into a relative index path
+        :param path: path relative to the media root, as found in a url
+        :return: relative index path, None if the path tries to escape the media root
+        :rtype: str
+        """
+        parts = [part for part in path.replace("\\", "/").split("/") if part]
+        if any(part in (os.curdir, os.pardir) for part in parts):
+            return None
+        return "/".join(parts)
+
+    def resolve(self, path):
+        """
+        Resolves a path received from a client to a path on the drives. The path must not escape the media root,
+        either with .. or by following symlinks, nor go through the directories the server keeps on the drives
+        for uploads and stored content
+        :param path: path relative to the media root, as found in a url
+        :return: absolute path on the filesystem, None if the path is empty or not allowed
+        :rtype: str
+        """
+        path = self.normalize(path or "")
+        if not path or IGNORED_NAMES.intersection(path.split("/")):
+            return None
+        full_path = self.full_path(path)
+        if not os.path.realpath(full_path).startswith(os.path.realpath(self.root_path) + os.sep):
+            return None
+        return full_path
+
+    def relative_path(self, full_path):
+        """
+        :param full_path: absolute path on the filesystem
+        :return: path relative to the media root as stored in the index, None if outside the media root
+        :rtype: str
+        """
+        relative = os.path.relpath(full_path, self.root_path)
+        if relative == os.curdir:
+            return ""
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative.replace(os.sep, "/")
+
+    def get_meta(self, key, default=None):
+        """
+        Reads a value from the meta table
+        :param key: key of the meta value
+        :param default: value to return if the key has not been set
+        """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def ensure_fresh(self):
+        """
+        Builds the index if it does not exist yet, or refreshes it if it is older than max_age seconds.
+        A refresh only re-lists directories that have changed, so this is cheap when nothing changed.
+        Nothing is done while the media watcher is running, since it keeps the index up to date
+        """
+        if self.needs_refresh():
+            self.refresh()
+
+    def needs_refresh(self):
+        """
+        :return: True if the index has not been built yet, or is older than max_age seconds and the media watcher
+         is not keeping it up to date
+        :rtype: bool
+        """
+        refreshed_at = self.get_meta("refreshed_at")
+        if refreshed_at is None:
+            return True
+        if self.watcher_alive():
+            return False
+        return self.max_age is not None and time.time() - float(refreshed_at) > self.max_age
+
+    def watcher_alive(self):
+        """
+        :return: True if the media watcher has recently reported that it is watching the media path
+        :rtype: bool
+        """
+        heartbeat = self.get_meta("watcher_heartbeat")
+        if heartbeat is None:
+            return False
+        expires_at, _, root_path = heartbeat.partition(" ")
+        return root_path == self.root_path and float(expires_at) > time.time()
+
+    def heartbeat(self, ttl):
+        """
+        Records that the media watcher is keeping the index up to date
+        :param ttl: seconds after which the heartbeat expires if it is not renewed
+        """
+        self._set_meta(self.connection, "watcher_heartbeat", "{!r} {}".format(time.time() + ttl, self.root_path))
+
+    def refresh(self, path=""):
+        """
+        Incrementally rescans the given directory and everything below it. Directories whose mtime has
+        not changed are not listed again, their children are read from the index instead
+        :param path: relative path of the directory to start from, defaults to the media root
+        :return: True if anything in the index changed
+        :rtype: bool
+        """
+        return self.update(trees=[path])
+
+    def sync_dir(self, path, force=False):
+        """
+        Re-lists a single directory if its mtime has changed, without descending into its children
+        :param path: relative path of the directory
+        :param force: re-list the directory even if its mtime is unchanged
+        :return: True if anything in the index changed
+        :rtype: bool
+        """
+        if not force:
+            # cheap check that avoids taking the write lock when the directory is unchanged, or when it is
+            # neither on disk nor in the index, e.g. a listing of a missing path or of a file
+            row = self.connection.execute("SELECT mtime FROM node WHERE path = ? AND is_dir = 1", (path,)).fetchone()
+            try:
+                dir_stat = os.stat(self.full_path(path))
+            except OSError:
+                dir_stat = None
+            if dir_stat is None or not stat.S_ISDIR(dir_stat.st_mode):
+                if row is None:
+                    return False
+            elif row is not None and row[0] == dir_stat.st_mtime:
+                return False
+        return self.update(dirs=[path], force=force)
+
+    def update(self, dirs=(), trees=(), force=False):
+        """
+        Applies a batch of changes to the index in a single transaction, the generation is bumped at
+        most once for the whole batch
+        :param dirs: relative paths of directories to re-list
+        :param trees: relative paths of directories to incrementally rescan, including their children
+        :param force: re-list the directories in dirs even if their mtime is unchanged
+        :return: True if anything in the index changed
+        :rtype: bool
+        """
+        conn = self.connection
+        changed = False
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for path in dirs:
+                _, dir_changed = self._sync_dir(conn, path, force=force)
+                changed = changed or dir_changed
+
+            stack = list(trees)
+            while stack:
+                child_dirs, dir_changed = self._sync_dir(conn, stack.pop())
+                stack.extend(child_dirs)
+                changed = changed or dir_changed
+
+            self._publish(conn, changed, full="" in trees)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return changed
+
+    def _sync_dir(self, conn, path, force=False):
+        """
+        Brings the index entry of a directory and its immediate children up to date
+        :return: tuple of the child directories to descend into and whether anything changed
+        :rtype: tuple
+        """
+        try:
+            dir_stat = os.stat(self.full_path(path))
+        except OSError:
+            dir_stat = None
+
+        if dir_stat is None or not stat.S_ISDIR(dir_stat.st_mode):
+            if path:
+                removed = self._remove(conn, path)
+                if removed is not None:
+                    self._roll_up(conn, path.rpartition("/")[0], -removed[0], -removed[1])
+                return [], removed is not None
+            # the media root itself is missing, nothing is mounted
+            return [], conn.execute("DELETE FROM node").rowcount > 0
+
+        row = conn.execute("SELECT mtime, is_dir FROM node WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[1] and row[0] == dir_stat.st_mtime and not force:
+            child_dirs = conn.execute("SELECT path FROM node WHERE parent = ? AND is_dir = 1", (path,))
+            return [child[0] for child in child_dirs], False
+
+        changed = False
+        if row is not None and not row[1]:
+            # a file has been replaced by a directory of the same name
+            removed = self._remove(conn, path)
+            self._roll_up(conn, path.rpartition("/")[0], -removed[0], -removed[1])
+            row = None
+        if row is None:
+            self._insert_dir(conn, path)
+            changed = True
+
+        existing = {
+            name: (is_dir, size, mtime) for name, is_dir, size, mtime in
+            conn.execute("SELECT name, is_dir, size, mtime FROM node WHERE parent = ?", (path,))
+        }
+        child_dirs = []
+        # change of the total size and file count of the directory
+        delta = [0, 0]
+        with os.scandir(self.full_path(path)) as entries:
+            for entry in entries:
+                if entry.name in IGNORED_NAMES:
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                child = join_path(path, entry.name)
+                known = existing.pop(entry.name, None)
+                if known is not None and bool(known[0]) != is_dir:
+                    removed = self._remove(conn, child)
+                    delta[0] -= removed[0]
+                    delta[1] -= removed[1]
+                    known = None
+
+                if is_dir:
+                    if known is None:
+                        # mtime is left at -1 so that the directory gets listed when it is visited
+                        conn.execute("INSERT INTO node (path, parent, name, is_dir) VALUES (?, ?, ?, 1)",
+                                     (child, path, entry.name))
+                        changed = True
+                    child_dirs.append(child)
+                elif known is None:
+                    conn.execute("INSERT INTO node (path, parent, name, ext, is_dir, size, file_count, mtime) "
+                                 "VALUES (?, ?, ?, ?, 0, ?, 1, ?)", (child, path, entry.name, extension(entry.name),
+                                                                     entry_stat.st_size, entry_stat.st_mtime))
+                    delta[0] += entry_stat.st_size
+                    delta[1] += 1
+                    changed = True
+                elif known[1:] != (entry_stat.st_size, entry_stat.st_mtime):
+                    conn.execute("UPDATE node SET size = ?, mtime = ? WHERE path = ?",
+                                 (entry_stat.st_size, entry_stat.st_mtime, child))
+                    delta[0] += entry_stat.st_size - known[1]
+                    changed = True
+
+        # whatever is left over is no longer on disk
+        for name in existing:
+            removed = self._remove(conn, join_path(path, name))
+            delta[0] -= removed[0]
+            delta[1] -= removed[1]
+            changed = True
+
+        conn.execute("UPDATE node SET mtime = ? WHERE path = ?", (dir_stat.st_mtime, path))
+        self._roll_up(conn, path, *delta)
+        return child_dirs, changed
+
+    def _insert_dir(self, conn, path):
+        """
+        Adds a directory to the index along with its ancestors that are not indexed yet, e.g. when a directory
+        is listed before the first full refresh. The ancestors are left unlisted, with an mtime of -1, and start
+        with empty totals, thus the totals rolled up from the directory are counted once when they get listed
+        :param path: relative path of the directory
+        """
+        paths = [path]
+        while path:
+            path = path.rpartition("/")[0]
+            paths.append(path)
+        for path in reversed(paths):
+            parent, _, name = path.rpartition("/") if path else (None, None, "")
+            conn.execute("INSERT OR IGNORE INTO node (path, parent, name, is_dir) VALUES (?, ?, ?, 1)",
+                         (path, parent, name))
+
+    def _remove(self, conn, path):
+        """
+        Removes a node and everything below it from the index
+        :return: tuple with the size and file count of what was removed, None if the node was not indexed
+        :rtype: tuple
+        """
+        row = conn.execute("SELECT size, file_count FROM node WHERE path = ?", (path,)).fetchone()
+        low, high = descendant_range(path)
+        conn.execute("DELETE FROM node WHERE path = ?", (path,))
+        conn.execute("DELETE FROM node WHERE path > ? AND path < ?", (low, high))
+        return row
+
+    def _roll_up(self, conn, path, size, file_count):
+        """
+        Adds to the totals of a directory and of all its ancestors. The size and file count of a directory are
+        the totals of everything below it, they are updated bottom-up with the changes to its children so
+        nothing has to be walked to know how much space a directory uses
+        :param path: relative path of the directory whose children changed
+        :param size: change of the total size in bytes
+        :param file_count: change of the number of files
+        """
+        if not size and not file_count:
+            return
+        paths = [path]
+        while path:
+            path = path.rpartition("/")[0]
+            paths.append(path)
+        conn.execute("UPDATE node SET size = size + ?, file_count = file_count + ? WHERE path IN ({})".format(
+            ", ".join("?" * len(paths))), [size, file_count] + paths)
+
+    def _publish(self, conn, changed, full=False):
+        """
+        Records the refresh time of a full refresh and, if the tree changed, rebuilds the summary returned
+        by home.index and bumps the generation of the index
+        """
+        if full:
+            self._set_meta(conn, "refreshed_at", repr(time.time()))
+        if not changed and self._get_meta(conn, "summary") is not None:
+            return
+        generation = int(self._get_meta(conn, "generation", 0)) + 1
+        self._set_meta(conn, "generation", str(generation))
+        self._set_meta(conn, "summary", json.dumps(self._build_summary(conn)))
+
+    def _get_meta(self, conn, key, default=None):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _count(self, conn, path):
+        """
+        Counts the directories and files below a directory
+        :return: tuple with the number of directories and files
+        :rtype: tuple
+        """
+        low, high = descendant_range(path)
+        counts = dict(conn.execute("SELECT is_dir, COUNT(*) FROM node WHERE path > ? AND path < ? GROUP BY is_dir",
+                                   (low, high)).fetchall())
+        return counts.get(1, 0), counts.get(0, 0)
+
+    def _build_summary(self, conn):
+        """
+        Builds the tree summary that is served by home.index
+        :rtype: dict
+        """
+        directories, files = self._count(conn, "")
+        root = conn.execute("SELECT size FROM node WHERE path = ''").fetchone()
+        summary = dict(root_path=self.root_path, directories=directories, files=files,
+                       size=0 if root is None else root[0], media=[], directory_tree={})
+        for drive, size in conn.execute("SELECT name, size FROM node WHERE parent = '' AND is_dir = 1 ORDER BY name"):
+            drive_dirs, drive_files = self._count(conn, drive)
+            summary["media"].append(drive)
+            summary["directory_tree"][drive] = dict(
+                files=[name for (name,) in conn.execute(
+                    "SELECT name FROM node WHERE parent = ? AND is_dir = 0 ORDER BY name", (drive,))],
+                file_num=drive_files,
+                dirs=drive_dirs,
+                size=size
+            )
+        return summary
+
+    def summary(self):
+        """
+        :return: summary of the media tree, None if the index has not been built
+        :rtype: dict
+        """
+        summary = self.get_meta("summary")
+        return None if summary is None else json.loads(summary)
+
+    def children(self, path):
+        """
+        Lists the names of the directories and files in a directory
+        :param path: relative path of the directory
+        :return: names of the children of the directory
+        :rtype: list
+        """
+        return [name for (name,) in self.connection.execute(
+            "SELECT name FROM node WHERE parent = ? ORDER BY name", (path,))]
+
+    def list_page(self, path, sort="name", descending=False, limit=100, after=None):
+        """
+        Returns a page of the children of a directory. Pages are fetched with keyset pagination on the
+        (parent, sort key, name) indexes, thus the cost of a page does not depend on the size of the directory
+        :param path: relative path of the directory
+        :param sort: column to sort by, one of SORT_KEYS
+        :param descending: sort in descending order
+        :param limit: maximum number of entries in the page
+        :param after: (sort value, name) of the last entry of the previous page
+        :return: list of dicts with the name, path, is_dir, size, file_count and mtime of each entry, the size and
+        file count of a directory are the totals of everything below it
+        :rtype: list
+        """
+        column = SORT_KEYS[sort]
+        operator, direction = ("<", "DESC") if descending else (">", "ASC")
+        query = "SELECT name, path, is_dir, size, file_count, mtime FROM node WHERE parent = ?"
+        params = [path]
+        if after is not None:
+            if column == "name":
+                query += " AND name {} ?".format(operator)
+                params.append(after[1])
+            else:
+                query += " AND ({0} {1} ? OR ({0} = ? AND name {1} ?))".format(column, operator)
+                params.extend([after[0], after[0], after[1]])
+        query += " ORDER BY {0} {1}, name {1} LIMIT ?".format(column, direction)
+        params.append(limit)
+        return [dict(name=name, path=child, is_dir=bool(is_dir), size=size, file_count=file_count, mtime=mtime)
+                for name, child, is_dir, size, file_count, mtime in self.connection.execute(query, params)]
+
+    def search(self, query="", mode="substring", path="", extensions=None, min_size=None, max_size=None,
+               modified_after=None, modified_before=None, is_dir=None, limit=100, after=None):
+        """
+        Searches the names of the directories and files in the index. Substring and glob searches use the
+        trigram index for terms of at least TRIGRAM_LENGTH characters, prefix searches use the index on names,
+        thus searches stay fast with millions of files. Shorter terms fall back to scanning the names
+        :param query: the term to search for, matched against the names case insensitively, glob patterns are
+        case sensitive
+        :param mode: how the query is matched, one of SEARCH_MODES
+        :param path: only search below this directory
+        :param extensions: only return files with one of these extensions, lower case without the dot
+        :param min_size: only return files and directories of at least this many bytes
+        :param max_size: only return files and directories of at most this many bytes
+        :param modified_after: only return nodes modified at or after this timestamp
+        :param modified_before: only return nodes modified before this timestamp
+        :param is_dir: only return directories if True or files if False
+        :param limit: maximum number of results
+        :param after: path of the last result of the previous page, results are ordered by path
+        :return: list of dicts with the name, path, is_dir, size, file_count and mtime of each result
+        :rtype: list
+        """
+        conn = self.connection
+        low, high = descendant_range(path)
+        clauses, params = ["node.path > ? AND node.path < ?"], [low, high]
+
+        if query and mode == "prefix":
+            clauses.append("node.name >= ? COLLATE NOCASE AND node.name < ? COLLATE NOCASE")
+            params.extend([query, query + "\U0010ffff"])
+        elif query:
+            literals = glob_literals(query) if mode == "glob" else [query]
+            terms = [term for term in literals if len(term) >= TRIGRAM_LENGTH] if self._local.searchable else []
+            if terms:
+                clauses.append("node.id IN (SELECT rowid FROM node_search WHERE node_search MATCH ?)")
+                params.append(" AND ".join('"{}"'.format(term.replace('"', '""')) for term in terms))
+            if mode == "glob":
+                clauses.append("node.name GLOB ?")
+                params.append(query)
+            elif not terms:
+                clauses.append("node.name LIKE ? ESCAPE '\\'")
+                params.append("%{}%".format(escape_like(query)))
+
+        if extensions:
+            clauses.append("node.ext IN ({})".format(", ".join("?" * len(extensions))))
+            params.extend(extensions)
+        for clause, value in (("node.size >= ?", min_size), ("node.size <= ?", max_size),
+                              ("node.mtime >= ?", modified_after), ("node.mtime < ?", modified_before)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if is_dir is not None:
+            clauses.append("node.is_dir = ?")
+            params.append(int(is_dir))
+        if after is not None:
+            clauses.append("node.path > ?")
+            params.append(after)
+
+        sql = "SELECT name, path, is_dir, size, file_count, mtime FROM node WHERE {} ORDER BY node.path LIMIT ?".format(
+            " AND ".join(clauses))
+        params.append(limit)
+        return [dict(name=name, path=child, is_dir=bool(is_dir), size=size, file_count=file_count, mtime=mtime)
+                for name, child, is_dir, size, file_count, mtime in conn.execute(sql, params)]
+
+    def directories(self, path=""):
+        """
+        :param path: relative path of the directory to start from
+        :return: relative paths of the directory and all the directories below it that are in the index
+        :rtype: list
+        """
+        low, high = descendant_range(path)
+        below = self.connection.execute("SELECT path FROM node WHERE is_dir = 1 AND path > ? AND path < ?",
+                                        (low, high))
+        return [path] + [child for (child,) in below]
+
+    def is_dir(self, path):
+        """
+        :param path: relative path of the node
+        :return: True if the node is a directory, None if it is not in the index
+        :rtype: bool
+        """
+        row = self.connection.execute("SELECT is_dir FROM node WHERE path = ?", (path,)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def generation(self):
+        """
+        :return: number that is incremented every time the contents of the index change
+        :rtype: int
+        """
+        return int(self.get_meta("generation", 0))
+
+    def etag(self):
+        """
+        Validator of everything read from the index, it changes whenever the contents of the index change and
+        when the index is rebuilt
+        :return: the unquoted etag
+        :rtype: str
+        """
+        values = dict(self.connection.execute("SELECT key, value FROM meta WHERE key IN ('index_id', 'generation')"))
+        return "{}-{}".format(values.get("index_id", ""), values.get("generation", 0))
@@ -0,0 +1,277 @@
+"""
+Long running watcher that keeps the media tree index hot. It watches the media path and every drive mounted
+in it with Linux inotify, groups the events it receives into batches and applies each batch to the media tree
+index in a single transaction, thus requests never have to walk the media path themselves.
+Started with python manage.py watch_media
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from app.media_tree import IGNORED_NAMES, join_path
+
+logger = logging.getLogger("PiCloud")
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """
+    Thin wrapper around the inotify system calls, loaded from libc with ctypes
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        :param path: directory to watch
+        :param mask: events to watch for
+        :return: watch descriptor
+        :rtype: int
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Reads all the events that are queued in the kernel
+        :return: list of (watch descriptor, mask, name) tuples
+        :rtype: list
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MediaWatcher(object):
+    """
+    Watches the media tree and applies filesystem changes to the media tree index
+    :cvar tree: the media tree index to keep up to date
+    :cvar batch_delay: seconds to wait for more events once a change has been seen, bounds the latency
+    with which changes appear in the index
+    :cvar heartbeat_interval: how often the watcher tells requests that it is keeping the index up to date
+    """
+
+    def __init__(self, tree, batch_delay=0.5, heartbeat_interval=5):
+        self.tree = tree
+        self.batch_delay = batch_delay
+        self.heartbeat_interval = heartbeat_interval
+        self.inotify = None
+        self.watches = {}
+        self.watched_paths = {}
+        self._pending_dirs = set()
+        self._pending_trees = set()
+        self._remount = False
+        self.degraded = False
+
+    def run(self):
+        """
+        Builds the index and runs the watch loop until interrupted
+        """
+        self.inotify = Inotify()
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+
+        # the mount table raises POLLPRI whenever a drive is mounted or unmounted
+        mounts = open("/proc/self/mounts")
+        poller.register(mounts.fileno(), select.POLLPRI)
+
+        try:
+            # watched before the index is built, so that whatever changes while it is built raises an event
+            self.watch_tree("")
+            self.tree.refresh()
+            next_heartbeat = time.time()
+            logger.info("Watching %d directories in %s", len(self.watches), self.tree.root_path)
+
+            while True:
+                batch_deadline = None
+                while batch_deadline is None or time.time() < batch_deadline:
+                    if batch_deadline is None:
+                        timeout = max(next_heartbeat - time.time(), 0)
+                    else:
+                        timeout = max(batch_deadline - time.time(), 0)
+                    for fd, _ in poller.poll(timeout * 1000):
+                        if fd == mounts.fileno():
+                            mounts.seek(0)
+                            mounts.read()
+                            self._remount = True
+                            self._pending_trees.add("")
+                        else:
+                            self.handle_events(self.inotify.read_events())
+                    if batch_deadline is None and (self._pending_dirs or self._pending_trees):
+                        batch_deadline = time.time() + self.batch_delay
+                    elif batch_deadline is None:
+                        break
+
+                self.apply_batch()
+                if time.time() >= next_heartbeat:
+                    if not self.degraded:
+                        self.tree.heartbeat(self.heartbeat_interval * 3)
+                    next_heartbeat = time.time() + self.heartbeat_interval
+        finally:
+            poller.unregister(self.inotify.fd)
+            mounts.close()
+            self.inotify.close()
+
+    def watch_tree(self, path):
+        """
+        Adds watches for a directory and all the directories below it. Each directory is watched before it is
+        listed, thus a directory created while the tree is walked is either listed or reported by the watch on
+        its parent
+        :param path: relative path of the directory
+        """
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            if directory not in self.watched_paths:
+                try:
+                    wd = self.inotify.add_watch(self.tree.full_path(directory))
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        # without a complete set of watches requests go back to refreshing the index
+                        logger.warning("inotify watch limit reached, unable to watch %s", directory)
+                        self.degraded = True
+                        return
+                    # the directory disappeared before it could be watched
+                    continue
+                # a directory that has been moved keeps its watch, which is now known under the new path
+                moved_from = self.watches.get(wd)
+                if moved_from is not None and self.watched_paths.get(moved_from) == wd:
+                    del self.watched_paths[moved_from]
+                self.watches[wd] = directory
+                self.watched_paths[directory] = wd
+            try:
+                with os.scandir(self.tree.full_path(directory)) as entries:
+                    stack.extend(join_path(directory, entry.name) for entry in entries
+                                 if entry.name not in IGNORED_NAMES and entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def unwatch(self, wd):
+        path = self.watches.pop(wd, None)
+        if path is not None and self.watched_paths.get(path) == wd:
+            del self.watched_paths[path]
+
+    def unwatch_tree(self, path):
+        """
+        Removes the watches of a directory that has been moved away and of the directories below it, they are
+        watched again under their new path if it is in the media tree
+        :param path: relative path the directory has been moved from
+        """
+        prefix = path + "/" if path else ""
+        for directory in [directory for directory in self.watched_paths
+                          if directory == path or directory.startswith(prefix)]:
+            wd = self.watched_paths.pop(directory)
+            if self.watches.get(wd) == directory:
+                del self.watches[wd]
+                self.inotify.rm_watch(wd)
+
+    def handle_events(self, events):
+        """
+        Records which parts of the tree have to be synced for a list of inotify events
+        :param events: list of (watch descriptor, mask, name) tuples
+        """
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events have been lost, fall back to rescanning the tree. Only directories whose mtime
+                # changed are listed again
+                logger.warning("inotify queue overflowed, rescanning %s", self.tree.root_path)
+                self._pending_trees.add("")
+                continue
+
+            path = self.watches.get(wd)
+            if path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                self.unwatch(wd)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT):
+                self.unwatch(wd)
+                self._pending_dirs.add(path.rpartition("/")[0] if path else "")
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._pending_dirs.add(path)
+                self._pending_trees.add(join_path(path, name))
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.unwatch_tree(join_path(path, name))
+                self._pending_dirs.add(path)
+            else:
+                self._pending_dirs.add(path)
+
+    def apply_batch(self):
+        """
+        Applies the pending changes to the index in a single transaction and watches new directories
+        """
+        if not self._pending_dirs and not self._pending_trees:
+            return
+        dirs, trees = sorted(self._pending_dirs), sorted(self._pending_trees)
+        self._pending_dirs, self._pending_trees = set(), set()
+
+        if self._remount:
+            # watches on mount points refer to the directory underneath the drive, thus all of them
+            # are recreated once the mount table has changed
+            for wd in list(self.watches):
+                self.inotify.rm_watch(wd)
+            self.watches, self.watched_paths = {}, {}
+            self._remount = False
+
+        # new directories are watched before they are scanned, like when the watcher starts
+        for path in trees:
+            self.watch_tree(path)
+        self.tree.update(dirs=dirs, trees=trees, force=True)
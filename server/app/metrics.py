@@ -0,0 +1,396 @@
+"""
+Request metrics in the Prometheus text format, served on /metrics.
+Every request records its latency in a histogram by endpoint and method, its status, the bytes of its body and
+whether it is in flight, views time their walks of the media path with time_walk. Latencies are measured until
+the view returns, thus for a streamed body they are the time to the first byte.
+A process keeps its values in memory. Gunicorn workers do not share memory, thus with METRICS_DIR set each
+process keeps its values in a memory mapped file in that directory instead, updated with plain memory writes,
+and the process answering the scrape sums the files of all of them. The counters of processes that have exited
+are kept so that totals never go backwards, their in flight gauges are dropped.
+"""
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+
+REQUEST_DURATION = "picloud_http_request_duration_seconds"
+REQUESTS = "picloud_http_requests_total"
+REQUESTS_IN_FLIGHT = "picloud_http_requests_in_flight"
+RESPONSE_BYTES = "picloud_http_response_bytes_total"
+WALK_DURATION = "picloud_fs_walk_duration_seconds"
+
+# type and help of each metric family
+FAMILIES = {
+    REQUEST_DURATION: ("histogram", "Time until the view returned its response"),
+    REQUESTS: ("counter", "Requests handled, by status"),
+    REQUESTS_IN_FLIGHT: ("gauge", "Requests being handled"),
+    RESPONSE_BYTES: ("counter", "Bytes of the response bodies"),
+    WALK_DURATION: ("histogram", "Time spent by views walking the media path"),
+}
+HISTOGRAM_SUFFIXES = ("_bucket", "_count", "_sum")
+
+
+def sample_key(name, labels):
+    """
+    :param name: name of the sample
+    :param labels: tuple of (name, value) pairs
+    :return: the sample as it is written in the exposition format, without its value
+    :rtype: str
+    """
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(label, str(value).replace("\\", r"\\").replace(
+        '"', r'\"').replace("\n", r"\n")) for label, value in labels))
+
+
+class MemoryValues(object):
+    """
+    Values of the samples of a single process
+    """
+
+    def __init__(self):
+        self._values = defaultdict(float)
+
+    def inc(self, key, amount):
+        self._values[key] += amount
+
+    def items(self):
+        return list(self._values.items())
+
+
+class MmapValues(object):
+    """
+    Values of the samples of a process in a memory mapped file. The file starts with the number of bytes in use,
+    followed by entries of the length of a key, the key padded to a multiple of 8 bytes and the value as a double.
+    An entry is written before the number of bytes in use is updated, so readers never see half of one
+    :cvar initial_size: size of a new file, it doubles whenever it is full
+    """
+    initial_size = 16 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a+b")
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            size = self.initial_size
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        if self._used() == 0:
+            struct.pack_into("i", self._map, 0, 8)
+        # the file may remain from a previous process with the same pid, its values are carried on
+        self._positions = {key: position for key, _, position in _read_entries(self._map, self._used())}
+
+    def _used(self):
+        return struct.unpack_from("i", self._map, 0)[0]
+
+    def inc(self, key, amount):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add(key)
+        struct.pack_into("d", self._map, position, struct.unpack_from("d", self._map, position)[0] + amount)
+
+    def items(self):
+        return [(key, value) for key, value, _ in _read_entries(self._map, self._used())]
+
+    def _add(self, key):
+        encoded = key.encode()
+        used = self._used()
+        header = 4 + len(encoded)
+        header += -header % 8
+        while used + header + 8 > len(self._map):
+            size = len(self._map) * 2
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        struct.pack_into("i{}s".format(len(encoded)), self._map, used, len(encoded), encoded)
+        struct.pack_into("d", self._map, used + header, 0.0)
+        struct.pack_into("i", self._map, 0, used + header + 8)
+        self._positions[key] = used + header
+        return used + header
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _read_entries(data, used):
+    position = 8
+    while position < used:
+        length = struct.unpack_from("i", data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        position += 4 + length
+        position += -position % 8
+        yield key, struct.unpack_from("d", data, position)[0], position
+        position += 8
+
+
+def read_values(path):
+    """
+    :param path: file written by MmapValues, possibly by another process
+    :return: list of (sample, value) pairs
+    :rtype: list
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < 8:
+        return []
+    return [(key, value) for key, value, _ in _read_entries(data, struct.unpack_from("i", data, 0)[0])]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _family(key):
+    name = key.partition("{")[0]
+    for suffix in HISTOGRAM_SUFFIXES:
+        if name.endswith(suffix) and FAMILIES.get(name[:-len(suffix)], ("",))[0] == "histogram":
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(key):
+    # buckets are listed by their upper bound, followed by the count and the sum of the histogram
+    name, _, labels = key.partition("{")
+    bound = 0.0
+    if 'le="' in labels:
+        labels, _, le = labels.partition('le="')
+        bound = float(le.partition('"')[0].replace("+Inf", "inf"))
+    suffix = next((index for index, suffix in enumerate(HISTOGRAM_SUFFIXES) if name.endswith(suffix)), -1)
+    return _family(key), labels, suffix, bound
+
+
+def render(values):
+    """
+    :param values: value of each sample
+    :return: the samples in the Prometheus text exposition format
+    :rtype: str
+    """
+    families = defaultdict(list)
+    for key in sorted(values, key=_sort_key):
+        families[_family(key)].append(key)
+
+    lines = []
+    for family in sorted(families):
+        kind, description = FAMILIES.get(family, ("untyped", family))
+        lines.append("# HELP {} {}".format(family, description))
+        lines.append("# TYPE {} {}".format(family, kind))
+        lines.extend("{} {!r}".format(key, float(values[key])) for key in families[family])
+    return "".join(line + "\n" for line in lines)
+
+
+class Metrics(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app, which also adds the /metrics route
+    :cvar enabled: whether requests are recorded, set with METRICS_ENABLED
+    :cvar buckets: upper bounds of the histogram buckets in seconds, set with METRICS_BUCKETS
+    :cvar directory: directory of the files of the processes, None to keep the values in memory
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.buckets = ()
+        self.directory = None
+        self._pid = None
+        self._values = None
+        self._live_values = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Starts recording the requests of the application and exposes the metrics on /metrics
+        :param app: current flask application
+        """
+        self.enabled = bool(app.config.get("METRICS_ENABLED"))
+        self.buckets = tuple(sorted(app.config.get("METRICS_BUCKETS")))
+        self.use_directory(app.config.get("METRICS_DIR"))
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule("/metrics", "metrics", self.expose)
+        app.extensions["metrics"] = self
+
+    def use_directory(self, directory):
+        """
+        Keeps the values in memory mapped files in a directory, so that the values of all the processes using
+        the directory are reported. Must be called before the workers are forked
+        :param directory: the directory, None to keep the values in memory
+        """
+        with self._lock:
+            self.directory = directory
+            self._pid = None
+
+    def clear_directory(self):
+        """
+        Removes the files of a previous run of the server
+        """
+        for path in glob.glob(os.path.join(self.directory, "*.db")):
+            os.remove(path)
+
+    def mark_process_dead(self, pid):
+        """
+        Drops the in flight requests of a process that has exited, its counters are kept
+        :param pid: id of the process
+        """
+        try:
+            os.remove(os.path.join(self.directory, "live_{}.db".format(pid)))
+        except FileNotFoundError:
+            pass
+
+    def _stores(self):
+        # the files are opened by each process on first use, thus after it has been forked
+        pid = os.getpid()
+        if self._pid != pid:
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                self._values = MmapValues(os.path.join(self.directory, "counter_{}.db".format(pid)))
+                self._live_values = MmapValues(os.path.join(self.directory, "live_{}.db".format(pid)))
+            else:
+                self._values, self._live_values = MemoryValues(), MemoryValues()
+            self._pid = pid
+        return self._values, self._live_values
+
+    def inc(self, name, labels=(), amount=1.0, live=False):
+        """
+        Adds to a counter, or a gauge if live
+        :param name: name of the sample
+        :param labels: tuple of (name, value) pairs
+        :param amount: amount to add
+        :param live: the value only counts while the process is alive, e.g. the requests in flight
+        """
+        key = sample_key(name, labels)
+        with self._lock:
+            values, live_values = self._stores()
+            (live_values if live else values).inc(key, amount)
+
+    def observe(self, name, labels, value):
+        """
+        Records a value in a histogram
+        :param name: name of the histogram
+        :param labels: tuple of (name, value) pairs
+        :param value: the value, a duration in seconds
+        """
+        with self._lock:
+            values, _ = self._stores()
+            for bound in self.buckets:
+                values.inc(sample_key(name + "_bucket", labels + (("le", repr(float(bound))),)),
+                           1 if value <= bound else 0)
+            values.inc(sample_key(name + "_bucket", labels + (("le", "+Inf"),)), 1)
+            values.inc(sample_key(name + "_count", labels), 1)
+            values.inc(sample_key(name + "_sum", labels), value)
+
+    def collect(self):
+        """
+        :return: the value of each sample, summed over the processes using the directory
+        :rtype: dict
+        """
+        if not self.directory:
+            with self._lock:
+                values, live_values = self._stores()
+                return dict(values.items() + live_values.items())
+
+        totals = defaultdict(float)
+        for path in glob.glob(os.path.join(self.directory, "*.db")):
+            kind, _, pid = os.path.basename(path)[:-len(".db")].partition("_")
+            if kind == "live" and not _pid_alive(int(pid)):
+                continue
+            for key, value in read_values(path):
+                totals[key] += value
+        return dict(totals)
+
+    @contextmanager
+    def time_walk(self, operation):
+        """
+        Times a walk of the media path done for the current request, e.g.
+            with metrics.time_walk("ensure_fresh"):
+                media_tree.ensure_fresh()
+        :param operation: what the walk is done for
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                endpoint = request.endpoint if has_request_context() else None
+                self.observe(WALK_DURATION, (("endpoint", endpoint or "none"), ("operation", operation)),
+                             time.perf_counter() - start)
+
+    def expose(self):
+        """
+        The /metrics view, requires a bearer token if METRICS_TOKEN is set
+        """
+        token = current_app.config.get("METRICS_TOKEN")
+        if token and request.headers.get("Authorization") != "Bearer {}".format(token):
+            return current_app.response_class("Unauthorized\n", 401, mimetype="text/plain")
+        return current_app.response_class(render(self.collect()),
+                                          content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    def _labels(self):
+        return ("endpoint", request.endpoint or "none"), ("method", request.method)
+
+    def _start_request(self):
+        if not self.enabled:
+            return
+        g.metrics_start = time.perf_counter()
+        g.metrics_recorded = False
+        self.inc(REQUESTS_IN_FLIGHT, live=True)
+
+    def _finish_request(self, response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+        g.metrics_recorded = True
+        labels = self._labels()
+        self.observe(REQUEST_DURATION, labels, time.perf_counter() - start)
+        self.inc(REQUESTS, labels + (("status", str(response.status_code)),))
+
+        if request.method == "HEAD" or response.status_code in (204, 304):
+            return response
+        length = response.content_length
+        if length is None and not response.is_streamed:
+            length = response.calculate_content_length()
+        if length is not None:
+            self.inc(RESPONSE_BYTES, labels[:1], length)
+        else:
+            # counted while the body is sent, reading the stream here would buffer all of it
+            response.response = self._count_bytes(response.response, labels[:1], response.charset)
+        return response
+
+    def _count_bytes(self, body, labels, charset):
+        sent = 0
+        try:
+            for chunk in body:
+                sent += len(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+                yield chunk
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            self.inc(RESPONSE_BYTES, labels, sent)
+
+    def _teardown_request(self, exc):
+        # removed, the application context and its g may outlive the request
+        start = g.pop("metrics_start", None)
+        recorded = g.pop("metrics_recorded", False)
+        if start is None:
+            return
+        if not recorded:
+            # the exception has not been turned into a response, e.g. while testing
+            labels = self._labels()
+            self.observe(REQUEST_DURATION, labels, time.perf_counter() - start)
+            self.inc(REQUESTS, labels + (("status", "500"),))
+        self.inc(REQUESTS_IN_FLIGHT, amount=-1, live=True)
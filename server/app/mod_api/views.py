@@ -1,6 +1,71 @@
+import json
+import time
+
+from flask import Response, current_app, jsonify, request, stream_with_context
+from flask_login import login_required, current_user
+
+from app.async_operations import load_operation, wait_for_change, is_finished
 from . import api
 
 
 @api.route("orange/<task>")
 def orange(task):
     return task
+
+
+@api.route("operations/<int:operation_id>")
+@login_required
+def get_operation(operation_id):
+    """
+    Returns the state of an operation of the current user. With the version query parameter set to the version
+    of the last state the client has seen, the request is held until the state changes or for at most wait
+    seconds, capped at ASYNC_OPERATION_MAX_WAIT
+    :param operation_id: id of the operation
+    :return: json response with the state of the operation
+    """
+    wait = min(request.args.get("wait", 0, type=float), current_app.config.get("ASYNC_OPERATION_MAX_WAIT"))
+    state = wait_for_change(operation_id, current_user.user_profile_id, request.args.get("version"),
+                            max(wait, 0), current_app.config.get("ASYNC_OPERATION_POLL_INTERVAL"))
+    if state is None:
+        return jsonify(message="Operation not found", success=False), 404
+    return jsonify(success=True, **state)
+
+
+@api.route("operations/<int:operation_id>/events")
+@login_required
+def stream_operation(operation_id):
+    """
+    Streams the state of an operation of the current user as Server-Sent Events, a progress event is sent
+    whenever the state changes and a done event once the operation has finished. The stream is closed after
+    ASYNC_OPERATION_STREAM_TIMEOUT seconds, EventSource then reconnects and sends the version it has last seen
+    in Last-Event-ID. The stream holds a worker while it is open, but no database connection
+    :param operation_id: id of the operation
+    :return: text/event-stream response
+    """
+    config = current_app.config
+    user_profile_id = current_user.user_profile_id
+    state = load_operation(operation_id, user_profile_id)
+    if state is None:
+        return jsonify(message="Operation not found", success=False), 404
+
+    def events(state):
+        version = request.headers.get("Last-Event-ID")
+        deadline = time.monotonic() + config.get("ASYNC_OPERATION_STREAM_TIMEOUT")
+        while True:
+            if state["version"] != version or is_finished(state):
+                version = state["version"]
+                yield "event: {}\nid: {}\ndata: {}\n\n".format("done" if is_finished(state) else "progress",
+                                                               version, json.dumps(state))
+            if is_finished(state) or time.monotonic() >= deadline:
+                return
+            state = wait_for_change(operation_id, user_profile_id, version,
+                                    min(config.get("ASYNC_OPERATION_KEEPALIVE"), deadline - time.monotonic()),
+                                    config.get("ASYNC_OPERATION_POLL_INTERVAL"))
+            if state is None:
+                return
+            if state["version"] == version:
+                # keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+
+    return Response(stream_with_context(events(state)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
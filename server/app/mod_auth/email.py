@@ -1,19 +1,133 @@
-from flask_mail import Message
+"""
+Mail is sent through a persistent outbox. send_mail only stores the message and wakes up the celery worker,
+which sends the due messages in batches over a single SMTP connection. Messages that could not be sent are
+retried with exponential backoff, the send_outbox task is also run periodically by celery beat so that
+retries happen and nothing is left behind when the broker was unreachable.
+"""
+import smtplib
+from datetime import datetime, timedelta
+
 from flask import current_app
-from app import mail
+from flask_mail import Message
+from app import mail, db, celery
+from .models import OutboxMessage
 
 
 def send_mail(to, subject, template):
     """
-    Sends a new confirmation email to the registering user
+    Adds a message to the outbox and returns right away, the message is sent by the mail worker
     :param to: which email address to send to
     :param subject: the subject of the email
     :param template: the template to use.
+    :return: the message in the outbox
+    :rtype: OutboxMessage
+    """
+    message = OutboxMessage(recipient=to, subject=subject, html=template,
+                            sender=current_app.config.get("MAIL_DEFAULT_SENDER"))
+    db.session.add(message)
+    db.session.commit()
+
+    try:
+        # publishing is not retried, the request would wait on a broker that is down
+        send_outbox.apply_async(retry=False)
+    except Exception:
+        # the message is safely in the outbox, it is sent on the next periodic run
+        current_app.logger.warning("Could not queue send_outbox, mail will be sent on the next periodic run",
+                                   exc_info=True)
+    return message
+
+
+@celery.task(ignore_result=True)
+def send_outbox():
+    """
+    Sends the due messages of the outbox, MAIL_OUTBOX_BATCH_SIZE messages at a time over one SMTP connection
+    :return: number of messages sent
+    :rtype: int
+    """
+    sent = 0
+    try:
+        while True:
+            messages = claim_messages(current_app.config.get("MAIL_OUTBOX_BATCH_SIZE"))
+            if not messages:
+                break
+            batch_sent = deliver(messages)
+            sent += batch_sent
+            if batch_sent < len(messages):
+                # the mail server is refusing mail, leave the rest for the retries
+                break
+    finally:
+        # the worker keeps one application context for its lifetime, thus every task starts with a new session,
+        # an eager task shares the session of the request that queued it
+        if not send_outbox.request.is_eager:
+            db.session.remove()
+    return sent
+
+
+def claim_messages(limit):
+    """
+    Claims the due messages of the outbox, a claimed message is not due again until MAIL_OUTBOX_LEASE seconds
+    have passed, which keeps concurrent workers from sending it twice and retries it if this worker dies
+    :param limit: maximum number of messages to claim
+    :return: the claimed messages
+    :rtype: list
+    """
+    now = datetime.utcnow()
+    messages = OutboxMessage.query.filter(OutboxMessage.status == "pending",
+                                          OutboxMessage.next_attempt_at <= now) \
+        .order_by(OutboxMessage.next_attempt_at).limit(limit).with_for_update(skip_locked=True).all()
+    lease = timedelta(seconds=current_app.config.get("MAIL_OUTBOX_LEASE"))
+    for message in messages:
+        message.attempts += 1
+        message.next_attempt_at = now + lease
+    db.session.commit()
+    return messages
+
+
+def deliver(messages):
+    """
+    Sends claimed messages over a single SMTP connection and records the outcome of each
+    :param messages: claimed messages
+    :return: number of messages sent
+    :rtype: int
+    """
+    pending = list(messages)
+    try:
+        with mail.connect() as connection:
+            while pending:
+                message = pending[0]
+                try:
+                    connection.send(Message(subject=message.subject, recipients=[message.recipient],
+                                            html=message.html, sender=message.sender))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as error:
+                    # refused by the server, the connection is still usable for the other messages
+                    retry_later(message, error)
+                else:
+                    message.status = "sent"
+                    message.sent_at = datetime.utcnow()
+                    message.last_error = None
+                pending.pop(0)
+                db.session.commit()
+    except (smtplib.SMTPException, OSError) as error:
+        # the connection failed, every message that has not been sent yet is retried
+        for message in pending:
+            retry_later(message, error)
+        db.session.commit()
+    return sum(1 for message in messages if message.status == "sent")
+
+
+def retry_later(message, error):
+    """
+    Schedules the next attempt of a message with exponential backoff, or gives up on it after
+    MAIL_OUTBOX_MAX_ATTEMPTS attempts
+    :param message: the message that could not be sent
+    :param error: why it could not be sent
     """
-    msg = Message(
-        subject=subject,
-        recipients=[to],
-        html=template,
-        sender=current_app.config.get("MAIL_DEFAULT_SENDER")
-    )
-    mail.send(msg)
+    config = current_app.config
+    message.last_error = str(error)
+    if message.attempts >= config.get("MAIL_OUTBOX_MAX_ATTEMPTS"):
+        message.status = "failed"
+        current_app.logger.error("Giving up on mail to {}: {}".format(message.recipient, error))
+        return
+    delay = min(config.get("MAIL_OUTBOX_RETRY_DELAY") * 2 ** (message.attempts - 1),
+                config.get("MAIL_OUTBOX_MAX_RETRY_DELAY"))
+    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
@@ -2,15 +2,14 @@
 These are models related to authentication, Will inherit from base models
 """
 
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Boolean, BigInteger, Text, Index, event
+from sqlalchemy.orm import relationship, Session, object_session, make_transient_to_detached
 from abc import ABCMeta
 import uuid
 from sqlalchemy.ext.declarative import declared_attr
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from app.models import Base
-from app import db, login_manager
+from app import db, login_manager, user_cache, password_hasher
 from datetime import datetime
 from json import loads
 
@@ -73,6 +72,11 @@ class PiCloudUserProfile(Base):
                                                                             self.last_name, self.email)
 
 
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# columns of the account that are never put in the user cache
+UNCACHED_COLUMNS = frozenset(["password_hash"])
+
+
 class PiCloudUserAccount(db.Model, UserMixin):
     """
     User account table containing all sensitive account information, like passwords, username, etc
@@ -88,7 +92,7 @@ class PiCloudUserAccount(db.Model, UserMixin):
     :cvar registered_on, when this account was first registered
     """
     __tablename__ = "user_account"
-    uid = Column(String(250), default=str(uuid.uuid4()), nullable=False)
+    uid = Column(String(250), default=lambda: str(uuid.uuid4()), nullable=False)
     username = Column(String(500), nullable=True, unique=True)
     email = Column(String(500), nullable=False, unique=True)
     password_hash = Column(String(250), nullable=False)
@@ -98,15 +102,16 @@ class PiCloudUserAccount(db.Model, UserMixin):
     confirmed_on = Column(DateTime, nullable=True)
 
     user_id = Column(Integer, primary_key=True, autoincrement=True, unique=True)
-    user_profile_id = Column(Integer, ForeignKey(PiCloudUserProfile.id))
+    user_profile_id = Column(Integer, ForeignKey(PiCloudUserProfile.id), index=True)
     user_profile = relationship(PiCloudUserProfile)
 
     def get_id(self):
         """
-        Overriding id attribute to fetch this id
-        :return: the user profile id
+        Overriding id attribute to fetch this id, this is the id stored in the session and passed
+        to load_user
+        :return: the user account id
         """
-        return self.user_profile_id
+        return str(self.user_id)
 
     @property
     def is_anonymous(self):
@@ -137,10 +142,11 @@ class PiCloudUserAccount(db.Model, UserMixin):
     @password.setter
     def password(self, password):
         """
-        Sets the password for the user and generates a password hash
+        Sets the password for the user and generates a password hash, the hash is computed by the password
+        hasher so that it does not block other requests
         :param password: user input password
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     @password.getter
     def get_password(self):
@@ -155,9 +161,23 @@ class PiCloudUserAccount(db.Model, UserMixin):
         Verify a user's password to enable authentication into the system
         This will check the password hash against the input user password,
         :param password, the password to verify
-        :return:
+        :return: True if the password is correct
+        :rtype: bool
+        """
+        return password_hasher.verify(self.password_hash, password)
+
+    def rehash_password(self, password):
+        """
+        Rehashes the password if it was hashed with other cost parameters than the configured ones, must be
+        called with a password that has just been verified
+        :param password: the verified password
+        :return: True if the password has been rehashed
+        :rtype: bool
         """
-        return check_password_hash(self.password_hash, password)
+        if not password_hasher.needs_rehash(self.password_hash):
+            return False
+        self.password = password
+        return True
 
     # todo: create tests for json 'converters'
     def from_json(self, picluod_user_account):
@@ -188,6 +208,41 @@ class PiCloudUserAccount(db.Model, UserMixin):
             confirmed=self.confirmed, confirmed_on=self.confirmed_on
         )
 
+    def to_cache(self):
+        """
+        Column values of the account for the user cache, dates are stored in DATE_FORMAT. The password hash is
+        left out as the cache is shared through redis, an account read from the cache loads it from the
+        database when a password is checked or changed
+        :return: JSON serializable dict of the column values
+        :rtype: dict
+        """
+        values = {}
+        for column in self.__table__.columns:
+            if column.key in UNCACHED_COLUMNS:
+                continue
+            value = getattr(self, column.key)
+            values[column.key] = value.strftime(DATE_FORMAT) if isinstance(value, datetime) else value
+        return values
+
+    @classmethod
+    def from_cache(cls, values):
+        """
+        Recreates an account from the values stored by to_cache and merges it into the session without
+        querying the database, relationships are still loaded when they are accessed
+        :param values: column values of the account
+        :return: account attached to the current session
+        :rtype: PiCloudUserAccount
+        """
+        values = dict(values)
+        for column in cls.__table__.columns:
+            if isinstance(column.type, DateTime) and values.get(column.key) is not None:
+                values[column.key] = datetime.strptime(values[column.key], DATE_FORMAT)
+        for key in UNCACHED_COLUMNS:
+            values.pop(key, None)
+        user = cls(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def __repr__(self):
         """
         Return a formatted and human readable format
@@ -203,12 +258,42 @@ class PiCloudUserAccount(db.Model, UserMixin):
 @login_manager.user_loader
 def load_user(user_id):
     """
-    callback used to reload the user object from the user id stored in the session
+    callback used to reload the user object from the user id stored in the session, this runs on every
+    authenticated request thus the account is served from the user cache when possible
     :param user_id: user id
     :return: User object stored in the session
     :rtype: PiCloudUserAccount
     """
-    return PiCloudUserAccount.query.get(int(user_id))
+    values = user_cache.get(user_id)
+    if values is not None:
+        return PiCloudUserAccount.from_cache(values)
+
+    # read before the query, the row is not cached if the account changes in the meantime
+    version = user_cache.version(user_id)
+    user = PiCloudUserAccount.query.get(int(user_id))
+    if user is not None:
+        user_cache.set(user_id, user.to_cache(), version)
+    return user
+
+
+@event.listens_for(PiCloudUserAccount, "after_update")
+@event.listens_for(PiCloudUserAccount, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    """
+    Drops a changed account from the user cache when it is flushed, and again once the transaction commits
+    so that a request that cached the old row in the meantime does not keep it. Bulk updates with
+    Query.update do not go through here
+    """
+    user_cache.invalidate(target.get_id())
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", set()).add(target.get_id())
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_users(session):
+    for user_id in session.info.pop("changed_users", ()):
+        user_cache.invalidate(user_id)
 
 
 # todo: add data metrics for checking who uploaded what when
@@ -290,12 +375,48 @@ class GoogleAccount(ExternalServiceAccount):
         self.google_id = google_id
 
 
+# codes of the async operation statuses by id, the statuses are seeded once and never change
+_status_codes = {}
+
+
 class AsyncOperationStatus(Base):
     """
     Dictionary table that stores 3 available statuses, pending, ok, error
+    The statuses are cached in each process, thus looking them up costs no query and operations do not have
+    to be joined with this table
     """
     __tablename__ = "async_operation_status"
-    code = Column("code", String(20), nullable=True)
+    code = Column("code", String(20), nullable=True, index=True)
+
+    @staticmethod
+    def id_for(code):
+        """
+        :param code: status code, one of pending, ok, error
+        :return: id of the status with the given code, None if there is no such status
+        :rtype: int
+        """
+        if code not in _status_codes.values():
+            AsyncOperationStatus._load()
+        for status_id, status_code in _status_codes.items():
+            if status_code == code:
+                return status_id
+        return None
+
+    @staticmethod
+    def code_for(status_id):
+        """
+        :param status_id: id of a status
+        :return: code of the status, None if there is no such status
+        :rtype: str
+        """
+        if status_id is not None and status_id not in _status_codes:
+            AsyncOperationStatus._load()
+        return _status_codes.get(status_id)
+
+    @staticmethod
+    def _load():
+        # a missing status is looked up again next time, e.g. before init_async_values has been run
+        _status_codes.update(db.session.query(AsyncOperationStatus.id, AsyncOperationStatus.code).all())
 
     def __repr__(self):
         return "Id: {} Code: {}".format(self.id, self.code)
@@ -303,15 +424,93 @@ class AsyncOperationStatus(Base):
 
 class AsyncOperation(Base):
     """
-
+    Long running operation started by a user, such as a resumable upload
+    :cvar operation: kind of operation, e.g. upload
+    :cvar target: what the operation works on, e.g. the media path an upload is written to
+    :cvar total: amount of work to do, e.g. the size of an upload in bytes
+    :cvar completed: amount of work done so far
+    :cvar details: JSON document with state specific to the kind of operation
+    :cvar task_id: id of the celery task running the operation, if it runs in the background
+    :cvar started_at: when the task started running
+    :cvar finished_at: when the task succeeded or failed
+    :cvar result: JSON document with the return value of the task, or its error
     """
     __tablename__ = "async_operation"
-    async_operation_status_id = Column(Integer, ForeignKey("async_operation_status.id"))
-    user_profile_id = Column(Integer, ForeignKey("user_profile.id"))
+    async_operation_status_id = Column(Integer, ForeignKey("async_operation_status.id"), index=True)
+    user_profile_id = Column(Integer, ForeignKey("user_profile.id"), index=True)
+    operation = Column(String(50), nullable=True)
+    target = Column(String(1000), nullable=True)
+    total = Column(BigInteger, nullable=True)
+    completed = Column(BigInteger, nullable=False, default=0)
+    details = Column(Text, nullable=True)
+    task_id = Column(String(155), nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    result = Column(Text, nullable=True)
 
     status = relationship("AsyncOperationStatus", foreign_keys=async_operation_status_id)
     user_profile = relationship("PiCloudUserProfile", foreign_keys=user_profile_id)
 
+    @staticmethod
+    def status_id(code):
+        """
+        :param code: status code, one of pending, ok, error
+        :return: id of the status with the given code
+        :rtype: int
+        """
+        return AsyncOperationStatus.id_for(code)
+
+    @property
+    def status_code(self):
+        """
+        :return: code of the status of the operation, looked up without loading the status
+        :rtype: str
+        """
+        return AsyncOperationStatus.code_for(self.async_operation_status_id)
+
+    @property
+    def progress(self):
+        """
+        :return: percentage of the operation that is done, None if the amount of work is unknown
+        :rtype: float
+        """
+        if not self.total:
+            return 100.0 if self.status_code == "ok" else None
+        return round(100.0 * (self.completed or 0) / self.total, 1)
+
     def __repr__(self):
         return "AsyncOpsId:{}, User Profile Id:{}, Status:{}, Profile:{}".format(
             self.async_operation_status_id, self.user_profile_id, self.status, self.user_profile)
+
+
+class OutboxMessage(Base):
+    """
+    Mail waiting to be sent by the mail worker, views only add messages to the outbox so that they never
+    wait on the mail server
+    :cvar recipient: email address the message is sent to
+    :cvar sender: email address the message is sent from
+    :cvar subject: subject of the message
+    :cvar html: html body of the message
+    :cvar status: pending until the message is sent or has failed MAIL_OUTBOX_MAX_ATTEMPTS times
+    :cvar attempts: number of times sending the message has been attempted
+    :cvar next_attempt_at: when the message is due, claiming a message pushes this back for the duration of
+    the send so that other workers leave it alone
+    :cvar last_error: the error of the last failed attempt
+    :cvar sent_at: when the message was handed to the mail server
+    """
+    __tablename__ = "mail_outbox"
+    # the worker looks for the due pending messages, sent and failed messages are skipped by the index
+    __table_args__ = (Index("ix_mail_outbox_status_next_attempt_at", "status", "next_attempt_at"),)
+    recipient = Column(String(500), nullable=False)
+    sender = Column(String(500), nullable=True)
+    subject = Column(String(500), nullable=False)
+    html = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return "OutboxMessage <To: {}, Subject: {}, Status: {}, Attempts: {}>".format(
+            self.recipient, self.subject, self.status, self.attempts)
@@ -0,0 +1,148 @@
+"""
+Bulk provisioning of user accounts from a CSV or NDJSON file, used by manage.py import_users.
+The file is streamed in batches, each batch hashes its passwords on all the password hasher workers and is
+inserted with one statement per table in a single transaction, or with COPY on PostgreSQL. Accounts whose
+email is already registered, or that appear twice in the file, are skipped.
+"""
+import csv
+import io
+import itertools
+import json
+import uuid
+from datetime import datetime
+
+from sqlalchemy import select, or_
+
+from app import db, password_hasher
+from .models import PiCloudUserAccount, PiCloudUserProfile
+
+# fields every account of the file must have
+REQUIRED_FIELDS = ("first_name", "last_name", "email", "password")
+
+FILE_FORMATS = ("csv", "ndjson")
+
+TRUE_VALUES = frozenset(["1", "true", "yes", "y", "on"])
+
+
+def read_users(stream, file_format):
+    """
+    Reads the accounts of a file one at a time
+    :param stream: text file object
+    :param file_format: csv, with a header line naming the fields, or ndjson, one JSON object per line
+    :return: generator of the accounts as dictionaries
+    :rtype: generator
+    """
+    if file_format == "csv":
+        for row in csv.DictReader(stream):
+            yield row
+    elif file_format == "ndjson":
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError("Unknown file format {}, expected one of {}".format(file_format, ", ".join(FILE_FORMATS)))
+
+
+def import_users(users, batch_size=1000):
+    """
+    Creates a user profile and a user account for each account read from a file
+    :param users: iterable of dictionaries with the fields first_name, last_name, email, password and
+    optionally accept_terms, admin and confirmed
+    :param batch_size: number of accounts hashed and inserted together
+    :return: number of accounts imported, skipped as duplicates and skipped as invalid
+    :rtype: dict
+    """
+    result = dict(imported=0, duplicates=0, invalid=0)
+    seen = set()
+    users = iter(users)
+    while True:
+        batch = list(itertools.islice(users, batch_size))
+        if not batch:
+            break
+
+        valid = []
+        for user in batch:
+            if not all(str(user.get(field) or "").strip() for field in REQUIRED_FIELDS):
+                result["invalid"] += 1
+                continue
+            email = user["email"].strip()
+            if email in seen:
+                result["duplicates"] += 1
+                continue
+            seen.add(email)
+            valid.append(dict(user, email=email))
+
+        existing = _registered_emails([user["email"] for user in valid])
+        new_users = [user for user in valid if user["email"] not in existing]
+        result["duplicates"] += len(valid) - len(new_users)
+        if not new_users:
+            continue
+
+        # hashed before the transaction starts, so that it is not held open while the workers are busy
+        password_hashes = password_hasher.hash_many(user["password"] for user in new_users)
+        with db.engine.begin() as connection:
+            _insert_batch(connection, new_users, password_hashes)
+        result["imported"] += len(new_users)
+    return result
+
+
+def _registered_emails(emails):
+    if not emails:
+        return set()
+    profiles = PiCloudUserProfile.__table__
+    accounts = PiCloudUserAccount.__table__
+    query = select([profiles.c.email]).where(profiles.c.email.in_(emails)).union(
+        select([accounts.c.email]).where(or_(accounts.c.email.in_(emails), accounts.c.username.in_(emails))))
+    return set(row[0] for row in db.engine.execute(query))
+
+
+def _insert_batch(connection, users, password_hashes):
+    now = datetime.now()
+    profiles = PiCloudUserProfile.__table__
+    accounts = PiCloudUserAccount.__table__
+
+    _insert(connection, profiles, [
+        dict(first_name=user["first_name"], last_name=user["last_name"], email=user["email"],
+             accept_terms=_flag(user.get("accept_terms")), date_created=now, date_modified=now)
+        for user in users
+    ])
+    # the ids can not be returned by executemany nor COPY, thus they are read back in one query
+    emails = [user["email"] for user in users]
+    profile_ids = dict(connection.execute(select([profiles.c.email, profiles.c.id])
+                                          .where(profiles.c.email.in_(emails))).fetchall())
+    _insert(connection, accounts, [
+        dict(uid=str(uuid.uuid4()), username=user["email"], email=user["email"], password_hash=password_hash,
+             admin=_flag(user.get("admin")), registered_on=now, confirmed=_flag(user.get("confirmed")),
+             confirmed_on=now if _flag(user.get("confirmed")) else None, user_profile_id=profile_ids[user["email"]])
+        for user, password_hash in zip(users, password_hashes)
+    ])
+
+
+def _insert(connection, table, rows):
+    """
+    Inserts rows with COPY on PostgreSQL through psycopg2, which is much faster than an INSERT per row, and
+    with a single executemany INSERT otherwise
+    """
+    if connection.dialect.driver == "psycopg2":
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            # empty unquoted values are NULL in COPY's csv format
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table.name, ", ".join(columns)),
+                               buffer)
+        finally:
+            cursor.close()
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def _flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in TRUE_VALUES
@@ -1,14 +1,50 @@
 from . import auth
 from flask import render_template, redirect, url_for, current_app, session, request, flash
 from datetime import datetime
-from app import db
+from app import db, rate_limiter
+from app.password_hasher import PasswordHasherBusy
 from flask_login import login_user, login_required, current_user, logout_user
+from sqlalchemy.exc import IntegrityError
 from .models import PiCloudUserAccount, PiCloudUserProfile
 from .forms import LoginForm, RegisterForm, RecoverPasswordForm, ChangePasswordForm
 from .tokens import generate_token, confirm_token
 from .email import send_mail
 
 
+@auth.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """
+    Too many passwords are being hashed, the client is asked to try again shortly instead of piling up more work
+    """
+    return "Too many sign ins at the moment, please try again shortly", 503, {"Retry-After": "5"}
+
+
+@auth.before_request
+def throttle_auth_requests():
+    """
+    Limits the POST requests to the auth views per client address and per account, every one of them hashes
+    a password or sends a mail. This runs before the views, so a limited request costs a redis round trip
+    and none of the hashing or database work. Behind a reverse proxy the client address must be set from
+    X-Forwarded-For, e.g. with werkzeug's ProxyFix
+    :return: 429 response if a limit has been reached, None otherwise
+    """
+    if request.method != "POST" or not rate_limiter.enabled:
+        return None
+
+    limits = current_app.config.get("AUTH_RATE_LIMITS")
+    keys = [("ip", request.remote_addr)]
+    email = request.form.get("email")
+    if email:
+        keys.append(("account", email.strip().lower()))
+
+    for scope, value in keys:
+        limit, window = limits[scope]
+        retry_after = rate_limiter.hit("auth:{}:{}".format(scope, value), limit, window)
+        if retry_after:
+            return "Too many requests, please try again later", 429, {"Retry-After": str(retry_after)}
+    return None
+
+
 @auth.route('/login', methods=["POST", "GET"])
 def login():
     """
@@ -23,13 +59,16 @@ def login():
 
             # if the user is valid and their password checks out, log them in
             if picloud_user is not None and picloud_user.verify_password(login_form.password.data):
+                # upgrade the hash if the hashing parameters have changed since it was created
+                if picloud_user.rehash_password(login_form.password.data):
+                    db.session.commit()
+
                 # login user
                 login_user(picloud_user, login_form.remember_me.data)
 
                 # display a message
                 flash(message="Welcome back {}!".format(picloud_user.username), category="success")
-                print("User", picloud_user)
-                print("login success")
+                current_app.logger.info("User {} logged in".format(picloud_user.user_id))
 
                 # todo: dashboard redirect
                 # redirect to dashboard
@@ -38,8 +77,7 @@ def login():
             else:
                 # flash error message
                 flash(message="Invalid email or password", category="error")
-                print("User", picloud_user)
-                print("login failed")
+                current_app.logger.info("Failed login from {}".format(request.remote_addr))
 
     return render_template("auth/login.html", login_form=login_form)
 
@@ -57,47 +95,50 @@ def register():
 
     if request.method == "POST":
         if register_form.validate_on_submit():
-            # check if the user credentials already exist
-            picloud_user = PiCloudUserAccount.query.filter_by(email=register_form.email.data).first()
-
-            # if they do no exist, create this user
-            if picloud_user is None:
-                picloud_user_profile = PiCloudUserProfile(first_name=register_form.first_name.data,
-                                                          last_name=register_form.last_name.data,
-                                                          email=register_form.email.data,
-                                                          accept_terms=register_form.accept_terms.data)
-                picloud_user_account = PiCloudUserAccount(password=register_form.password.data,
-                                                          email=register_form.email.data,
-                                                          username=register_form.email.data,
-                                                          registered_on=datetime.now(),
-                                                          confirmed=False)
-                # add to db session and commit
-                db.session.add(picloud_user_account)
-                db.session.add(picloud_user_profile)
+            picloud_user_profile = PiCloudUserProfile(first_name=register_form.first_name.data,
+                                                      last_name=register_form.last_name.data,
+                                                      email=register_form.email.data,
+                                                      accept_terms=register_form.accept_terms.data)
+            picloud_user_account = PiCloudUserAccount(password=register_form.password.data,
+                                                      email=register_form.email.data,
+                                                      username=register_form.email.data,
+                                                      registered_on=datetime.now(),
+                                                      confirmed=False,
+                                                      user_profile=picloud_user_profile)
+
+            # both rows are inserted in one transaction, the unique constraints on the email catch an existing
+            # account instead of looking it up first, which would also race with a concurrent registration
+            db.session.add(picloud_user_account)
+            try:
                 db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                register_form.email.errors.append("Email already exists")
+                flash(message="Email already exists", category="error")
+                return render_template("auth/register.html", register_form=register_form)
+
+            # build token and send an email for user confirmation
+            email = register_form.email.data
+            token = generate_token(email)
 
-                # build token and send an email for user confirmation
-                token = generate_token(picloud_user_profile.email)
-
-                # _external adds the full url that includes the hostname and port
-                confirm_url = url_for("auth.confirm_email", token=token, _external=True)
+            # _external adds the full url that includes the hostname and port
+            confirm_url = url_for("auth.confirm_email", token=token, _external=True)
 
-                # build the message
-                html = render_template("auth/confirm_email.html", confirm_url=confirm_url)
-                subject = "Please confirm you email"
+            # build the message
+            html = render_template("auth/confirm_email.html", confirm_url=confirm_url)
+            subject = "Please confirm you email"
 
-                # send the user an email
-                send_mail(picloud_user_profile.email, subject, html)
+            # send the user an email
+            send_mail(email, subject, html)
 
-                # login the user
-                login_user(picloud_user_account)
+            # login the user
+            login_user(picloud_user_account)
 
-                # flash the message
-                flash(message="A confirmation email has been sent to {}".format(picloud_user_account.email),
-                      category="success")
+            # flash the message
+            flash(message="A confirmation email has been sent to {}".format(email), category="success")
 
-                # todo: redirect unconfirmed users to the unconfirmed view
-                # return redirect(url_for("dashboard.unconfirmed"))
+            # todo: redirect unconfirmed users to the unconfirmed view
+            # return redirect(url_for("dashboard.unconfirmed"))
 
     return render_template("auth/register.html", register_form=register_form)
 
@@ -159,7 +200,7 @@ def recover_password(token):
     if not email:
         # flash a message and redirect to login
         flash(message="The confirmation link has expired or is invalid", category="error")
-        print("recover_password: Email is not valid", email)
+        current_app.logger.info("Password reset with an invalid or expired token")
         return redirect(url_for("auth.login"))
 
     else:
@@ -170,13 +211,13 @@ def recover_password(token):
                 picloud_user = PiCloudUserAccount.query.filter_by(email=email).first()
 
                 # change the password
-                picloud_user.password_hash = change_password_form.password_field_1.data
+                picloud_user.password = change_password_form.password_field_1.data
 
                 db.session.add(picloud_user)
                 db.session.commit()
 
                 flash(message="Password has been reset", category="success")
-                print("Password reset successfully")
+                current_app.logger.info("User {} reset their password".format(picloud_user.user_id))
                 return render_template("auth/change_password.html",
                                        change_password_form=change_password_form)
             else:
@@ -0,0 +1,123 @@
+"""
+Streams ZIP archives of directories while they are being walked. The archive is written into a small buffer
+that is drained after every write, thus no temporary file is created and the memory used does not grow with
+the size of the files being archived, only the central directory (a few dozen bytes per file) is kept
+until the end of the archive. Entries switch to ZIP64 when they need to, and media that is already
+compressed is stored instead of being deflated again.
+"""
+import os
+import stat
+import time
+import zipfile
+
+from app.media_tree import IGNORED_NAMES
+
+BUFFER_SIZE = 64 * 1024
+# ZIP stores MS-DOS timestamps, which can not hold times before 1980 or after 2107
+EARLIEST_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+LATEST_DATE_TIME = (2107, 12, 31, 23, 59, 59)
+
+
+class _StreamBuffer(object):
+    """
+    Write only file object handed to ZipFile. It can tell its position but can not seek, which makes ZipFile
+    write data descriptors after each entry instead of seeking back to patch the local headers
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        :return: everything written since the last drain
+        :rtype: bytes
+        """
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def file_entry(arcname, file_stat):
+    """
+    Creates the entry of a file, as ZipInfo.from_file with strict_timestamps=False does on python 3.8 and
+    later. Modification times a ZIP can not hold are clamped, raising would cut the archive short as its
+    headers have already been sent
+    :param arcname: name of the file in the archive
+    :param file_stat: os.stat_result of the file
+    :rtype: zipfile.ZipInfo
+    """
+    try:
+        date_time = time.localtime(file_stat.st_mtime)[:6]
+    except (OverflowError, OSError, ValueError):
+        date_time = LATEST_DATE_TIME if file_stat.st_mtime > 0 else EARLIEST_DATE_TIME
+    entry = zipfile.ZipInfo(arcname, min(max(date_time, EARLIEST_DATE_TIME), LATEST_DATE_TIME))
+    entry.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+    entry.file_size = file_stat.st_size
+    return entry
+
+
+def zip_directory(full_path, stored_extensions):
+    """
+    Generates a ZIP archive of a directory and everything below it. Symlinks are skipped so the archive
+    can not reach outside of the directory
+    :param full_path: absolute path of the directory to archive
+    :param stored_extensions: file extensions, without the dot, of files that are stored uncompressed
+    :return: generator of the bytes of the archive
+    """
+    buffer = _StreamBuffer()
+    base_name = os.path.basename(os.path.normpath(full_path))
+
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            dirnames[:] = sorted(name for name in dirnames if name not in IGNORED_NAMES)
+            relative_dir = os.path.relpath(dirpath, full_path)
+            arc_dir = base_name if relative_dir == os.curdir else os.path.join(base_name, relative_dir)
+            arc_dir = arc_dir.replace(os.sep, "/")
+
+            if not filenames and not dirnames:
+                # keep empty directories in the archive
+                archive.writestr(zipfile.ZipInfo(arc_dir + "/"), b"")
+                yield buffer.drain()
+
+            for name in sorted(filenames):
+                file_path = os.path.join(dirpath, name)
+                try:
+                    file_stat = os.lstat(file_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+
+                entry = file_entry(arc_dir + "/" + name, file_stat)
+                extension = os.path.splitext(name)[1][1:].lower()
+                entry.compress_type = zipfile.ZIP_STORED if extension in stored_extensions else zipfile.ZIP_DEFLATED
+
+                try:
+                    source = open(file_path, "rb")
+                except OSError:
+                    continue
+                with source, archive.open(entry, mode="w", force_zip64=entry.file_size > zipfile.ZIP64_LIMIT) as dest:
+                    while True:
+                        chunk = source.read(BUFFER_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        data = buffer.drain()
+                        if data:
+                            yield data
+                yield buffer.drain()
+
+    # the central directory is written when the archive is closed
+    yield buffer.drain()
@@ -0,0 +1,200 @@
+"""
+Optional content addressed store that deduplicates uploaded files, enabled with MEDIA_DEDUP_ENABLED.
+Each drive gets a hidden store directory holding one blob per distinct content, uploaded files are hard
+links to their blob, thus uploading the same phone backup again takes no extra space. Hard links share
+their content, so a file edited in place changes every copy of it, which is fine for media files that are
+uploaded and then only read.
+
+Content is identified by a block hash: the sha256 of the concatenated sha256 digests of each block of
+MEDIA_DEDUP_BLOCK_SIZE bytes. Unlike a plain sha256 of the whole file, the block digests can be computed as
+the chunks of an upload arrive, in any order, and the client can compute the same hash up front to skip
+uploading content that is already stored.
+"""
+import hashlib
+import os
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from app import db, media_tree
+from app.media_tree import STORE_DIR_NAME
+from .models import ContentBlob, ContentBlobOwner
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def dedup_enabled():
+    return bool(current_app.config.get("MEDIA_DEDUP_ENABLED"))
+
+
+def block_size():
+    return current_app.config.get("MEDIA_DEDUP_BLOCK_SIZE")
+
+
+def hash_block(fd, index, size):
+    """
+    Hashes a single block of a file
+    :param fd: file descriptor of the file
+    :param index: index of the block
+    :param size: size of the whole file
+    :return: hex digest of the block
+    :rtype: str
+    """
+    start = index * block_size()
+    stop = min(start + block_size(), size)
+    digest = hashlib.sha256()
+    while start < stop:
+        chunk = os.pread(fd, min(BUFFER_SIZE, stop - start), start)
+        if not chunk:
+            break
+        digest.update(chunk)
+        start += len(chunk)
+    return digest.hexdigest()
+
+
+def completed_blocks(ranges, size):
+    """
+    :param ranges: merged [start, stop] ranges that have been received
+    :param size: size of the whole file
+    :return: indexes of the blocks that have been received completely
+    :rtype: list
+    """
+    blocks = []
+    for start, stop in ranges:
+        first = -(-start // block_size())
+        last = stop // block_size() if stop < size else -(-size // block_size())
+        blocks.extend(range(first, last))
+    return blocks
+
+
+def touched_blocks(start, stop):
+    """
+    :param start: offset of a chunk
+    :param stop: offset the chunk was written up to
+    :return: indexes of the blocks a chunk has written to, in full or in part
+    :rtype: range
+    """
+    return range(start // block_size(), -(-stop // block_size()))
+
+
+def content_hash(block_digests):
+    """
+    :param block_digests: hex digests of each block of a file, in order
+    :return: the content hash of the file
+    :rtype: str
+    """
+    return hashlib.sha256(b"".join(bytes.fromhex(digest) for digest in block_digests)).hexdigest()
+
+
+def blob_path(drive, digest):
+    """
+    :return: absolute path of a blob in the store of a drive
+    :rtype: str
+    """
+    return os.path.join(media_tree.full_path(drive), STORE_DIR_NAME, digest[:2], digest)
+
+
+def find_blob(drive, digest, size, owner_id=None):
+    """
+    Looks up stored content, this is checked before anything is uploaded
+    :param drive: the drive the content should be stored on
+    :param digest: content hash
+    :param size: size of the content
+    :param owner_id: only find content this user profile has uploaded in full, see ContentBlobOwner
+    :return: the blob, None if the content is not stored on the drive
+    :rtype: ContentBlob
+    """
+    query = ContentBlob.query.filter_by(drive=drive, content_hash=digest, size=size)
+    if owner_id is not None:
+        query = query.join(ContentBlobOwner).filter(ContentBlobOwner.user_profile_id == owner_id)
+    blob = query.first()
+    if blob is None or not os.path.isfile(blob_path(drive, digest)):
+        return None
+    return blob
+
+
+def link_blob(blob, target):
+    """
+    Creates a file with the content of a blob
+    :param blob: the stored content
+    :param target: absolute path of the file to create
+    :return: False if the drive does not support hard links
+    :rtype: bool
+    :raises FileExistsError: if the target already exists
+    """
+    try:
+        os.link(blob_path(blob.drive, blob.content_hash), target)
+    except FileExistsError:
+        raise
+    except OSError:
+        return False
+    return True
+
+
+def store_file(drive, path, digest, size):
+    """
+    Moves a file into the store of a drive, if the content is already stored the file is discarded
+    :param drive: the drive the file is on
+    :param path: absolute path of the file
+    :param digest: content hash of the file
+    :param size: size of the file
+    :return: the blob holding the content
+    :rtype: ContentBlob
+    """
+    blob = find_blob(drive, digest, size)
+    if blob is not None:
+        os.remove(path)
+        return blob
+
+    destination = blob_path(drive, digest)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.rename(path, destination)
+
+    blob = ContentBlob(drive=drive, content_hash=digest, size=size)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        # stored by a concurrent upload of the same content in the meantime
+        blob = ContentBlob.query.filter_by(drive=drive, content_hash=digest).first()
+    return blob
+
+
+def add_owner(blob, user_profile_id):
+    """
+    Records that a user has uploaded the content of a blob in full
+    :param blob: the stored content
+    :param user_profile_id: the user that uploaded it
+    """
+    if ContentBlobOwner.query.filter_by(content_blob_id=blob.id, user_profile_id=user_profile_id).first():
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(ContentBlobOwner(content_blob_id=blob.id, user_profile_id=user_profile_id))
+    except IntegrityError:
+        # recorded by a concurrent upload of the same user in the meantime
+        pass
+
+
+def prune_store(drive):
+    """
+    Removes blobs that are no longer linked from anywhere on the drive, the link count of the blob is the
+    number of files sharing its content plus the blob itself
+    :param drive: the drive to prune
+    :return: number of blobs removed
+    :rtype: int
+    """
+    removed = 0
+    for blob in ContentBlob.query.filter_by(drive=drive):
+        path = blob_path(drive, blob.content_hash)
+        try:
+            links = os.stat(path).st_nlink
+        except FileNotFoundError:
+            links = 0
+        if links <= 1:
+            if links:
+                os.remove(path)
+            db.session.delete(blob)
+            removed += 1
+    db.session.commit()
+    return removed
@@ -0,0 +1,220 @@
+"""
+Thumbnails and previews of the images on the drives, so galleries do not have to load the originals.
+Derivatives are built by a tracked celery task, see async_operations, and kept in a disk cache under MEDIA_DERIVATIVE_CACHE_PATH. A cached
+derivative is named after the validator of its original (inode, size and modification time, the same as
+the ETag of downloads) and the variant, thus a changed original gets a new derivative and the stale one is
+evicted eventually. The cache is limited to MEDIA_DERIVATIVE_CACHE_SIZE bytes, the least recently used
+derivatives are evicted first.
+Pillow is optional, without it no derivatives are built.
+"""
+import hashlib
+import os
+import time
+
+from flask import current_app
+
+from app import celery, media_tree
+from app.async_operations import TrackedTask
+from .serving import file_etag
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+# images that derivatives can be built for
+IMAGE_EXTENSIONS = frozenset(["jpg", "jpeg", "png", "gif", "webp", "bmp", "tif", "tiff"])
+
+# a derivative that has been requested but not built after this many seconds is requested again
+PENDING_TIMEOUT = 60
+
+# the cache is evicted down to this fraction of its size, so that not every new derivative triggers an eviction
+EVICTION_LOW_WATER = 0.9
+
+PENDING_SUFFIX = ".pending"
+FAILED_SUFFIX = ".failed"
+
+
+def derivatives_available():
+    """
+    :return: True if Pillow is installed
+    :rtype: bool
+    """
+    return Image is not None
+
+
+def has_derivatives(name):
+    """
+    :param name: name of a file
+    :return: True if derivatives can be built for the file
+    :rtype: bool
+    """
+    return os.path.splitext(name)[1][1:].lower() in IMAGE_EXTENSIONS
+
+
+def derivative_path(file_stat, variant):
+    """
+    :param file_stat: os.stat_result of the original
+    :param variant: name of the derivative, one of MEDIA_DERIVATIVE_SIZES
+    :return: absolute path of the derivative in the cache
+    :rtype: str
+    """
+    key = hashlib.sha256("{}-{}".format(file_etag(file_stat), variant).encode()).hexdigest()
+    return os.path.join(current_app.config.get("MEDIA_DERIVATIVE_CACHE_PATH"), key[:2], key + ".jpg")
+
+
+def get_derivative(full_path, variant, user_profile_id):
+    """
+    Looks up a derivative in the cache and starts building it if it is not cached yet
+    :param full_path: absolute path of the original image
+    :param variant: name of the derivative, one of MEDIA_DERIVATIVE_SIZES
+    :param user_profile_id: the user requesting the derivative, the build is recorded as an operation of theirs
+    :return: tuple of the status, one of ok, pending, failed, and the path of the derivative
+    :rtype: tuple
+    """
+    path = derivative_path(os.stat(full_path), variant)
+    if _mark_used(path):
+        return "ok", path
+    if os.path.exists(path + FAILED_SUFFIX):
+        return "failed", path
+
+    if _claim(path + PENDING_SUFFIX):
+        config = current_app.config
+        build_derivative.start(user_profile_id, full_path, path, config.get("MEDIA_DERIVATIVE_SIZES")[variant],
+                               config.get("MEDIA_DERIVATIVE_QUALITY"), config.get("MEDIA_DERIVATIVE_CACHE_PATH"),
+                               config.get("MEDIA_DERIVATIVE_CACHE_SIZE"), target=media_tree.relative_path(full_path),
+                               total=1)
+        # the task may have run right away, e.g. with an eager celery
+        if os.path.exists(path):
+            return "ok", path
+        if os.path.exists(path + FAILED_SUFFIX):
+            return "failed", path
+    return "pending", path
+
+
+def _mark_used(path):
+    """
+    Records the use of a cached derivative in its access time, which the eviction goes by. The modification
+    time is left alone since it is the Last-Modified of the derivative
+    :return: False if the derivative is not cached
+    :rtype: bool
+    """
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _claim(marker):
+    """
+    Creates the pending marker of a derivative so that concurrent requests do not queue the same work
+    :return: True if the caller should queue the task
+    :rtype: bool
+    """
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    try:
+        os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640))
+        return True
+    except FileExistsError:
+        pass
+    try:
+        if time.time() - os.stat(marker).st_mtime < PENDING_TIMEOUT:
+            return False
+        # the task has been lost, e.g. the worker was restarted
+        os.utime(marker)
+    except FileNotFoundError:
+        # the task finished in the meantime
+        return False
+    return True
+
+
+@celery.task(base=TrackedTask, bind=True, ignore_result=True, operation_name="derivative")
+def build_derivative(self, operation_id, source, target, size, quality, cache_path, cache_size):
+    """
+    Builds a derivative of an image that fits in a size x size box, then evicts the cache if it has grown
+    over its size limit
+    :param operation_id: id of the operation tracking the build
+    :param source: absolute path of the original image
+    :param target: absolute path of the derivative in the cache
+    :param size: maximum width and height of the derivative
+    :param quality: JPEG quality of the derivative
+    :param cache_path: the directory of the cache
+    :param cache_size: maximum size of the cache in bytes
+    """
+    try:
+        build_image(source, target, size, quality)
+    except (IOError, OSError, ValueError):
+        # not an image Pillow can read, do not try again until the original changes
+        open(target + FAILED_SUFFIX, "w").close()
+    finally:
+        try:
+            os.remove(target + PENDING_SUFFIX)
+        except FileNotFoundError:
+            pass
+    self.update_progress(operation_id, 1, 1)
+    evict(cache_path, cache_size)
+
+
+def build_image(source, target, size, quality):
+    """
+    Writes a downscaled JPEG copy of an image, the copy is written to a temporary file first so that a
+    partially written derivative is never served
+    """
+    if not derivatives_available():
+        raise IOError("Pillow is not installed")
+
+    with Image.open(source) as image:
+        # JPEG images are decoded at a reduced scale right away, which is much faster than decoding them fully
+        image.draft("RGB", (size, size))
+        if hasattr(ImageOps, "exif_transpose"):
+            image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        temp = "{}.{}.tmp".format(target, os.getpid())
+        try:
+            image.save(temp, "JPEG", quality=quality, optimize=True, progressive=True)
+            os.replace(temp, target)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+def evict(cache_path, cache_size):
+    """
+    Removes the least recently used derivatives until the cache is back under its size limit
+    :param cache_path: the directory of the cache
+    :param cache_size: maximum size of the cache in bytes
+    :return: number of derivatives removed
+    :rtype: int
+    """
+    entries, total = [], 0
+    for directory in os.scandir(cache_path):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            if entry.name.endswith(PENDING_SUFFIX):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_atime, entry_stat.st_size, entry.path))
+            total += entry_stat.st_size
+
+    if total <= cache_size:
+        return 0
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= cache_size * EVICTION_LOW_WATER:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
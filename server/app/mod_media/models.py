@@ -0,0 +1,43 @@
+"""
+Models related to the media stored on the drives
+"""
+from sqlalchemy import Column, String, BigInteger, Integer, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relationship
+from app.models import Base
+from app.mod_auth.models import PiCloudUserProfile
+
+
+class ContentBlob(Base):
+    """
+    A file in the content addressed store of a drive. Files with identical content are hard links to the
+    same blob, thus the content is only stored once on each drive
+    :cvar drive: the drive the blob is stored on, hard links can not span drives
+    :cvar content_hash: hash of the content, see app.mod_media.content_store.content_hash
+    :cvar size: size of the content in bytes
+    """
+    __tablename__ = "content_blob"
+    __table_args__ = (UniqueConstraint("drive", "content_hash"),)
+    drive = Column(String(255), nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    owners = relationship("ContentBlobOwner", cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return "ContentBlob <Drive: {}, Hash: {}, Size: {}>".format(self.drive, self.content_hash, self.size)
+
+
+class ContentBlobOwner(Base):
+    """
+    A user that has uploaded the content of a blob in full, the bytes of the upload having been hashed by the
+    server. Only they may create files from the blob by its hash alone, anyone else could otherwise read
+    content they only know the hash of
+    :cvar content_blob_id: the stored content
+    :cvar user_profile_id: the user that uploaded it
+    """
+    __tablename__ = "content_blob_owner"
+    __table_args__ = (UniqueConstraint("content_blob_id", "user_profile_id"),)
+    content_blob_id = Column(Integer, ForeignKey(ContentBlob.id, ondelete="CASCADE"), nullable=False)
+    user_profile_id = Column(Integer, ForeignKey(PiCloudUserProfile.id), nullable=False, index=True)
+
+    def __repr__(self):
+        return "ContentBlobOwner <Blob: {}, User profile: {}>".format(self.content_blob_id, self.user_profile_id)
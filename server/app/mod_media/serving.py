@@ -0,0 +1,231 @@
+"""
+Serves files from the media path with support for conditional requests and byte ranges.
+Single ranges and whole files are handed to the WSGI server's file wrapper, which gunicorn sends with the
+kernel's sendfile, thus the bytes of a file never have to be loaded into Python memory. Multiple ranges
+are sent as a multipart/byteranges body that is read in small chunks.
+"""
+import mimetypes
+import os
+import stat
+import unicodedata
+from calendar import timegm
+from urllib.parse import quote
+from uuid import uuid4
+
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+
+BUFFER_SIZE = 64 * 1024
+# servers whose file wrapper sends no more than the Content-Length of the response, see manage.py transfer
+SENDFILE_SERVERS = ("gunicorn", "picloud-transfer")
+
+
+def file_etag(file_stat):
+    """
+    Creates a strong validator for a file from its inode, size and modification time
+    :param file_stat: os.stat_result of the file
+    :return: the unquoted etag
+    :rtype: str
+    """
+    return "{:x}-{:x}-{:x}".format(file_stat.st_ino, file_stat.st_size, int(file_stat.st_mtime * 1e9))
+
+
+def attachment_disposition(filename):
+    """
+    Creates the Content-Disposition of a download. The name is sent as UTF-8 in filename* (RFC 5987), with an
+    ASCII filename for clients that do not support it, in which accents are dropped from letters and characters
+    that can not be quoted are left out
+    :param filename: name the client should save the download as
+    :rtype: str
+    """
+    fallback = "".join(char for char in unicodedata.normalize("NFKD", filename)
+                       if " " <= char <= "~" and char not in '"\\')
+    return "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(fallback.strip() or "download",
+                                                                    quote(filename, safe=""))
+
+
+def resolve_ranges(byte_range, size):
+    """
+    Resolves the ranges of a Range header against the size of a file. Suffix and open ended ranges are
+    resolved, unsatisfiable ranges are dropped and overlapping or adjacent ranges are merged
+    :param byte_range: werkzeug Range parsed from the request
+    :param size: size of the file
+    :return: sorted list of (start, stop) tuples, stop being exclusive
+    :rtype: list
+    """
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Evaluates If-None-Match and If-Modified-Since, If-None-Match takes precedence when both are sent
+    :param etag: current etag of the resource
+    :param last_modified: current modification time of the resource as a timestamp
+    :return: True if the client already has the current representation
+    :rtype: bool
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return int(last_modified) <= _timestamp(request.if_modified_since)
+    return False
+
+
+def not_modified(etag):
+    """
+    Answers a conditional request for a page or listing read from the media tree index, whose etag is that of
+    the index. Checked before the response is built, so a client polling an unchanged tree costs no queries
+    :param etag: current etag of the index
+    :return: an empty 304 response if the client already has the current representation, None otherwise
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def if_range_matches(etag, last_modified):
+    """
+    If-Range makes a Range request conditional, if the validator does not match the current file the
+    whole file is sent instead of the requested ranges
+    :rtype: bool
+    """
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(last_modified) == _timestamp(if_range.date)
+    return True
+
+
+def _timestamp(date):
+    return timegm(date.utctimetuple())
+
+
+def send_media_file(full_path):
+    """
+    Creates a response for a file on disk, answering conditional requests with 304, Range requests with
+    206 and unsatisfiable ranges with 416
+    :param full_path: absolute path of the file to send
+    :return: the response, None if there is no regular file at the path
+    """
+    try:
+        file_stat = os.stat(full_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+
+    size = file_stat.st_size
+    etag = file_etag(file_stat)
+    mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    response = current_app.response_class(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = file_stat.st_mtime
+    response.headers["Accept-Ranges"] = "bytes"
+
+    if is_not_modified(etag, file_stat.st_mtime):
+        response.status_code = 304
+        return response
+
+    if current_app.use_x_sendfile:
+        # the front end server sends the file and takes care of the ranges
+        response.headers["X-Sendfile"] = full_path
+        response.content_length = size
+        return response
+
+    ranges = None
+    byte_range = request.range
+    if byte_range is not None and byte_range.units == "bytes" and if_range_matches(etag, file_stat.st_mtime):
+        ranges = resolve_ranges(byte_range, size)
+        if not ranges:
+            response.status_code = 416
+            response.headers["Content-Range"] = "bytes */{}".format(size)
+            return response
+        if len(ranges) > current_app.config.get("MEDIA_MAX_RANGES"):
+            # too many ranges is not worth serving piecewise, RFC 7233 allows ignoring the Range header
+            ranges = None
+
+    f = open(full_path, "rb")
+    if not ranges:
+        response.response = wrap_file(request.environ, f, BUFFER_SIZE)
+        response.content_length = size
+        response.direct_passthrough = True
+        return response
+
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        f.seek(start)
+        response.response = _range_body(f, start, stop, size)
+        response.content_length = stop - start
+        response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, size)
+        response.direct_passthrough = True
+        return response
+
+    boundary = uuid4().hex
+    parts = [("--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+        boundary, mimetype, start, stop - 1, size).encode(), start, stop) for start, stop in ranges]
+    closing = "--{}--\r\n".format(boundary).encode()
+    response.response = _multipart_body(f, parts, closing)
+    response.content_length = sum(len(header) + stop - start + 2 for header, start, stop in parts) + len(closing)
+    response.headers["Content-Type"] = "multipart/byteranges; boundary={}".format(boundary)
+    response.direct_passthrough = True
+    return response
+
+
+def _range_body(f, start, stop, size):
+    """
+    A range that runs to the end of the file can be handed to the server's file wrapper as is. Servers
+    that use sendfile limit the bytes sent to the Content-Length, which gunicorn and the transfer server do,
+    thus any range can be handed to them. Other servers read the file wrapper to the end, so the range is read
+    in chunks
+    """
+    if stop == size or request.environ.get("SERVER_SOFTWARE", "").startswith(SENDFILE_SERVERS):
+        return wrap_file(request.environ, f, BUFFER_SIZE)
+    return _read_chunks(f, start, stop)
+
+
+def _read_chunks(f, start, stop):
+    try:
+        for chunk in _pread_chunks(f.fileno(), start, stop):
+            yield chunk
+    finally:
+        f.close()
+
+
+def _multipart_body(f, parts, closing):
+    try:
+        for header, start, stop in parts:
+            yield header
+            for chunk in _pread_chunks(f.fileno(), start, stop):
+                yield chunk
+            yield b"\r\n"
+        yield closing
+    finally:
+        f.close()
+
+
+def _pread_chunks(fd, start, stop):
+    while start < stop:
+        chunk = os.pread(fd, min(BUFFER_SIZE, stop - start), start)
+        if not chunk:
+            return
+        start += len(chunk)
+        yield chunk
@@ -0,0 +1,433 @@
+"""
+Resumable chunked uploads straight to the drives.
+An upload session preallocates a temporary file on the drive it is uploaded to, chunks are streamed from the
+request into that file at their offset without buffering the request body, so chunks may be sent in any
+order, concurrently and again after a dropped connection. The state of each upload is tracked with an
+AsyncOperation, once every byte has been received the upload is finalized by renaming the temporary file
+to its target path.
+When deduplication is enabled the blocks of the upload are hashed as they are received, see content_store.
+Uploads that have not received a chunk for MEDIA_UPLOAD_EXPIRY seconds are cancelled by a periodic task.
+"""
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import celery, db, media_tree
+from app.media_tree import UPLOADS_DIR_NAME
+from app.mod_auth.models import AsyncOperation
+from . import content_store
+
+BUFFER_SIZE = 64 * 1024
+UPLOAD_OPERATION = "upload"
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload request can not be fulfilled
+    :cvar status_code: HTTP status code to respond with
+    """
+
+    def __init__(self, message, status_code=400):
+        super(UploadError, self).__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping and adjacent ranges
+    :param ranges: list of [start, stop] pairs, stop being exclusive
+    :return: sorted list of disjoint [start, stop] pairs
+    :rtype: list
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def temp_path(upload):
+    """
+    :param upload: AsyncOperation of the upload
+    :return: absolute path of the temporary file the upload is written to
+    :rtype: str
+    """
+    drive = upload.target.split("/")[0]
+    return os.path.join(media_tree.full_path(drive), UPLOADS_DIR_NAME, json.loads(upload.details)["temp"])
+
+
+def create_upload(path, size, user_profile_id, content_hash=None):
+    """
+    Creates an upload session and preallocates the temporary file for it on the target drive, the
+    temporary file lives on the same drive so that it can be moved to its target with a rename.
+    If the content hash is given and the same user has already uploaded that content to the drive, the file
+    is linked to the stored content and the upload completes right away. Content uploaded by others is only
+    linked once the bytes have been received and hashed, see finalize_upload
+    :param path: relative media path the file will be written to
+    :param size: size of the file in bytes
+    :param user_profile_id: the user uploading the file
+    :param content_hash: optional content hash of the file, see content_store
+    :return: the AsyncOperation tracking the upload
+    :rtype: AsyncOperation
+    """
+    path = media_tree.normalize(path or "")
+    if not path or "/" not in path or media_tree.resolve(path) is None:
+        raise UploadError("Uploads must target a path inside a drive")
+    if not isinstance(size, int) or size < 0:
+        raise UploadError("Invalid upload size")
+
+    parent = media_tree.full_path(path.rpartition("/")[0])
+    if not os.path.isdir(parent):
+        raise UploadError("Directory not found", 404)
+    if os.path.lexists(media_tree.full_path(path)):
+        raise UploadError("File already exists", 409)
+
+    drive = path.split("/")[0]
+    if content_hash and content_store.dedup_enabled():
+        blob = content_store.find_blob(drive, content_hash, size, owner_id=user_profile_id)
+        try:
+            linked = blob is not None and content_store.link_blob(blob, media_tree.full_path(path))
+        except FileExistsError:
+            raise UploadError("File already exists", 409)
+        if linked:
+            upload = AsyncOperation(operation=UPLOAD_OPERATION, target=path, total=size, completed=size,
+                                    user_profile_id=user_profile_id,
+                                    async_operation_status_id=AsyncOperation.status_id("ok"),
+                                    details=json.dumps(dict(temp=None, ranges=[[0, size]] if size else [],
+                                                            content_hash=content_hash, deduplicated=True)))
+            db.session.add(upload)
+            db.session.commit()
+            _sync_parent(upload)
+            return upload
+
+    uploads_dir = os.path.join(media_tree.full_path(drive), UPLOADS_DIR_NAME)
+    if not os.path.isdir(uploads_dir):
+        os.makedirs(uploads_dir, exist_ok=True)
+    temp_name = "{}.part".format(uuid.uuid4().hex)
+
+    fd = os.open(os.path.join(uploads_dir, temp_name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+    try:
+        if size:
+            # reserve the space up front, the upload fails now instead of when the drive fills up
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        os.remove(os.path.join(uploads_dir, temp_name))
+        raise UploadError("Not enough space on the drive", 507)
+    os.close(fd)
+
+    upload = AsyncOperation(operation=UPLOAD_OPERATION, target=path, total=size, completed=0,
+                            user_profile_id=user_profile_id,
+                            async_operation_status_id=AsyncOperation.status_id("pending"),
+                            details=json.dumps(dict(temp=temp_name, ranges=[], content_hash=content_hash,
+                                                    blocks={})))
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+def get_upload(upload_id, user_profile_id, lock=False):
+    """
+    :param upload_id: id of the AsyncOperation of the upload
+    :param user_profile_id: the user that must own the upload
+    :param lock: lock the row until the end of the transaction, used when updating the received ranges
+    :return: the AsyncOperation tracking the upload
+    :rtype: AsyncOperation
+    """
+    query = AsyncOperation.query
+    if lock:
+        query = query.with_for_update()
+    upload = query.filter_by(id=upload_id, operation=UPLOAD_OPERATION, user_profile_id=user_profile_id).first()
+    if upload is None:
+        raise UploadError("Upload not found", 404)
+    return upload
+
+
+def write_chunk(upload, offset, length, stream):
+    """
+    Streams a chunk from the request into the temporary file at the given offset and records the range
+    that has been received. Whatever was written before a dropped connection is recorded as well, so
+    the client only has to send the remainder
+    :param upload: AsyncOperation of the upload
+    :param offset: offset of the chunk in the file
+    :param length: length of the chunk, the Content-Length of the request
+    :param stream: file like object to read the chunk from
+    :return: the updated AsyncOperation
+    :rtype: AsyncOperation
+    """
+    upload_id, user_profile_id = upload.id, upload.user_profile_id
+    path = prepare_chunk(upload, offset, length)
+
+    position = offset
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while position < offset + length:
+            chunk = stream.read(min(BUFFER_SIZE, offset + length - position))
+            if not chunk:
+                break
+            position = write_at(fd, chunk, position)
+    finally:
+        os.close(fd)
+
+    return record_chunk(upload_id, user_profile_id, offset, position)
+
+
+def prepare_chunk(upload, offset, length):
+    """
+    Checks that a chunk can be written to an upload and ends the transaction, so that no database connection
+    is held while the chunk is streamed
+    :param upload: AsyncOperation of the upload
+    :param offset: offset of the chunk in the file
+    :param length: length of the chunk
+    :return: absolute path of the temporary file to write the chunk to
+    :rtype: str
+    """
+    if upload.status_code != "pending":
+        raise UploadError("Upload is not pending", 409)
+    if offset < 0 or offset + length > upload.total:
+        raise UploadError("Chunk is outside of the upload", 416)
+
+    path = temp_path(upload)
+    db.session.commit()
+    return path
+
+
+def write_at(fd, chunk, position):
+    """
+    Writes all of a chunk to a file at the given position
+    :param fd: file descriptor opened for writing
+    :param chunk: bytes to write
+    :param position: offset in the file to write the chunk at
+    :return: the position after the chunk
+    :rtype: int
+    """
+    view = memoryview(chunk)
+    while view:
+        written = os.pwrite(fd, view, position)
+        position += written
+        view = view[written:]
+    return position
+
+
+def record_chunk(upload_id, user_profile_id, offset, position):
+    """
+    Records the range of a chunk that has been written to the temporary file
+    :param upload_id: id of the upload
+    :param user_profile_id: the user that owns the upload
+    :param offset: offset the chunk was written at
+    :param position: position in the file the chunk was written up to
+    :return: the updated AsyncOperation
+    :rtype: AsyncOperation
+    """
+    upload = get_upload(upload_id, user_profile_id, lock=True)
+    if position > offset:
+        details = json.loads(upload.details)
+        details["ranges"] = merge_ranges(details["ranges"] + [[offset, position]])
+        if content_store.dedup_enabled():
+            # a range may be sent again with other bytes, the digests of the blocks it wrote to are stale
+            blocks = details.setdefault("blocks", {})
+            for index in content_store.touched_blocks(offset, position):
+                blocks.pop(str(index), None)
+            # hash the blocks completed by this chunk while they are still in the page cache
+            hash_blocks(upload, details, temp_path(upload))
+        upload.details = json.dumps(details)
+        upload.completed = sum(stop - start for start, stop in details["ranges"])
+    db.session.commit()
+    return upload
+
+
+def hash_blocks(upload, details, path):
+    """
+    Hashes the blocks of an upload that have been received completely and not hashed yet
+    :param upload: AsyncOperation of the upload
+    :param details: the details of the upload, updated with the block digests
+    :param path: absolute path of the temporary file
+    """
+    blocks = details.setdefault("blocks", {})
+    missing = [index for index in content_store.completed_blocks(details["ranges"], upload.total)
+               if str(index) not in blocks]
+    if not missing:
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for index in missing:
+            blocks[str(index)] = content_store.hash_block(fd, index, upload.total)
+    finally:
+        os.close(fd)
+
+
+def finalize_upload(upload):
+    """
+    Moves a completely received upload to its target path
+    :param upload: AsyncOperation of the upload
+    :return: the updated AsyncOperation
+    :rtype: AsyncOperation
+    """
+    if upload.status_code == "ok":
+        return upload
+    if upload.completed != upload.total:
+        raise UploadError("Upload is incomplete", 409)
+
+    # checked again as a directory on the way may have been replaced by a symlink since the upload started
+    target = media_tree.resolve(upload.target)
+    if target is None:
+        raise UploadError("Uploads must target a path inside a drive")
+    path = temp_path(upload)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if content_store.dedup_enabled():
+        _store_upload(upload, path, target)
+    else:
+        _move_into_place(path, target)
+
+    upload.async_operation_status_id = AsyncOperation.status_id("ok")
+    db.session.commit()
+    _sync_parent(upload)
+    return upload
+
+
+def _move_into_place(path, target):
+    # link fails if the target has been created in the meantime, a rename would overwrite it
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        raise UploadError("File already exists", 409)
+    except OSError:
+        # drives formatted with FAT do not support hard links
+        if os.path.lexists(target):
+            raise UploadError("File already exists", 409)
+        os.rename(path, target)
+    else:
+        os.remove(path)
+
+
+def _store_upload(upload, path, target):
+    """
+    Moves an upload into the content store of its drive and links its target to the stored content
+    """
+    details = json.loads(upload.details)
+    # the stored content is shared with every later upload of the same hash, thus its hash is computed from
+    # the file as it is now rather than from the digests recorded while the chunks were received
+    details["blocks"] = {}
+    hash_blocks(upload, details, path)
+    block_count = -(-upload.total // content_store.block_size())
+    digest = content_store.content_hash(details["blocks"][str(index)] for index in range(block_count))
+    if details.get("content_hash") and details["content_hash"] != digest:
+        raise UploadError("Content hash mismatch", 422)
+    if os.path.lexists(target):
+        raise UploadError("File already exists", 409)
+
+    blob = content_store.store_file(upload.target.split("/")[0], path, digest, upload.total)
+    try:
+        linked = content_store.link_blob(blob, target)
+    except FileExistsError:
+        # the temporary file is gone, the upload can not be finalized anymore
+        upload.async_operation_status_id = AsyncOperation.status_id("error")
+        db.session.commit()
+        raise UploadError("File already exists", 409)
+    if not linked:
+        # the drive does not support hard links, thus there is nothing to deduplicate
+        os.rename(content_store.blob_path(blob.drive, blob.content_hash), target)
+        db.session.delete(blob)
+    else:
+        content_store.add_owner(blob, upload.user_profile_id)
+
+    details["content_hash"] = digest
+    upload.details = json.dumps(details)
+
+
+def _sync_parent(upload):
+    if not media_tree.watcher_alive():
+        media_tree.sync_dir(upload.target.rpartition("/")[0])
+
+
+def cancel_upload(upload):
+    """
+    Cancels an upload and removes its temporary file
+    :param upload: AsyncOperation of the upload
+    """
+    if upload.status_code == "pending":
+        try:
+            os.remove(temp_path(upload))
+        except FileNotFoundError:
+            pass
+        upload.async_operation_status_id = AsyncOperation.status_id("error")
+        db.session.commit()
+
+
+def expire_uploads(max_age):
+    """
+    Cancels the pending uploads that have not received a chunk for max_age seconds, and removes the temporary
+    files that are that old and belong to no pending upload, e.g. when cancelling an upload failed
+    :param max_age: seconds an upload may go without receiving a chunk
+    :return: number of uploads cancelled
+    :rtype: int
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    uploads = AsyncOperation.query.filter(
+        AsyncOperation.operation == UPLOAD_OPERATION,
+        AsyncOperation.async_operation_status_id == AsyncOperation.status_id("pending")).all()
+    expired = [upload for upload in uploads if upload.date_modified < cutoff]
+    for upload in expired:
+        cancel_upload(upload)
+    pending = set(json.loads(upload.details)["temp"] for upload in uploads if upload not in expired)
+
+    oldest = time.time() - max_age
+    try:
+        with os.scandir(media_tree.full_path("")) as drives:
+            uploads_dirs = [os.path.join(drive.path, UPLOADS_DIR_NAME) for drive in drives
+                            if drive.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        # nothing is mounted
+        uploads_dirs = []
+    for uploads_dir in uploads_dirs:
+        try:
+            entries = list(os.scandir(uploads_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.name not in pending and entry.stat(follow_symlinks=False).st_mtime < oldest:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return len(expired)
+
+
+@celery.task(ignore_result=True)
+def prune_uploads():
+    """
+    Run periodically by celery beat, see expire_uploads
+    """
+    try:
+        expire_uploads(current_app.config.get("MEDIA_UPLOAD_EXPIRY"))
+    finally:
+        # the worker keeps one application context for its lifetime, thus every task starts with a new session
+        if not prune_uploads.request.is_eager:
+            db.session.remove()
+
+
+def upload_to_json(upload):
+    """
+    :param upload: AsyncOperation of the upload
+    :return: the state of the upload
+    :rtype: dict
+    """
+    details = json.loads(upload.details)
+    return dict(id=upload.id, path=upload.target, size=upload.total, completed=upload.completed,
+                received=details["ranges"], status=upload.status_code,
+                deduplicated=details.get("deduplicated", False))
@@ -2,8 +2,18 @@
 This will handle media files that are in the media directory if the Pi
 """
 from . import media
-from getpass import getuser
-from flask import render_template, redirect, url_for, current_app
+from flask import render_template, redirect, url_for, current_app, request, jsonify, abort, make_response
+from flask_login import login_required, current_user
+from app import media_tree, metrics
+from .serving import send_media_file, not_modified, attachment_disposition
+from .archive import zip_directory
+from .derivatives import derivatives_available, has_derivatives, get_derivative
+from .uploads import UploadError, create_upload, get_upload, write_chunk, finalize_upload, cancel_upload, \
+    upload_to_json
+from app.media_tree import join_path, SORT_KEYS, SEARCH_MODES
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
+import json
 import os
 
 
@@ -14,25 +24,23 @@ def view_media(drive_name):
     :param drive_name: the drive to display
     :return: view template for files in the media file
     """
-    try:
-        context = {
-            "drive": os.listdir("/media/{}/{}".format(getuser(), drive_name)),
-            "drive_name": drive_name
-        }
-        return render_template("media.media.html", **context)
-    except FileNotFoundError:
-        context = {
-            "drive_name": drive_name
-        }
-        return render_template("media.media.html", **context)
-
-        # for root, dirs, files in os.walk("/media/{}/{}".format(getuser(), drive)):
-        #     level = root.replace(drive, '').count(os.sep)
-        #     indent = ' ' * 4 * (level)
-        #     print('{}{}/'.format(indent, os.path.basename(root)))
-        #     subindent = ' ' * 4 * (level + 1)
-        #     for f in files:
-        #         print('{}{}'.format(subindent, f))
+    # the listing is read from the media tree index, which is kept up to date by the media watcher
+    if media_tree.needs_refresh():
+        with metrics.time_walk("ensure_fresh"):
+            media_tree.refresh()
+    etag = media_tree.etag()
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    context = {
+        "drive": media_tree.children(drive_name),
+        "drive_name": drive_name
+    }
+    response = make_response(render_template("media.media.html", **context))
+    response.set_etag(etag)
+    return response
+
 
 
 @media.route("<drive_name>/<folder_or_file>")
@@ -43,17 +51,29 @@ def view_folder_in_drive(drive_name, folder_or_file):
     :param drive_name: the name of the connected drive
     :return: view of the folder or the file 
     """
-    root_path = "/media/{}/{}/{}".format(getuser(), drive_name, folder_or_file)
+    path = join_path(drive_name, folder_or_file)
+    if media_tree.needs_refresh():
+        with metrics.time_walk("ensure_fresh"):
+            media_tree.refresh()
 
     # perform a check to determine if the folder is a folder or a file
-    if os.path.isdir(root_path):
+    if media_tree.is_dir(path):
+        etag = media_tree.etag()
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         context = dict(
-            folders=os.listdir(root_path),
-            drive_name=drive_name
+            folders=media_tree.children(path),
+            drive_name=drive_name,
+            path=path
         )
-        return render_template("media.media_dir.html", **context)
+        response = make_response(render_template("media.media_dir.html", **context))
+        response.set_etag(etag)
+        return response
     # if not a folder then it is obviously a file :D
     # return redirect(url_for("media.view_file_in_drive", drive_name=drive_name, file=folder_or_file))
+    return render_template("media.media_file.html", file=folder_or_file)
 
 
 @media.route("<drive_name>/<file>")
@@ -63,3 +83,302 @@ def view_file_in_drive(drive_name, file):
     :return: 
     """
     return render_template("media.media_file.html", file=file)
+
+
+@media.route("api/listing/", defaults={"path": ""})
+@media.route("api/listing/<path:path>")
+def list_directory(path):
+    """
+    Lists a page of the entries of a directory as JSON, including their size and mtime. The size and
+    file_count of a directory are the totals of everything below it.
+    Query parameters:
+        sort: name, size or mtime, defaults to name
+        order: asc or desc, defaults to asc
+        limit: number of entries per page, at most MEDIA_LISTING_MAX_PAGE_SIZE
+        cursor: next_cursor returned with the previous page
+    Pages are read from the media tree index with keyset pagination, so the time taken to return a page
+    does not depend on the number of entries in the directory. The ETag of a page is that of the index, a
+    client sending it in If-None-Match gets a 304 while the directory is unchanged
+    :param path: path of the directory relative to the media path
+    :return: json response with the entries of the page and the cursor of the next page
+    """
+    path = media_tree.normalize(path)
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    max_page_size = current_app.config.get("MEDIA_LISTING_MAX_PAGE_SIZE")
+    try:
+        limit = min(int(request.args.get("limit", current_app.config.get("MEDIA_LISTING_PAGE_SIZE"))),
+                    max_page_size)
+    except ValueError:
+        limit = 0
+
+    if path is None or sort not in SORT_KEYS or order not in ("asc", "desc") or limit < 1:
+        return jsonify(message="Invalid listing request", success=False), 400
+
+    after = None
+    if request.args.get("cursor"):
+        after = decode_cursor(request.args["cursor"], sort, order)
+        if after is None:
+            return jsonify(message="Invalid cursor", success=False), 400
+
+    # only re-list the directory with os.scandir if it has changed since it was indexed, there is no need to
+    # check when the media watcher is keeping the index up to date
+    if not media_tree.watcher_alive():
+        with metrics.time_walk("sync_dir"):
+            media_tree.sync_dir(path)
+    if not media_tree.is_dir(path):
+        return jsonify(message="Directory not found", success=False), 404
+    etag = media_tree.etag()
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    entries = media_tree.list_page(path, sort=sort, descending=order == "desc", limit=limit + 1, after=after)
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1], sort, order)
+
+    response = jsonify(success=True, path=path, sort=sort, order=order, entries=entries, next_cursor=next_cursor)
+    response.set_etag(etag)
+    return response
+
+
+@media.route("api/search")
+def search_media():
+    """
+    Searches the names of the directories and files on all drives.
+    Query parameters:
+        q: the term to search for
+        mode: substring, prefix or glob, defaults to substring
+        path: only search below this directory
+        ext: comma separated extensions of the files to return
+        min_size, max_size: size range of the files and directories to return in bytes
+        modified_after, modified_before: modification time range as unix timestamps
+        type: file or dir to only return files or directories
+        limit: number of results per page, at most MEDIA_LISTING_MAX_PAGE_SIZE
+        cursor: next_cursor returned with the previous page
+    :return: json response with the results ordered by path and the cursor of the next page
+    """
+    args = request.args
+    mode = args.get("mode", "substring")
+    path = media_tree.normalize(args.get("path", ""))
+    extensions = [ext.strip().lstrip(".").lower() for ext in args.get("ext", "").split(",") if ext.strip()]
+    kind = args.get("type")
+    try:
+        limit = min(int(args.get("limit", current_app.config.get("MEDIA_LISTING_PAGE_SIZE"))),
+                    current_app.config.get("MEDIA_LISTING_MAX_PAGE_SIZE"))
+        min_size, max_size = [None if key not in args else int(args[key]) for key in ("min_size", "max_size")]
+        modified_after, modified_before = [None if key not in args else float(args[key])
+                                           for key in ("modified_after", "modified_before")]
+        after = urlsafe_b64decode(args["cursor"].encode()).decode() if args.get("cursor") else None
+    except (ValueError, binascii.Error):
+        return jsonify(message="Invalid search request", success=False), 400
+
+    if path is None or mode not in SEARCH_MODES or kind not in (None, "file", "dir") or limit < 1:
+        return jsonify(message="Invalid search request", success=False), 400
+
+    with metrics.time_walk("ensure_fresh"):
+        media_tree.ensure_fresh()
+    results = media_tree.search(args.get("q", ""), mode=mode, path=path, extensions=extensions,
+                                min_size=min_size, max_size=max_size, modified_after=modified_after,
+                                modified_before=modified_before, is_dir=None if kind is None else kind == "dir",
+                                limit=limit + 1, after=after)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = urlsafe_b64encode(results[-1]["path"].encode()).decode()
+
+    return jsonify(success=True, query=args.get("q", ""), mode=mode, results=results, next_cursor=next_cursor)
+
+
+@media.route("download/<path:path>")
+@login_required
+def download_file(path):
+    """
+    Downloads a file from a drive. Supports single and multiple byte ranges (resumable downloads, video
+    seeking), If-Range and conditional requests with ETag/Last-Modified, the file is sent with sendfile
+    when the server supports it
+    :param path: path of the file relative to the media path
+    :return: the file, or the requested ranges of it
+    """
+    response = send_media_file(resolve_media_path(path))
+    if response is None:
+        abort(404)
+    return response
+
+
+@media.route("archive/<path:path>")
+@login_required
+def download_archive(path):
+    """
+    Downloads a folder as a ZIP archive that is streamed while the folder is walked, the size of the
+    archive is not known up front, thus it is sent without a Content-Length
+    :param path: path of the folder relative to the media path
+    :return: the ZIP archive of the folder
+    """
+    full_path = resolve_media_path(path)
+    if not os.path.isdir(full_path):
+        abort(404)
+
+    archive = zip_directory(full_path, current_app.config.get("MEDIA_ZIP_STORED_EXTENSIONS"))
+    response = current_app.response_class(archive, mimetype="application/zip")
+    response.headers["Content-Disposition"] = attachment_disposition(os.path.basename(full_path) + ".zip")
+    return response
+
+
+@media.route("derivatives/<variant>/<path:path>")
+@login_required
+def get_image_derivative(path, variant):
+    """
+    Serves a thumbnail or preview of an image. A derivative that is not cached yet is built by a celery
+    task, in the meantime 202 is returned and the client should try again after Retry-After seconds
+    :param path: path of the image relative to the media path
+    :param variant: the derivative to serve, one of MEDIA_DERIVATIVE_SIZES
+    :return: the derivative, with support for conditional requests
+    """
+    full_path = resolve_media_path(path)
+    if variant not in current_app.config.get("MEDIA_DERIVATIVE_SIZES") or not has_derivatives(path) or \
+            not os.path.isfile(full_path):
+        abort(404)
+    if not derivatives_available():
+        return jsonify(message="Previews are not available", success=False), 501
+
+    status, derivative = get_derivative(full_path, variant, current_user.user_profile_id)
+    if status == "pending":
+        return jsonify(message="Preview is being built", success=True), 202, {"Retry-After": "1"}
+    if status == "failed":
+        return jsonify(message="No preview available for this file", success=False), 415
+    response = send_media_file(derivative)
+    if response is None:
+        # evicted right after it was looked up
+        abort(404)
+    return response
+
+
+@media.app_template_filter()
+def has_preview(name):
+    """
+    :param name: name of a file
+    :return: True if thumbnails of the file can be shown
+    :rtype: bool
+    """
+    return derivatives_available() and has_derivatives(name)
+
+
+@media.errorhandler(UploadError)
+def upload_error(error):
+    return jsonify(message=error.message, success=False), error.status_code
+
+
+@media.route("uploads", methods=["POST"])
+@login_required
+def start_upload():
+    """
+    Starts a resumable upload. Expects a JSON body with the path to upload to, relative to the media path,
+    and the size of the file in bytes. When deduplication is enabled the body may also contain the
+    content_hash of the file, if that content is already stored the upload completes right away
+    :return: json response with the id and state of the upload
+    """
+    data = request.get_json(silent=True) or {}
+    upload = create_upload(data.get("path"), data.get("size"), current_user.user_profile_id,
+                           content_hash=data.get("content_hash"))
+    return jsonify(success=True, **upload_to_json(upload)), 201
+
+
+@media.route("uploads/<int:upload_id>", methods=["GET"])
+@login_required
+def upload_progress(upload_id):
+    """
+    Returns the state of an upload, including the byte ranges that have been received so that an
+    interrupted upload can be resumed
+    :param upload_id: id of the upload
+    """
+    upload = get_upload(upload_id, current_user.user_profile_id)
+    return jsonify(success=True, **upload_to_json(upload))
+
+
+@media.route("uploads/<int:upload_id>", methods=["PUT"])
+@login_required
+def upload_chunk(upload_id):
+    """
+    Uploads a chunk of the file, the body of the request is written to the file at the offset given
+    in the offset query parameter. Chunks can be sent in any order and concurrently
+    :param upload_id: id of the upload
+    """
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        raise UploadError("Missing offset")
+    if request.content_length is None:
+        raise UploadError("Missing Content-Length", 411)
+
+    upload = get_upload(upload_id, current_user.user_profile_id)
+    upload = write_chunk(upload, offset, request.content_length, request.stream)
+    return jsonify(success=True, **upload_to_json(upload))
+
+
+@media.route("uploads/<int:upload_id>/finalize", methods=["POST"])
+@login_required
+def finish_upload(upload_id):
+    """
+    Finalizes an upload once all of it has been received, the file is moved to its target path
+    :param upload_id: id of the upload
+    """
+    upload = finalize_upload(get_upload(upload_id, current_user.user_profile_id, lock=True))
+    return jsonify(success=True, **upload_to_json(upload))
+
+
+@media.route("uploads/<int:upload_id>", methods=["DELETE"])
+@login_required
+def abort_upload(upload_id):
+    """
+    Cancels an upload and discards whatever has been received
+    :param upload_id: id of the upload
+    """
+    upload = get_upload(upload_id, current_user.user_profile_id)
+    cancel_upload(upload)
+    return jsonify(success=True, **upload_to_json(upload))
+
+
+def resolve_media_path(path):
+    """
+    Resolves a path received from a client to a path on the drives, aborts with 404 if the path escapes
+    the media path, either with .. or by following symlinks, see MediaTree.resolve
+    :param path: path relative to the media path
+    :return: absolute path on the filesystem
+    :rtype: str
+    """
+    full_path = media_tree.resolve(path)
+    if full_path is None:
+        abort(404)
+    return full_path
+
+
+def encode_cursor(entry, sort, order):
+    """
+    Creates an opaque cursor pointing after the given entry
+    :param entry: last entry of a page
+    :param sort: sort key of the listing
+    :param order: sort order of the listing
+    :rtype: str
+    """
+    cursor = json.dumps([sort, order, entry[SORT_KEYS[sort]], entry["name"]])
+    return urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor, sort, order):
+    """
+    Decodes a cursor created by encode_cursor
+    :param cursor: the cursor received from the client
+    :param sort: sort key of the current request, must match the one of the cursor
+    :param order: sort order of the current request, must match the one of the cursor
+    :return: (sort value, name) tuple, None if the cursor is invalid
+    :rtype: tuple
+    """
+    try:
+        cursor_sort, cursor_order, value, name = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if cursor_sort != sort or cursor_order != order:
+        return None
+    return value, name
@@ -0,0 +1,145 @@
+"""
+Hashes and verifies passwords in a pool of worker processes.
+PBKDF2 takes hundreds of milliseconds on a Raspberry Pi and holds the GIL while it runs, thus hashing on the
+request thread stalls every other request served by the same process. The request thread only waits for the
+pool, which releases the GIL, and at most PASSWORD_HASH_QUEUE_SIZE passwords are hashed or waiting at once.
+Requests over that limit wait up to PASSWORD_HASH_TIMEOUT seconds for a slot and then fail with
+PasswordHasherBusy, instead of queueing without bound while the CPU is already saturated.
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when the pool is saturated and no slot freed up in time
+    """
+
+
+class PasswordHasher(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app. Without an application, passwords are hashed inline with werkzeug's defaults
+    :cvar method: werkzeug hash method including its cost, e.g. pbkdf2:sha256:150000
+    :cvar salt_length: length of the salt of new hashes
+    :cvar workers: number of worker processes, 0 hashes on the calling thread
+    :cvar queue_size: maximum number of passwords hashed or waiting in the pool
+    :cvar timeout: seconds to wait for a slot in the pool and for the result
+    """
+
+    def __init__(self, app=None):
+        self.method = "pbkdf2:sha256"
+        self.salt_length = 8
+        self.workers = 0
+        self.queue_size = 1
+        self.timeout = None
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the hasher with the application configuration
+        :param app: current flask application
+        """
+        self.method = app.config.get("PASSWORD_HASH_METHOD")
+        self.salt_length = app.config.get("PASSWORD_SALT_LENGTH")
+        self.workers = app.config.get("PASSWORD_HASH_WORKERS")
+        self.queue_size = app.config.get("PASSWORD_HASH_QUEUE_SIZE")
+        self.timeout = app.config.get("PASSWORD_HASH_TIMEOUT")
+        self.shutdown()
+        app.extensions["password_hasher"] = self
+
+    def hash(self, password):
+        """
+        :param password: the password to hash
+        :return: the hash of the password with the configured method and salt length
+        :rtype: str
+        """
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def hash_many(self, passwords):
+        """
+        Hashes a batch of passwords on all the workers at once, for bulk imports. The queue limit does not
+        apply, the batch is split in chunks so that every worker is kept busy
+        :param passwords: the passwords to hash
+        :return: the hashes of the passwords, in the same order
+        :rtype: list
+        """
+        passwords = list(passwords)
+        if not self.workers:
+            return [self.hash(password) for password in passwords]
+
+        pool, _ = self._get_pool()
+        count = len(passwords)
+        try:
+            return list(pool.map(generate_password_hash, passwords, [self.method] * count,
+                                 [self.salt_length] * count, chunksize=max(1, count // (self.workers * 4))))
+        except BrokenProcessPool:
+            self.shutdown()
+            raise
+
+    def verify(self, password_hash, password):
+        """
+        :param password_hash: a hash created by hash
+        :param password: the password to check
+        :return: True if the password matches the hash
+        :rtype: bool
+        """
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Hashes created with other cost parameters than the configured ones are rehashed when the user logs
+        in, which is the only time the password is known
+        :param password_hash: hash stored for a user
+        :return: True if the hash was created with another method, cost or salt length
+        :rtype: bool
+        """
+        method, _, rest = password_hash.partition("$")
+        salt = rest.partition("$")[0]
+        return method != self.method or len(salt) != self.salt_length
+
+    def shutdown(self):
+        """
+        Stops the worker processes, they are started again on the next use
+        """
+        with self._lock:
+            pool, self._pool, self._slots = self._pool, None, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+
+        pool, slots = self._get_pool()
+        if not slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy("Too many passwords are being hashed")
+        try:
+            future = pool.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy("Timed out waiting for the password hash")
+        except BrokenProcessPool:
+            # a worker died, e.g. killed by the OOM killer, start a new pool on the next call
+            self.shutdown()
+            raise
+
+    def _get_pool(self):
+        # started on first use so that each forked web worker gets its own pool
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._slots = threading.BoundedSemaphore(self.queue_size)
+            return self._pool, self._slots
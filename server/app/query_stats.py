@@ -0,0 +1,128 @@
+"""
+Counts and times the SQL statements of every request.
+The totals of a request are sent in its Server-Timing header, which shows up in the network panel of the
+browser, and logged at debug level. Statements are grouped by their text, which has placeholders instead of
+the parameters, so that the same query issued over and over, e.g. by lazy loading in a loop, stands out.
+Tests record the statements of the requests they make with record, see BaseTestCase.assertQueryBudget.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryLog(object):
+    """
+    Statements executed while a request or a recording was active
+    :cvar count: number of statements
+    :cvar duration: total time spent in the database in seconds
+    :cvar statements: number of times each statement was executed
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[" ".join(statement.split())] += 1
+
+    def most_repeated(self):
+        """
+        :return: the statement executed most often and how many times it was executed, None if there was none
+        :rtype: tuple
+        """
+        repeated = self.statements.most_common(1)
+        return repeated[0] if repeated else None
+
+
+class QueryStats(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app. The statements of all the engines of the process are counted, thus the primary and the
+    replica alike
+    :cvar enabled: whether the statements of requests are counted, set with SQL_STATS_ENABLED
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._recordings = []
+        self._lock = threading.Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Starts counting the statements of the requests of the application
+        :param app: current flask application
+        """
+        self.enabled = bool(app.config.get("SQL_STATS_ENABLED"))
+        self._listen()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.extensions["query_stats"] = self
+
+    @contextmanager
+    def record(self):
+        """
+        Records every statement executed in this process until the block exits, whether in a request or not
+        :return: the log the statements are recorded in
+        :rtype: QueryLog
+        """
+        log = QueryLog()
+        with self._lock:
+            self._recordings.append(log)
+        try:
+            yield log
+        finally:
+            with self._lock:
+                self._recordings.remove(log)
+
+    def _listen(self):
+        with self._lock:
+            if self._listening:
+                return
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            self._listening = True
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start_time"].pop()
+        log = g.get("query_log") if has_request_context() else None
+        if log is not None:
+            log.add(statement, duration)
+        for recording in tuple(self._recordings):
+            recording.add(statement, duration)
+
+    def _start_request(self):
+        if self.enabled:
+            g.query_log = QueryLog()
+
+    def _finish_request(self, response):
+        log = g.get("query_log")
+        if log is None:
+            return response
+
+        timing = 'db;dur={:.1f};desc="{} queries"'.format(log.duration * 1000, log.count)
+        if response.headers.get("Server-Timing"):
+            timing = "{}, {}".format(response.headers["Server-Timing"], timing)
+        response.headers["Server-Timing"] = timing
+
+        if not current_app.logger.isEnabledFor(logging.DEBUG):
+            return response
+        repeated = log.most_repeated()
+        current_app.logger.debug("{} {}: {} queries in {:.1f}ms, most repeated {} times: {}".format(
+            request.method, request.path, log.count, log.duration * 1000,
+            repeated[1] if repeated else 0, repeated[0] if repeated else None))
+        return response
@@ -0,0 +1,81 @@
+"""
+Sliding window rate limiter backed by redis, shared by all the processes of the application.
+Each limited key is a sorted set of the timestamps of its requests, requests that fell out of the window are
+dropped on every hit, thus the count is exact over the last window seconds instead of jumping at the edge
+of fixed windows. Requests over the limit are not recorded, otherwise someone hammering the key of an
+account would keep its owner locked out for as long as they keep going.
+The limiter fails open: if redis can not be reached requests are let through and redis is not tried again
+for REDIS_RETRY_INTERVAL seconds, so an outage does not add a timeout to every request.
+"""
+import math
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+KEY_PREFIX = "picloud:ratelimit:"
+
+# seconds during which redis is not used after it failed
+REDIS_RETRY_INTERVAL = 30
+
+
+class RateLimiter(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app
+    :cvar enabled: whether requests are limited, set with RATE_LIMIT_ENABLED
+    """
+
+    def __init__(self, redis_store=None, app=None):
+        self.redis_store = redis_store
+        self.enabled = False
+        self._down_until = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the limiter with the application configuration
+        :param app: current flask application
+        """
+        self.enabled = bool(app.config.get("RATE_LIMIT_ENABLED"))
+        self._down_until = 0
+        app.extensions["rate_limiter"] = self
+
+    def hit(self, key, limit, window):
+        """
+        Records a request for a key and checks it against the limit
+        :param key: what is limited, e.g. auth:ip:127.0.0.1
+        :param limit: number of requests allowed in the window
+        :param window: length of the window in seconds
+        :return: seconds after which the client may try again, 0 if the request is allowed
+        :rtype: int
+        """
+        now = time.time()
+        if not self.enabled or now < self._down_until:
+            return 0
+
+        redis_key = KEY_PREFIX + key
+        member = "{!r}:{}".format(now, uuid.uuid4().hex[:8])
+        try:
+            pipeline = self.redis_store.pipeline()
+            pipeline.zremrangebyscore(redis_key, 0, now - window)
+            # ZADD changed its signature between redis-py versions
+            pipeline.execute_command("ZADD", redis_key, now, member)
+            pipeline.zcard(redis_key)
+            pipeline.expire(redis_key, int(math.ceil(window)))
+            count = pipeline.execute()[2]
+            if count <= limit:
+                return 0
+            # the rejected request does not count
+            pipeline = self.redis_store.pipeline()
+            pipeline.zrem(redis_key, member)
+            pipeline.zrange(redis_key, 0, 0, withscores=True)
+            oldest = pipeline.execute()[1]
+        except RedisError:
+            self._down_until = now + REDIS_RETRY_INTERVAL
+            return 0
+
+        if not oldest:
+            return int(math.ceil(window))
+        return max(1, int(math.ceil(oldest[0][1] + window - now)))
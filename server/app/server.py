@@ -0,0 +1,108 @@
+"""
+Runs the application under gunicorn, started with manage.py serve.
+The application is created once in the master process and the workers are forked from it, so they share its
+memory and start right away. Each worker runs THREADS_PER_PAGE threads, thus a request waiting on the disk or
+the database does not hold up the others. Workers are recycled after SERVER_MAX_REQUESTS requests, bounding
+the memory a leak can take, and kill -HUP on the master replaces them gracefully.
+"""
+import multiprocessing
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+
+def default_workers(cpu_count=None):
+    """
+    :param cpu_count: number of processors, detected if None
+    :return: number of worker processes, one per processor plus one so that a processor is always busy
+    :rtype: int
+    """
+    if cpu_count is None:
+        try:
+            cpu_count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpu_count = 1
+    return cpu_count + 1
+
+
+def server_options(app, bind=None, workers=None, threads=None):
+    """
+    Gunicorn settings from the application configuration, workers and threads that are not set are derived
+    from the number of processors and THREADS_PER_PAGE
+    :param app: current flask application
+    :param bind: address to listen on, overrides SERVER_BIND
+    :param workers: number of worker processes, overrides SERVER_WORKERS
+    :param threads: number of threads per worker, overrides SERVER_THREADS
+    :return: gunicorn settings
+    :rtype: dict
+    """
+    config = app.config
+    threads = threads or config.get("SERVER_THREADS") or config.get("THREADS_PER_PAGE") or 1
+    return dict(
+        bind=bind or config.get("SERVER_BIND"),
+        workers=workers or config.get("SERVER_WORKERS") or default_workers(),
+        threads=threads,
+        worker_class="gthread" if threads > 1 else "sync",
+        preload_app=True,
+        timeout=config.get("SERVER_TIMEOUT"),
+        graceful_timeout=config.get("SERVER_GRACEFUL_TIMEOUT"),
+        max_requests=config.get("SERVER_MAX_REQUESTS"),
+        max_requests_jitter=config.get("SERVER_MAX_REQUESTS_JITTER"),
+    )
+
+
+class PiCloudServer(BaseApplication):
+    """
+    Gunicorn application serving an already created flask application
+    """
+
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super(PiCloudServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None and key in self.cfg.settings:
+                self.cfg.set(key, value)
+        # plain functions, gunicorn 19 counts the arguments of a hook and would count self for a method
+        self.cfg.set("on_starting", on_starting)
+        self.cfg.set("post_fork", post_fork)
+        self.cfg.set("child_exit", child_exit)
+
+    def load(self):
+        # loaded before the workers are forked when preloading, so that they share the modules
+        self.application.load_blueprints()
+        return self.application
+
+
+def on_starting(server):
+    """
+    Keeps the metrics of the workers in files so that /metrics reports the totals of all of them, the files
+    of a previous run are removed
+    :param server: the gunicorn arbiter, its app is the PiCloudServer
+    """
+    from app import metrics
+    config = server.app.application.config
+    config["METRICS_DIR"] = config.get("METRICS_DIR") or tempfile.mkdtemp(prefix="picloud-metrics-")
+    metrics.use_directory(config["METRICS_DIR"])
+    metrics.clear_directory()
+
+
+def child_exit(server, worker):
+    from app import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """
+    Drops the database connections inherited from the master, a connection must not be shared between
+    processes. The other clients connect lazily or detect the fork themselves
+    :param server: the gunicorn arbiter, its app is the PiCloudServer
+    :param worker: the forked worker
+    """
+    from app import db
+    application = server.app.application
+    with application.app_context():
+        for bind in [None] + list(application.config.get("SQLALCHEMY_BINDS") or ()):
+            db.get_engine(application, bind=bind).dispose()
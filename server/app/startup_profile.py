@@ -0,0 +1,85 @@
+"""
+Measures how long the application takes to start, reported by manage.py startup_profile.
+A fresh interpreter runs the phases of a start up: importing the app package, create_app, and loading the
+blueprints, which the first request or the fork of the gunicorn workers pays for. It runs with -X importtime,
+which reports the time spent importing each module (Python 3.7 and later, older interpreters only report the
+phases).
+"""
+import json
+import subprocess
+import sys
+
+PHASES_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(sys.argv[1])
+created = time.perf_counter()
+app.load_blueprints()
+loaded = time.perf_counter()
+print(json.dumps(dict(import_app=imported - start, create_app=created - imported, load_blueprints=loaded - created)))
+"""
+
+
+def parse_importtime(output):
+    """
+    Parses the report of -X importtime, e.g.
+        import time: self [us] | cumulative | imported package
+        import time:       303 |      60149 |   flask_wtf
+    :param output: standard error of the interpreter
+    :return: list of (module, self microseconds, cumulative microseconds, depth) tuples in import order, the
+     depth is 0 for the modules imported by the profiled code itself
+    :rtype: list
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return imports
+
+
+def profile_startup(config_name, cwd=None):
+    """
+    Starts the application in a fresh interpreter
+    :param config_name: the configuration to create the application with
+    :param cwd: directory to start the interpreter in, the one containing the app package
+    :return: dict with the seconds taken by each phase and the parsed import times
+    :rtype: dict
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", PHASES_SCRIPT, config_name],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError("The application failed to start:\n{}".format(process.stderr[-2000:]))
+    phases = json.loads(process.stdout.strip().splitlines()[-1])
+    return dict(phases=phases, total=sum(phases.values()), imports=parse_importtime(process.stderr))
+
+
+def format_report(profile, limit=20):
+    """
+    :param profile: the result of profile_startup
+    :param limit: number of packages to list
+    :return: lines of the report, the phases followed by the packages that took longest to import, summing
+     the self time of their modules
+    :rtype: list
+    """
+    lines = ["{:<20} {:>8.1f} ms".format(phase, seconds * 1000) for phase, seconds in sorted(
+        profile["phases"].items(), key=lambda item: -item[1])]
+    lines.append("{:<20} {:>8.1f} ms".format("total", profile["total"] * 1000))
+
+    packages = {}
+    for name, self_time, _, _ in profile["imports"]:
+        modules, total = packages.get(name.split(".")[0], (0, 0))
+        packages[name.split(".")[0]] = (modules + 1, total + self_time)
+    if packages:
+        lines.append("")
+        lines.append("{:<30} {:>8} {:>10}".format("package", "modules", "ms"))
+        for package, (modules, total) in sorted(packages.items(), key=lambda item: -item[1][1])[:limit]:
+            lines.append("{:<30} {:>8} {:>10.1f}".format(package, modules, total / 1000))
+    return lines
@@ -0,0 +1,336 @@
+"""
+Serves file downloads and upload chunks from an asyncio event loop, started with manage.py transfer next to the
+gunicorn workers of manage.py serve. The front end server routes the GET and HEAD requests of media.download_file
+and the PUT requests of media.upload_chunk to it.
+A synchronous worker sending a video to a phone on a slow connection is held until the last byte has been sent.
+Here each transfer is a coroutine that waits on its socket: downloads are sent with the kernel's sendfile and
+upload chunks are written to the drive as they are received, thus a slow client costs a socket and a buffer of
+TRANSFER_BUFFER_SIZE bytes. The session cookie is checked, and the download response is prepared, by the
+application itself in a few threads that never wait on a client.
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote_to_bytes
+
+from flask import jsonify, request
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import FileWrapper
+
+from app.mod_media.uploads import UploadError, get_upload, prepare_chunk, record_chunk, write_at, upload_to_json
+
+SERVER_SOFTWARE = "picloud-transfer"
+# files are sent in slices, a client has TRANSFER_IDLE_TIMEOUT seconds to take each slice
+SENDFILE_SLICE = 256 * 1024
+
+
+def parse_request_head(head, peer, sockname):
+    """
+    Creates the WSGI environ of a request from its request line and headers
+    :param head: bytes of the request up to the blank line ending the headers
+    :param peer: address of the client
+    :param sockname: address the connection was accepted on
+    :return: the WSGI environ, its input is empty as bodies are read by the server
+    :rtype: dict
+    :raises ValueError: if the request is malformed
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, version = lines[0].split(" ")
+    if not version.startswith("HTTP/1."):
+        raise ValueError("Unsupported protocol {}".format(version))
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_PROTOCOL": version,
+        "SERVER_NAME": str(sockname[0]),
+        "SERVER_PORT": str(sockname[1]),
+        "SERVER_SOFTWARE": SERVER_SOFTWARE,
+        "REMOTE_ADDR": str(peer[0]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": FileWrapper,
+    }
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(":")
+        if not name or not _:
+            raise ValueError("Malformed header {}".format(line))
+        key = name.strip().upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.strip()
+        environ[key] = "{},{}".format(environ[key], value) if key in environ else value
+    return environ
+
+
+def wants_keep_alive(environ):
+    """
+    :param environ: WSGI environ of the request
+    :return: True if the client will send another request on the connection
+    :rtype: bool
+    """
+    connection = environ.get("HTTP_CONNECTION", "").lower()
+    if environ["SERVER_PROTOCOL"] == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+class TransferServer(object):
+    """
+    Serves the transfers of media files of an application
+    :cvar download_endpoints: views sent from the event loop, their body is sent with sendfile if it is a file
+    :cvar upload_endpoint: view receiving upload chunks, the chunk is received by the server instead
+    """
+    download_endpoints = ("media.download_file",)
+    upload_endpoint = "media.upload_chunk"
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        # the requests are matched against the url map before they are handed to the application
+        app.load_blueprints()
+        self.buffer_size = app.config.get("TRANSFER_BUFFER_SIZE")
+        self.idle_timeout = app.config.get("TRANSFER_IDLE_TIMEOUT")
+        self.executor = ThreadPoolExecutor(threads or app.config.get("TRANSFER_SERVER_THREADS"))
+
+    def start(self, host, port):
+        """
+        :return: coroutine starting the server, it returns the asyncio server
+        """
+        # the limit bounds the request head and the bytes buffered for each connection
+        return asyncio.start_server(self.handle, host, port, limit=self.buffer_size)
+
+    def run(self, bind=None):
+        """
+        Serves until interrupted
+        :param bind: address to listen on, overrides TRANSFER_SERVER_BIND
+        """
+        host, _, port = (bind or self.app.config.get("TRANSFER_SERVER_BIND")).rpartition(":")
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(self.start(host or None, int(port)))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
+
+    def in_thread(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def handle(self, reader, writer):
+        """
+        Serves the requests of a connection until the client or a response closes it
+        """
+        peer = writer.get_extra_info("peername") or ("", 0)
+        sockname = writer.get_extra_info("sockname") or ("", 0)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, "431 Request Header Fields Too Large")
+                    return
+                try:
+                    environ = parse_request_head(head[:-4], peer, sockname)
+                except ValueError:
+                    await self.send_error(writer, "400 Bad Request")
+                    return
+                keep_alive = await self.serve(environ, reader, writer)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, environ, reader, writer):
+        """
+        Serves a request
+        :return: True if the connection can be kept open for another request
+        :rtype: bool
+        """
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(
+                environ, server_name=self.app.config.get("SERVER_NAME")).match()
+        except HTTPException:
+            endpoint, view_args = None, {}
+
+        if endpoint in self.download_endpoints:
+            return await self.send_download(environ, writer)
+        if endpoint == self.upload_endpoint:
+            return await self.receive_chunk(environ, view_args["upload_id"], reader, writer)
+        # the request was not meant for the transfer server, its body is not read
+        await self.send_error(writer, "404 Not Found")
+        return False
+
+    def call_application(self, environ):
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        body = self.app(environ, start_response)
+        return body, response[0], response[1]
+
+    async def send_download(self, environ, writer):
+        """
+        Sends the response of a download view, its file is sent with sendfile
+        """
+        body, status, headers = await self.in_thread(self.call_application, environ)
+        try:
+            length = _content_length(headers)
+            keep_alive = wants_keep_alive(environ) and (length is not None or environ["REQUEST_METHOD"] == "HEAD" or
+                                                        status[:3] in ("204", "304"))
+            await self.send_head(writer, status, headers, keep_alive)
+            if isinstance(body, FileWrapper):
+                await self.send_file(writer, body.file, length)
+            else:
+                for chunk in body:
+                    writer.write(chunk)
+                    await asyncio.wait_for(writer.drain(), self.idle_timeout)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        return keep_alive
+
+    async def send_file(self, writer, f, count):
+        """
+        Sends count bytes of a file from its current position, with sendfile where the event loop supports it
+        """
+        loop = asyncio.get_event_loop()
+        offset = f.tell()
+        while count > 0:
+            size = min(SENDFILE_SLICE, count)
+            if hasattr(loop, "sendfile"):
+                sent = await asyncio.wait_for(loop.sendfile(writer.transport, f, offset, size), self.idle_timeout)
+            else:
+                chunk = os.pread(f.fileno(), min(self.buffer_size, size), offset)
+                writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), self.idle_timeout)
+                sent = len(chunk)
+            if not sent:
+                # the file has been truncated, the client notices the missing bytes
+                raise ConnectionAbortedError("{} bytes of the file are missing".format(count))
+            offset += sent
+            count -= sent
+
+    async def receive_chunk(self, environ, upload_id, reader, writer):
+        """
+        Receives a chunk of an upload into its temporary file, see app.mod_media.views.upload_chunk. Whatever is
+        received before the client drops the connection or goes idle is recorded
+        """
+        response, chunk = await self.in_thread(self.prepare_upload, environ, upload_id)
+        if chunk is None:
+            await self.send_response(writer, response, False)
+            return False
+
+        user_profile_id, path, offset, length = chunk
+        if environ.get("HTTP_EXPECT", "").lower() == "100-continue":
+            writer.write("{} 100 Continue\r\n\r\n".format(environ["SERVER_PROTOCOL"]).encode())
+        position = offset
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            while position < offset + length:
+                try:
+                    data = await asyncio.wait_for(reader.read(min(self.buffer_size, offset + length - position)),
+                                                  self.idle_timeout)
+                except (ConnectionError, asyncio.TimeoutError):
+                    break
+                if not data:
+                    break
+                position = write_at(fd, data, position)
+        finally:
+            os.close(fd)
+
+        response = await self.in_thread(self.record_upload, environ, upload_id, user_profile_id, offset, position)
+        keep_alive = wants_keep_alive(environ) and position == offset + length
+        await self.send_response(writer, response, keep_alive)
+        return keep_alive
+
+    def prepare_upload(self, environ, upload_id):
+        """
+        Authenticates a chunk upload with the session cookie and checks it, as the upload_chunk view does
+        :return: (response, None) if the chunk must not be received, (None, (user_profile_id, temporary file,
+         offset, length)) otherwise
+        :rtype: tuple
+        """
+        with self.app.request_context(environ):
+            if not current_user.is_authenticated:
+                return self.finish_response(self.app.login_manager.unauthorized(), environ), None
+            user_profile_id = current_user.user_profile_id
+            offset = request.args.get("offset", type=int)
+            try:
+                if offset is None:
+                    raise UploadError("Missing offset")
+                if request.content_length is None:
+                    raise UploadError("Missing Content-Length", 411)
+                path = prepare_chunk(get_upload(upload_id, user_profile_id), offset, request.content_length)
+            except UploadError as error:
+                return self.finish_response((jsonify(message=error.message, success=False), error.status_code),
+                                            environ), None
+            return None, (user_profile_id, path, offset, request.content_length)
+
+    def record_upload(self, environ, upload_id, user_profile_id, offset, position):
+        """
+        Records the part of a chunk that has been received
+        :return: the response to the chunk upload
+        :rtype: tuple
+        """
+        with self.app.request_context(environ):
+            try:
+                upload = record_chunk(upload_id, user_profile_id, offset, position)
+            except UploadError as error:
+                return self.finish_response((jsonify(message=error.message, success=False), error.status_code),
+                                            environ)
+            return self.finish_response(jsonify(success=True, **upload_to_json(upload)), environ)
+
+    def finish_response(self, rv, environ):
+        """
+        Runs the after request functions of the application on a view's return value, must be called in the
+        request context
+        :return: (status, headers, body) of the response
+        :rtype: tuple
+        """
+        response = self.app.process_response(self.app.make_response(rv))
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        return status, headers, b"".join(app_iter)
+
+    async def send_head(self, writer, status, headers, keep_alive):
+        lines = ["HTTP/1.1 {}".format(status)] + ["{}: {}".format(name, value) for name, value in headers]
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write("{}\r\n\r\n".format("\r\n".join(lines)).encode("latin-1"))
+        await asyncio.wait_for(writer.drain(), self.idle_timeout)
+
+    async def send_response(self, writer, response, keep_alive):
+        status, headers, body = response
+        await self.send_head(writer, status, headers, keep_alive)
+        writer.write(body)
+        await asyncio.wait_for(writer.drain(), self.idle_timeout)
+
+    async def send_error(self, writer, status):
+        body = status.encode()
+        await self.send_response(writer, (status, [("Content-Type", "text/plain; charset=utf-8"),
+                                                   ("Content-Length", str(len(body)))], body), False)
+
+
+def _content_length(headers):
+    for name, value in headers:
+        if name.lower() == "content-length":
+            return int(value)
+    return None
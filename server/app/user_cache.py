@@ -0,0 +1,155 @@
+"""
+Two level cache of the user accounts loaded by flask_login on every authenticated request.
+The first level is a small LRU in each process, the second is shared by all processes through redis. Entries
+are the column values of the account, not ORM instances, so they can be shared between processes and merged
+into the session of any request without a query.
+An account is invalidated in both levels when its row is updated or deleted through the ORM. Invalidating
+bumps the version of the account, the version is read before the account is loaded from the database and
+cached with it, and a redis entry is only used while its version is current. Thus a request that loaded the
+old row before the change was committed can not cache it for the whole USER_CACHE_REDIS_TTL afterwards. The
+LRU of other processes can not be reached, thus USER_CACHE_TTL bounds for how long they may serve a changed
+account, e.g. after a password change or a deactivation, it is kept to a few seconds.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+KEY_PREFIX = "picloud:user:"
+VERSION_PREFIX = "picloud:user-version:"
+
+
+class UserCache(object):
+    """
+    Follows the flask extension pattern, thus a global instance is created in app/__init__.py and configured
+    with init_app
+    :cvar max_size: maximum number of accounts kept in the LRU of this process
+    :cvar ttl: seconds an account is kept in the LRU of this process
+    :cvar redis_ttl: seconds an account is kept in redis, redis is not used if this is falsy
+    """
+
+    def __init__(self, redis_store=None, app=None):
+        self.redis_store = redis_store
+        self.max_size = 0
+        self.ttl = 0
+        self.redis_ttl = 0
+        self._entries = OrderedDict()
+        # bumped whenever an account is invalidated in this process
+        self._generation = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the cache with the application configuration and empties it
+        :param app: current flask application
+        """
+        self.max_size = app.config.get("USER_CACHE_SIZE")
+        self.ttl = app.config.get("USER_CACHE_TTL")
+        self.redis_ttl = app.config.get("USER_CACHE_REDIS_TTL") if app.config.get("USER_CACHE_REDIS_ENABLED") else 0
+        with self._lock:
+            self._entries.clear()
+        app.extensions["user_cache"] = self
+
+    def get(self, user_id):
+        """
+        :param user_id: id of the account, as stored in the session
+        :return: the cached column values of the account, None if it is not cached
+        :rtype: dict
+        """
+        user_id = str(user_id)
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(user_id)
+                    return entry[1]
+                del self._entries[user_id]
+
+        if not self.redis_ttl:
+            return None
+        try:
+            data, version = self.redis_store.mget(KEY_PREFIX + user_id, VERSION_PREFIX + user_id)
+        except RedisError:
+            # the database is still there, a redis outage only costs the queries
+            return None
+        if data is None:
+            return None
+        entry = json.loads(data.decode())
+        if "values" not in entry or entry.get("version") != _decode(version):
+            # cached from a row loaded before the account was last invalidated
+            return None
+        self._remember(user_id, entry["values"], generation)
+        return entry["values"]
+
+    def version(self, user_id):
+        """
+        Reads the version of an account, this is done before the account is loaded from the database so that
+        the values loaded are not cached if the account is invalidated in the meantime
+        :param user_id: id of the account
+        :return: token to pass to set along with the values loaded
+        :rtype: tuple
+        """
+        user_id = str(user_id)
+        version = None
+        if self.redis_ttl:
+            try:
+                version = _decode(self.redis_store.get(VERSION_PREFIX + user_id))
+            except RedisError:
+                version = False
+        return self._generation, version
+
+    def set(self, user_id, values, version=None):
+        """
+        Caches the column values of an account in both levels
+        :param user_id: id of the account
+        :param values: JSON serializable column values of the account
+        :param version: the version read before the values were loaded, the current one if None
+        """
+        user_id = str(user_id)
+        generation, version = version or self.version(user_id)
+        self._remember(user_id, values, generation)
+        if self.redis_ttl and version is not False:
+            try:
+                self.redis_store.setex(KEY_PREFIX + user_id, self.redis_ttl,
+                                       json.dumps(dict(version=version, values=values)))
+            except RedisError:
+                pass
+
+    def invalidate(self, user_id):
+        """
+        Drops an account from both levels and bumps its version, so that values loaded before are not cached
+        :param user_id: id of the account
+        """
+        user_id = str(user_id)
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+        if self.redis_ttl:
+            try:
+                pipeline = self.redis_store.pipeline()
+                pipeline.incr(VERSION_PREFIX + user_id)
+                pipeline.delete(KEY_PREFIX + user_id)
+                pipeline.execute()
+            except RedisError:
+                pass
+
+    def _remember(self, user_id, values, generation):
+        if not self.max_size:
+            return
+        with self._lock:
+            if generation != self._generation:
+                # an account has been invalidated since the values were read
+                return
+            self._entries[user_id] = (time.time() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _decode(version):
+    return version.decode() if version is not None else None
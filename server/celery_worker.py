@@ -0,0 +1,12 @@
+"""
+Entry point of the celery worker, which runs the background tasks such as building image thumbnails
+Start it with:
+    celery -A celery_worker.celery worker
+"""
+import os
+from app import create_app, celery
+
+app = create_app(os.getenv("FLASK_CONFIG") or "default")
+# the tasks are declared in the modules of the blueprints
+app.load_blueprints()
+app.app_context().push()
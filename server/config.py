@@ -21,6 +21,52 @@ class Config(object):
     CSRF_ENABLED = True
     THREADS_PER_PAGE = 2
 
+    # manage.py serve runs the application under gunicorn, workers and threads left at 0 are derived from the
+    # number of processors and THREADS_PER_PAGE. Workers are replaced after SERVER_MAX_REQUESTS requests, the
+    # jitter keeps them from all restarting at once
+    SERVER_BIND = os.environ.get("SERVER_BIND", "0.0.0.0:5000")
+    SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 0))
+    SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 0))
+    SERVER_TIMEOUT = 60
+    SERVER_GRACEFUL_TIMEOUT = 30
+    SERVER_MAX_REQUESTS = 1000
+    SERVER_MAX_REQUESTS_JITTER = 100
+
+    # manage.py transfer serves file downloads and upload chunks from an asyncio event loop, a slow client
+    # holds a socket and a buffer of TRANSFER_BUFFER_SIZE bytes there instead of a worker. The threads only
+    # authenticate requests and record uploads, connections idle for TRANSFER_IDLE_TIMEOUT seconds are closed
+    TRANSFER_SERVER_BIND = os.environ.get("TRANSFER_SERVER_BIND", "0.0.0.0:5001")
+    TRANSFER_SERVER_THREADS = 4
+    TRANSFER_BUFFER_SIZE = 16 * 1024
+    TRANSFER_IDLE_TIMEOUT = 60
+
+    # seconds the application may take to import, start and load its views, manage.py startup_profile fails
+    # when it takes longer
+    STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", 2.5))
+
+    # /metrics exposes the latency, status and size of the requests and the time views spend walking the media
+    # path in the Prometheus text format, a scraper must send the METRICS_TOKEN as a bearer token if it is set.
+    # Each process keeps its values in a memory mapped file in METRICS_DIR, so that the totals of all the gunicorn
+    # workers are reported, manage.py serve uses a temporary directory if it is not set
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    # records are queued by the request threads and written by a background thread as JSON lines to stderr and to
+    # LOG_FILE, which is rotated. Errors are mailed to LOG_MAIL_ADMINS, an error repeating within LOG_MAIL_INTERVAL
+    # seconds is counted instead of mailed again and at most LOG_MAIL_BURST mails are sent per interval. Records
+    # are dropped when LOG_QUEUE_SIZE records are waiting
+    LOG_LEVEL = os.environ.get("LOG_LEVEL")
+    LOG_QUEUE_SIZE = 10000
+    LOG_STREAM = True
+    LOG_FILE = os.environ.get("LOG_FILE")
+    LOG_FILE_MAX_BYTES = 1 * 1024 * 1024
+    LOG_FILE_BACKUPS = 10
+    LOG_MAIL_ADMINS = [admin for admin in os.environ.get("ADMINS", "").split(",") if admin]
+    LOG_MAIL_INTERVAL = 600
+    LOG_MAIL_BURST = 5
+
     # setup for media path to mount to host filesystem
     PICLOUD_USER = os.environ.get("PICLOUD_USER", "picloud")
     ROOT_MEDIA_PATH = "/media/{}/"
@@ -29,17 +75,95 @@ class Config(object):
     else:
         MEDIA_PATH = ROOT_MEDIA_PATH.format(PICLOUD_USER)
 
-    # database setup
+    # persistent index of the media tree, requests will incrementally refresh it if it is older
+    # than MEDIA_INDEX_MAX_AGE seconds
+    MEDIA_INDEX_PATH = os.environ.get("MEDIA_INDEX_PATH", os.path.join(basedir, "media_index.db"))
+    MEDIA_INDEX_MAX_AGE = 30
+
+    # the media watcher (python manage.py watch_media) applies filesystem changes to the index in batches
+    # collected over MEDIA_WATCHER_BATCH_DELAY seconds
+    MEDIA_WATCHER_BATCH_DELAY = 0.5
+    MEDIA_WATCHER_HEARTBEAT = 5
+
+    # directory listings are paginated
+    MEDIA_LISTING_PAGE_SIZE = 100
+    MEDIA_LISTING_MAX_PAGE_SIZE = 1000
+
+    # Range requests asking for more ranges than this are answered with the whole file
+    MEDIA_MAX_RANGES = 16
+
+    # pending uploads that have not received a chunk for this many seconds are cancelled and their temporary
+    # file removed, by celery beat and by manage.py prune_store
+    MEDIA_UPLOAD_EXPIRY = 24 * 3600
+
+    # content addressed store that deduplicates uploads with hard links, content is hashed in blocks
+    MEDIA_DEDUP_ENABLED = os.environ.get("MEDIA_DEDUP_ENABLED", "0") == "1"
+    MEDIA_DEDUP_BLOCK_SIZE = 4 * 1024 * 1024
+
+    # folders are downloaded as ZIP archives, files with these extensions are already compressed and are stored
+    MEDIA_ZIP_STORED_EXTENSIONS = frozenset([
+        "jpg", "jpeg", "png", "gif", "webp", "heic", "mp3", "m4a", "aac", "ogg", "opus", "flac", "mp4", "m4v",
+        "mkv", "mov", "avi", "webm", "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "docx", "xlsx", "pptx"
+    ])
+
+    # thumbnails and previews of images, as the maximum width and height of each variant. They are built by
+    # celery and cached on disk, the least recently used ones are evicted once the cache is over its size
+    MEDIA_DERIVATIVE_CACHE_PATH = os.environ.get("MEDIA_DERIVATIVE_CACHE_PATH", os.path.join(basedir, "derivatives"))
+    MEDIA_DERIVATIVE_CACHE_SIZE = 512 * 1024 * 1024
+    MEDIA_DERIVATIVE_SIZES = dict(thumbnail=256, preview=1280)
+    MEDIA_DERIVATIVE_QUALITY = 80
+
+    # users loaded for authenticated requests are cached in each process for USER_CACHE_TTL seconds and in
+    # redis for USER_CACHE_REDIS_TTL seconds. Other processes may serve a changed user, e.g. one that has been
+    # deactivated, until their entry expires, thus USER_CACHE_TTL is kept short
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 2
+    USER_CACHE_REDIS_TTL = 300
+    USER_CACHE_REDIS_ENABLED = os.environ.get("REDIS_SERVER_URL") is not None
+
+    # passwords are hashed in a pool of PASSWORD_HASH_WORKERS processes, at most PASSWORD_HASH_QUEUE_SIZE
+    # passwords are hashed or waiting at once. Users are rehashed at login when the method, its cost or the
+    # salt length change
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:150000"
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_SIZE = 8
+    PASSWORD_HASH_TIMEOUT = 10
+
+    # POST requests to the auth blueprint are limited per client address and per account email, as
+    # (requests, window in seconds) over a sliding window kept in redis
+    RATE_LIMIT_ENABLED = os.environ.get("REDIS_SERVER_URL") is not None
+    AUTH_RATE_LIMITS = dict(ip=(30, 60), account=(10, 300))
+
+    # database setup, DATABASE_CONNECT_OPTIONS are passed to the database driver
     DATABASE_CONNECT_OPTIONS = {}
     POSTGRES_USER = os.environ.get("POSTGRES_USER")
     POSTGRES_DB = os.environ.get("POSTGRES_DB")
     POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
     CELERY_BROKER_URL = os.environ.get("REDIS_SERVER_URL")
     CELERY_RESULT_BACKEND = os.environ.get("REDIS_SERVER_URL")
+    REDIS_URL = os.environ.get("REDIS_SERVER_URL", "redis://localhost:6379/0")
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL")
     SECURITY_PASSWORD_SALT = os.environ.get("SECURITY_PASSWORD_SALT")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # every web worker has its own pool, thus a server holds up to workers * (pool size + overflow) connections,
+    # which must stay under max_connections of the database. Connections are checked before use and recycled
+    # before the server or a firewall drops them, statements running longer than the timeout are cancelled
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 5))
+    SQLALCHEMY_POOL_TIMEOUT = 10
+    SQLALCHEMY_POOL_RECYCLE = 1800
+    SQLALCHEMY_POOL_PRE_PING = True
+    SQLALCHEMY_STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", 30000))
+
+    # the number and duration of the statements of each request are sent in its Server-Timing header
+    SQL_STATS_ENABLED = True
+
+    # read only requests are served by the replica if there is one, see app/database.py
+    SQLALCHEMY_BINDS = dict(replica=os.environ.get("DATABASE_REPLICA_URL")) \
+        if os.environ.get("DATABASE_REPLICA_URL") else None
+
     # mail settings
     MAIL_SERVER = 'smtp.googlemail.com'
     MAIL_PORT = 465
@@ -51,6 +175,24 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('APP_MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get("MAIL_DEFAULT_SENDER")
 
+    # clients follow background operations by long polling or over Server-Sent Events, in seconds
+    ASYNC_OPERATION_POLL_INTERVAL = 0.5
+    ASYNC_OPERATION_MAX_WAIT = 25
+    ASYNC_OPERATION_KEEPALIVE = 15
+    ASYNC_OPERATION_STREAM_TIMEOUT = 300
+
+    # mail is queued in an outbox and sent by celery in batches over one connection, failed messages are
+    # retried after MAIL_OUTBOX_RETRY_DELAY seconds, doubling up to MAIL_OUTBOX_MAX_RETRY_DELAY
+    MAIL_OUTBOX_BATCH_SIZE = 50
+    MAIL_OUTBOX_MAX_ATTEMPTS = 8
+    MAIL_OUTBOX_RETRY_DELAY = 60
+    MAIL_OUTBOX_MAX_RETRY_DELAY = 3600
+    MAIL_OUTBOX_LEASE = 300
+    CELERYBEAT_SCHEDULE = {
+        "send-outbox": dict(task="app.mod_auth.email.send_outbox", schedule=60),
+        "prune-uploads": dict(task="app.mod_media.uploads.prune_uploads", schedule=3600),
+    }
+
     @staticmethod
     def init_app(app):
         pass
@@ -78,9 +220,16 @@ class TestingConfig(Config):
     DEBUG = True
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_BINDS = None
     WTF_CSRF_ENABLED = False
     CSRF_ENABLED = False
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    CELERY_ALWAYS_EAGER = True
+    USER_CACHE_REDIS_ENABLED = False
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
+    PASSWORD_HASH_WORKERS = 0
+    RATE_LIMIT_ENABLED = False
+    LOG_STREAM = False
 
 
 class ProductionConfig(Config):
@@ -89,6 +238,8 @@ class ProductionConfig(Config):
 
     """
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    LOG_FILE = os.environ.get("LOG_FILE", os.path.join(basedir, "tmp", "picloud.log"))
 
 
 # configuration dictionary that will be imported in other parts of the application and will be used to
@@ -1,22 +1,19 @@
 from datetime import datetime
 
 import os
+import sys
 from click import echo, style
 import logging
-from flask_migrate import MigrateCommand, Migrate
 from flask_script import Server, Manager, Shell
+from setup_environment import setup_environment_variables
+
+# import environment variables from .env file, before the configurations read them
+setup_environment_variables()
+
 from app import create_app, db
 
 logger = logging.getLogger("PiCloud")
 
-# import environment variables from .env file
-if os.path.exists(".env"):
-    echo(style(text=">>>> Importing environment variables", fg="green", bold=True))
-    for line in open(".env"):
-        var = line.strip().split("=")
-        if len(var) == 2:
-            os.environ[var[0]] = var[1]
-
 cov = None
 if os.environ.get("FLASK_COVERAGE"):
     import coverage
@@ -32,7 +29,6 @@ app = create_app(os.getenv("FLASK_CONFIG") or "default")
 
 # pass the application object to manager and create a manager instance, to enable running the application
 manager = Manager(app)
-migrate = Migrate(app, db, directory="migrations")
 
 # set up a server to run at a specific port and host
 server = Server(host="0.0.0.0", port=5000)
@@ -44,14 +40,23 @@ def make_shell_context():
     :return: A dictionary with the variables that will be in the shell context
     :rtype: dict
     """
+    app.load_blueprints()
     return dict(app=app, db=db)
 
 
 # add the commands that will be used in the application
 # run these commands with python manage.py shell/runserver/etc...
-manager.add_command("shell", Shell(make_context=make_shell_context()))
+manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command("runserver", server)
-manager.add_command("db", MigrateCommand)
+
+# alembic takes longer to import than the rest of the application, only the db commands need it
+if sys.argv[1:2] == ["db"]:
+    from flask_migrate import MigrateCommand, Migrate
+
+    # the models are imported with the blueprints, autogenerate compares them to the database
+    app.load_blueprints()
+    migrate = Migrate(app, db, directory="migrations")
+    manager.add_command("db", MigrateCommand)
 
 
 @manager.command
@@ -62,7 +67,6 @@ def test(cover=False):
     :param cover variable will be set to False, this will be used to coverage reports
     """
     if cover and not os.environ.get("FLASK_COVERAGE"):
-        import sys
         os.environ['FLASK_COVERAGE'] = '1'
         os.execvp(sys.executable, [sys.executable] + sys.argv)
 
@@ -92,6 +96,59 @@ def test(cover=False):
         cov.erase()
 
 
+@manager.option("-b", "--bind", dest="bind", default=None, help="address to listen on, e.g. 0.0.0.0:5000")
+@manager.option("-w", "--workers", dest="workers", type=int, default=None, help="number of worker processes")
+@manager.option("-t", "--threads", dest="threads", type=int, default=None, help="number of threads per worker")
+def serve(bind=None, workers=None, threads=None):
+    """
+    Runs the application under gunicorn, use this instead of runserver in production. Send HUP to the master
+    process to replace the workers gracefully, e.g. after changing the configuration
+    """
+    from app.server import PiCloudServer, server_options
+
+    options = server_options(app, bind=bind, workers=workers, threads=threads)
+    echo(style(">>>> Serving on {bind} with {workers} workers of {threads} threads".format(**options),
+               fg="green", bold=True))
+    PiCloudServer(app, options).run()
+
+
+@manager.option("-b", "--bind", dest="bind", default=None, help="address to listen on, e.g. 0.0.0.0:5001")
+@manager.option("-t", "--threads", dest="threads", type=int, default=None, help="threads checking the requests")
+def transfer(bind=None, threads=None):
+    """
+    Runs the transfer server, which sends file downloads and receives upload chunks from an event loop so that
+    slow clients do not hold the workers of manage.py serve. Route the download and chunk upload requests to it
+    """
+    from app.transfer_server import TransferServer
+
+    bind = bind or app.config.get("TRANSFER_SERVER_BIND")
+    echo(style(">>>> Serving transfers on {}".format(bind), fg="green", bold=True))
+    TransferServer(app, threads=threads).run(bind)
+
+
+@manager.option("-c", "--config", dest="config_name", default=None, help="configuration to start with")
+@manager.option("-l", "--limit", dest="limit", type=int, default=20, help="number of packages to list")
+def startup_profile(config_name=None, limit=20):
+    """
+    Measures how long the application takes to start in a fresh interpreter and which packages take longest to
+    import. Exits with 1 if the start up takes longer than STARTUP_BUDGET seconds, e.g. to catch regressions in CI
+    """
+    from app.startup_profile import profile_startup, format_report
+
+    profile = profile_startup(config_name or os.getenv("FLASK_CONFIG") or "default",
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in format_report(profile, limit):
+        echo(line)
+
+    budget = app.config.get("STARTUP_BUDGET")
+    if profile["total"] > budget:
+        echo(style(">>>> Start up took {:.2f}s, over the budget of {:.2f}s".format(profile["total"], budget),
+                   fg="red", bold=True))
+        sys.exit(1)
+    echo(style(">>>> Start up took {:.2f}s, within the budget of {:.2f}s".format(profile["total"], budget),
+               fg="green", bold=True))
+
+
 @manager.command
 def init_async_values():
     """
@@ -117,6 +174,66 @@ def init_async_values():
     print("Done...")
 
 
+@manager.command
+def watch_media():
+    """
+    Runs the media watcher, which keeps the media tree index up to date with inotify so that requests
+    never have to walk the media path
+    """
+    from app import media_tree
+    from app.media_watcher import MediaWatcher
+
+    watcher = MediaWatcher(media_tree, batch_delay=app.config.get("MEDIA_WATCHER_BATCH_DELAY"),
+                           heartbeat_interval=app.config.get("MEDIA_WATCHER_HEARTBEAT"))
+    echo(style(">>>> Watching {}".format(media_tree.root_path), fg="green", bold=True))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        echo(style(">>>> Stopped watching {}".format(media_tree.root_path), fg="yellow", bold=True))
+
+
+@manager.command
+def prune_store():
+    """
+    Cancels the uploads that have not received a chunk for MEDIA_UPLOAD_EXPIRY seconds, then removes content
+    from the deduplicating store of each drive that is no longer used by any file
+    """
+    from app import media_tree
+    from app.mod_media.content_store import prune_store as prune_drive_store
+    from app.mod_media.uploads import expire_uploads
+
+    expired = expire_uploads(app.config.get("MEDIA_UPLOAD_EXPIRY"))
+    echo(style(">>>> Cancelled {} expired uploads".format(expired), fg="green"))
+    for drive in media_tree.children(""):
+        if media_tree.is_dir(drive):
+            removed = prune_drive_store(drive)
+            echo(style(">>>> Removed {} unused blobs from {}".format(removed, drive), fg="green"))
+
+
+@manager.option("path", help="CSV or NDJSON file of the accounts, - reads from stdin")
+@manager.option("-f", "--format", dest="file_format", default=None, help="csv or ndjson, defaults to the extension")
+@manager.option("-b", "--batch-size", dest="batch_size", type=int, default=1000, help="accounts inserted at once")
+def import_users(path, file_format=None, batch_size=1000):
+    """
+    Creates the user profiles and accounts listed in a CSV or NDJSON file, with the fields first_name,
+    last_name, email, password and optionally accept_terms, admin and confirmed. Accounts that already exist
+    are skipped
+    """
+    from app.mod_auth.provisioning import read_users, import_users as import_user_accounts
+
+    if file_format is None:
+        file_format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+    stream = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        result = import_user_accounts(read_users(stream, file_format), batch_size=batch_size)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    echo(style(">>>> Imported {imported} accounts, skipped {duplicates} existing and {invalid} invalid".format(
+        **result), fg="green", bold=True))
+
+
 @manager.command
 def create_admin():
     """
@@ -1,15 +1,29 @@
 import os
 from click import echo, style
 
+# the files that have already been imported, so that a file is parsed once per process
+_imported = set()
+
+
+def setup_environment_variables(path=".env"):
+    """
+    import environment variables, this must run before config is imported as the configurations read the
+    environment when they are defined
+    :param path: the file of NAME=value lines to import
+    """
+    if path in _imported or not os.path.exists(path):
+        return
+    _imported.add(path)
+    echo(style(">>>> Importing environment variables", fg="green", bold=True))
+    with open(path) as env_file:
+        for line in env_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, separator, value = line.partition("=")
+            if separator:
+                os.environ[name.strip()] = value.strip()
 
-def setup_environment_variables():
-    """import environment variables """
-    if os.path.exists(".env"):
-        echo(style("Importing environment variables", fg="green", bold=True))
-        for line in open(".env"):
-            var = line.strip().split("=")
-            if len(var) == 2:
-                os.environ[var[0]] = var[1]
 
 if __name__ == "__main__":
     setup_environment_variables()
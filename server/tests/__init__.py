@@ -1,7 +1,13 @@
+import os
+from getpass import getuser
+import shutil
+import tempfile
 import unittest
-from app import create_app, db
-from app.mod_auth.models import PiCloudUserAccount, PiCloudUserProfile
+from contextlib import contextmanager
+from app import create_app, db, media_tree, query_stats
+from app.mod_auth.models import PiCloudUserAccount, PiCloudUserProfile, AsyncOperationStatus
 from flask_testing import TestCase
+from redis.exceptions import RedisError
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 
@@ -50,6 +56,7 @@ class BaseTestCase(ContextTestCase):
         db.create_all()
 
         self.create_user_account()
+        self.create_async_statuses()
         # self.add_file()
 
         db.session.commit()
@@ -75,7 +82,8 @@ class BaseTestCase(ContextTestCase):
                 user_profile = PiCloudUserProfile(first_name="picloud", last_name="man",
                                                   email="picloudman@picloud.com")
                 user_account = PiCloudUserAccount(username="picloud", email=user_profile.email,
-                                                  password="picloudman", registered_on=datetime.now())
+                                                  password="picloudman", registered_on=datetime.now(),
+                                                  user_profile=user_profile)
                 db.session.add(user_account)
                 db.session.add(user_profile)
             except IntegrityError as ie:
@@ -84,6 +92,14 @@ class BaseTestCase(ContextTestCase):
 
         return user_profile
 
+    @staticmethod
+    def create_async_statuses():
+        """
+        Adds the async operation statuses, as done by manage.py init_async_values
+        """
+        for status_id, code in ((1, "pending"), (2, "ok"), (3, "error")):
+            db.session.add(AsyncOperationStatus(id=status_id, code=code))
+
     def login(self):
         """
         Login in the user to the testing app
@@ -99,7 +115,163 @@ class BaseTestCase(ContextTestCase):
             follow_redirects=False
         )
 
+    @contextmanager
+    def assertQueryBudget(self, max_queries=None, max_repeats=None):
+        """
+        Fails the test if the block, e.g. a request made with the test client, runs more than max_queries SQL
+        statements, or runs the same statement more than max_repeats times, which is the sign of an N+1 query
+        :param max_queries: maximum number of statements, None for no limit
+        :param max_repeats: maximum number of times a statement may be run, None for no limit
+        :return: the log of the statements
+        :rtype: app.query_stats.QueryLog
+        """
+        with query_stats.record() as log:
+            yield log
+        if max_queries is not None and log.count > max_queries:
+            self.fail("{} queries over the budget of {}:\n{}".format(
+                log.count, max_queries, "\n".join(log.statements)))
+        repeated = log.most_repeated()
+        if max_repeats is not None and repeated is not None and repeated[1] > max_repeats:
+            self.fail("Statement run {} times, over the limit of {}: {}".format(repeated[1], max_repeats, repeated[0]))
+
     # todo: add dummy adding file and dummy downloading file
 
+
+class FakeRedis(object):
+    """
+    Stands in for redis, implements the few commands the application uses and keeps the values in dicts
+    """
+
+    def __init__(self, broken=False):
+        self.values = {}
+        self.sorted_sets = {}
+        self.broken = broken
+
+    def check(self):
+        if self.broken:
+            raise RedisError("down")
+
+    def get(self, key):
+        self.check()
+        return self.values.get(key)
+
+    def mget(self, *keys):
+        self.check()
+        return [self.values.get(key) for key in keys]
+
+    def incr(self, key):
+        self.check()
+        value = int(self.values.get(key, b"0")) + 1
+        self.values[key] = str(value).encode()
+        return value
+
+    def setex(self, key, ttl, value):
+        self.check()
+        self.values[key] = value.encode()
+
+    def delete(self, key):
+        self.check()
+        self.values.pop(key, None)
+        self.sorted_sets.pop(key, None)
+
+    def execute_command(self, command, key, *args):
+        self.check()
+        if command != "ZADD":
+            raise NotImplementedError(command)
+        members = self.sorted_sets.setdefault(key, {})
+        for score, member in zip(args[::2], args[1::2]):
+            members[member] = float(score)
+        return len(args) // 2
+
+    def zremrangebyscore(self, key, low, high):
+        self.check()
+        members = self.sorted_sets.get(key, {})
+        removed = [member for member, score in members.items() if low <= score <= high]
+        for member in removed:
+            del members[member]
+        return len(removed)
+
+    def zrem(self, key, *members):
+        self.check()
+        existing = self.sorted_sets.get(key, {})
+        return len([existing.pop(member) for member in members if member in existing])
+
+    def zcard(self, key):
+        self.check()
+        return len(self.sorted_sets.get(key, {}))
+
+    def zrange(self, key, start, stop, withscores=False):
+        self.check()
+        members = sorted(self.sorted_sets.get(key, {}).items(), key=lambda item: item[1])
+        members = members[start:None if stop == -1 else stop + 1]
+        return members if withscores else [member for member, _ in members]
+
+    def expire(self, key, seconds):
+        self.check()
+        return True
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    """
+    Queues the commands sent to a FakeRedis and runs them on execute
+    """
+
+    def __init__(self, redis_store):
+        self.redis_store = redis_store
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_store, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.commands]
+
+
+class MediaTreeTestCase(BaseTestCase):
+    """
+    Creates a dummy media path with a drive in it and points the media tree index to it
+    """
+
+    def setUp(self):
+        super(MediaTreeTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.media_path = os.path.join(self.tmp_dir, "media")
+        os.makedirs(os.path.join(self.media_path, "usb", "photos"))
+        self.write_file("usb/readme.txt", b"picloud")
+        self.write_file("usb/photos/one.jpg", b"1" * 10)
+        self.write_file("usb/photos/two.jpg", b"2" * 20)
+
+        self.app.config["MEDIA_PATH"] = self.media_path
+        self.app.config["MEDIA_INDEX_PATH"] = os.path.join(self.tmp_dir, "media_index.db")
+        media_tree.init_app(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(MediaTreeTestCase, self).tearDown()
+
+    def write_file(self, path, content):
+        with open(os.path.join(self.media_path, *path.split("/")), "wb") as f:
+            f.write(content)
+
+    def touch_dir(self, path, offset):
+        """move the mtime of a directory, mtime resolution may be too coarse to notice fast changes"""
+        full_path = os.path.join(self.media_path, *path.split("/"))
+        dir_stat = os.stat(full_path)
+        os.utime(full_path, (dir_stat.st_atime, dir_stat.st_mtime + offset))
+
+    @staticmethod
+    def media_url(path):
+        """url of a route in the media blueprint"""
+        return "/media/{}/{}".format(getuser(), path)
+
+
 if __name__ == "__main__":
     unittest.main()
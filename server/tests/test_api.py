@@ -0,0 +1,145 @@
+"""
+Tests for the background operations tracked with AsyncOperation and for following them through the api
+"""
+import json
+import time
+import unittest
+
+from app import celery, db
+from app.async_operations import TrackedTask
+from app.mod_auth.models import AsyncOperation, AsyncOperationStatus, PiCloudUserProfile
+from tests import BaseTestCase
+
+# the tasks are defined on first use, pytest would evaluate them while collecting the module otherwise, which
+# finalizes celery before it is configured
+TASKS = {}
+
+
+def tracked_tasks():
+    if not TASKS:
+        @celery.task(base=TrackedTask, bind=True, name="tests.count_to")
+        def count_to(self, operation_id, total):
+            for number in range(1, total + 1):
+                self.update_progress(operation_id, number, total)
+            return total
+
+        @celery.task(base=TrackedTask, bind=True, name="tests.fail")
+        def fail(self, operation_id):
+            raise IOError("Drive is gone")
+
+        @celery.task(base=TrackedTask, bind=True, name="tests.fail_on_database")
+        def fail_on_database(self, operation_id):
+            # the operation exists already, thus the insert fails
+            db.session.expunge_all()
+            db.session.add(AsyncOperation(id=operation_id, completed=0))
+            db.session.commit()
+
+        TASKS.update(count_to=count_to, fail=fail, fail_on_database=fail_on_database)
+    return TASKS
+
+
+class AsyncOperationTestCases(BaseTestCase):
+    """
+    Tests for tracking celery tasks and following their progress
+    """
+
+    def setUp(self):
+        super(AsyncOperationTestCases, self).setUp()
+        self.tasks = tracked_tasks()
+        self.profile_id = PiCloudUserProfile.query.filter_by(email="picloudman@picloud.com").one().id
+        self.app.config.update(ASYNC_OPERATION_POLL_INTERVAL=0.05, ASYNC_OPERATION_KEEPALIVE=0.1,
+                               ASYNC_OPERATION_STREAM_TIMEOUT=0.3)
+
+    def pending_operation(self, user_profile_id=None):
+        operation = AsyncOperation(operation="copy", user_profile_id=user_profile_id or self.profile_id, total=10,
+                                   completed=4, async_operation_status_id=AsyncOperation.status_id("pending"))
+        db.session.add(operation)
+        db.session.commit()
+        return operation.id
+
+    def test_statuses_are_cached(self):
+        """>>> Test that statuses are looked up without a query once they are cached"""
+        AsyncOperationStatus.id_for("pending")
+        with self.assertQueryBudget(max_queries=0):
+            self.assertEqual(AsyncOperationStatus.id_for("ok"), 2)
+            self.assertEqual(AsyncOperationStatus.code_for(3), "error")
+        self.assertIsNone(AsyncOperationStatus.id_for("unknown"))
+
+    def test_tracked_task_records_progress_and_result(self):
+        """>>> Test that a tracked task records its start, progress, end and return value"""
+        operation_id = self.tasks["count_to"].start(self.profile_id, 5, target="drive/folder").id
+        operation = AsyncOperation.query.get(operation_id)
+        self.assertEqual(operation.status_code, "ok")
+        self.assertEqual((operation.completed, operation.total, operation.progress), (5, 5, 100.0))
+        self.assertEqual(operation.operation, "count_to")
+        self.assertEqual(operation.target, "drive/folder")
+        self.assertIsNotNone(operation.task_id)
+        self.assertIsNotNone(operation.started_at)
+        self.assertIsNotNone(operation.finished_at)
+        self.assertEqual(json.loads(operation.result), dict(value=5))
+
+    def test_tracked_task_records_error(self):
+        """>>> Test that a failing tracked task records its error"""
+        operation_id = self.tasks["fail"].start(self.profile_id).id
+        operation = AsyncOperation.query.get(operation_id)
+        self.assertEqual(operation.status_code, "error")
+        self.assertEqual(json.loads(operation.result), dict(error="Drive is gone"))
+
+    def test_tracked_task_records_database_error(self):
+        """>>> Test that a tracked task failing on a database error still records its error"""
+        self.tasks["fail_on_database"].start(self.profile_id)
+        operation = AsyncOperation.query.filter_by(operation="fail_on_database").one()
+        self.assertEqual(operation.status_code, "error")
+        self.assertIn("UNIQUE constraint failed", json.loads(operation.result)["error"])
+
+    def test_get_operation(self):
+        """>>> Test that users can only see their own operations"""
+        operation_id = self.pending_operation()
+        other_profile = PiCloudUserProfile(first_name="other", last_name="user", email="other@picloud.com")
+        db.session.add(other_profile)
+        db.session.commit()
+        other_operation_id = self.pending_operation(other_profile.id)
+
+        self.login()
+        response = self.client.get("api/operations/{}".format(operation_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json["status"], response.json["progress"]), ("pending", 40.0))
+        self.assertEqual(self.client.get("api/operations/{}".format(other_operation_id)).status_code, 404)
+
+    def test_long_poll_waits_for_change(self):
+        """>>> Test that a long poll with the current version is held until it times out"""
+        operation_id = self.pending_operation()
+        self.login()
+        version = self.client.get("api/operations/{}".format(operation_id)).json["version"]
+
+        start = time.monotonic()
+        response = self.client.get("api/operations/{}?version={}&wait=0.2".format(operation_id, version))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(response.json["version"], version)
+
+        response = self.client.get("api/operations/{}?version=stale&wait=5".format(operation_id))
+        self.assertEqual(response.json["version"], version)
+
+    def test_event_stream(self):
+        """>>> Test that the progress of an operation is streamed until the stream times out"""
+        operation_id = self.pending_operation()
+        self.login()
+        response = self.client.get("api/operations/{}/events".format(operation_id))
+        self.assertEqual(response.mimetype, "text/event-stream")
+        data = response.get_data(as_text=True)
+        self.assertTrue(data.startswith("event: progress\nid: pending:4:10\n"))
+        self.assertIn(": keepalive", data)
+
+    def test_event_stream_of_finished_operation(self):
+        """>>> Test that the stream of a finished operation sends a done event and ends"""
+        operation_id = self.tasks["count_to"].start(self.profile_id, 2).id
+        self.login()
+        response = self.client.get("api/operations/{}/events".format(operation_id),
+                                   headers={"Last-Event-ID": "ok:2:2"})
+        events = response.get_data(as_text=True).split("\n\n")
+        self.assertTrue(events[0].startswith("event: done\nid: ok:2:2"))
+        self.assertEqual(events[1:], [""])
+
+
+if __name__ == "__main__":
+    unittest.main()
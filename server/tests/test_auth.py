@@ -6,15 +6,17 @@ works as it should as compared to Register authentication and as well as Recover
 Makes is more readable and cleaner
 For functional tests (how all these separated units work together) refer to test_functional.py file
 """
+import time
 import unittest
 from datetime import datetime
 
 from flask_login import current_user
+from sqlalchemy import event
 
 from app.mod_auth.models import PiCloudUserAccount, PiCloudUserProfile
-from app import db
+from app import db, rate_limiter
 from app.mod_auth.tokens import generate_token, confirm_token
-from tests import BaseTestCase
+from tests import BaseTestCase, FakeRedis
 
 
 class LoginAuthTestCases(BaseTestCase):
@@ -103,6 +105,41 @@ class RegisterAuthTestCases(BaseTestCase):
             self.assertTrue(picloud_user_account.email == 'picloudman@picloud.com')
             self.assertFalse(picloud_user_account.admin)
 
+    def register(self, email):
+        return self.client.post("auth/register", data=dict(
+            first_name="new", last_name="picloud", email=email, password="newpicloud",
+            verify_password="newpicloud", accept_terms=True))
+
+    def test_registration_links_account_to_profile(self):
+        """>>> Test that registering creates an account linked to its profile without looking it up first"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with self.client:
+                self.register("newpicloud@picloud.com")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        account = PiCloudUserAccount.query.filter_by(email="newpicloud@picloud.com").one()
+        self.assertEqual(account.user_profile.email, "newpicloud@picloud.com")
+        self.assertNotEqual(account.uid, PiCloudUserAccount.query.filter_by(email="picloudman@picloud.com").one().uid)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith("SELECT") and "FROM user_account" in statement
+                          and "user_account.email = " in statement])
+
+    def test_registration_with_existing_email_fails(self):
+        """>>> Test that registering an existing email is refused by the unique constraint"""
+        with self.client:
+            response = self.register("picloudman@picloud.com")
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(current_user.is_authenticated)
+        self.assertEqual(PiCloudUserProfile.query.filter_by(email="picloudman@picloud.com").count(), 1)
+        self.assertEqual(PiCloudUserAccount.query.count(), 1)
+
     def test_registered_on_defaults_to_datetime(self):
         """>>> Ensure that the registered_on date is a datetime object"""
         with self.client:
@@ -204,5 +241,79 @@ class RecoverPasswordAuthTestCases(BaseTestCase):
             # check if there is a response
             self.assertTrue(response.status_code == 302)
 
+
+class ThrottleAuthTestCases(BaseTestCase):
+    """
+    Tests for limiting the requests to the auth views
+    """
+
+    def setUp(self):
+        super(ThrottleAuthTestCases, self).setUp()
+        self.redis_store = FakeRedis()
+        rate_limiter.redis_store = self.redis_store
+        rate_limiter.enabled = True
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(5, 60), account=(2, 60))
+
+    def tearDown(self):
+        rate_limiter.enabled = False
+        super(ThrottleAuthTestCases, self).tearDown()
+
+    def post_login(self, email="picloudman@picloud.com", address="127.0.0.1"):
+        return self.client.post("auth/login", data=dict(email=email, password="wrong"),
+                                environ_base={"REMOTE_ADDR": address})
+
+    def test_account_is_limited(self):
+        """>>> Test that logins to an account are limited and answered with 429 and Retry-After"""
+        self.assertEqual(self.post_login().status_code, 200)
+        self.assertEqual(self.post_login(email="PiCloudMan@picloud.com").status_code, 200)
+        response = self.post_login(address="10.0.0.1")
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers["Retry-After"]), 0)
+        self.assertEqual(self.post_login(email="other@picloud.com").status_code, 200)
+
+    def test_address_is_limited(self):
+        """>>> Test that the requests of a client address are limited across accounts"""
+        for index in range(5):
+            self.assertEqual(self.post_login(email="user{}@picloud.com".format(index)).status_code, 200)
+        self.assertEqual(self.post_login(email="user9@picloud.com").status_code, 429)
+        self.assertEqual(self.post_login(email="user9@picloud.com", address="10.0.0.1").status_code, 200)
+
+    def test_limit_is_checked_before_hashing(self):
+        """>>> Test that a limited request does not reach the view"""
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(0, 60), account=(0, 60))
+        response = self.post_login()
+        self.assertEqual(response.status_code, 429)
+        self.assertNotIn(b"login", response.data)
+
+    def test_window_slides(self):
+        """>>> Test that requests older than the window no longer count"""
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(5, 60), account=(1, 0.2))
+        self.assertEqual(self.post_login().status_code, 200)
+        self.assertEqual(self.post_login().status_code, 429)
+        time.sleep(0.3)
+        self.assertEqual(self.post_login().status_code, 200)
+
+    def test_rejected_requests_do_not_count(self):
+        """>>> Test that requests over the limit do not keep the account limited once the window has passed"""
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(100, 60), account=(1, 0.5))
+        self.assertEqual(self.post_login().status_code, 200)
+        for _ in range(3):
+            time.sleep(0.1)
+            self.assertEqual(self.post_login().status_code, 429)
+        time.sleep(0.25)
+        self.assertEqual(self.post_login().status_code, 200)
+
+    def test_get_is_not_limited(self):
+        """>>> Test that only POST requests are limited"""
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(0, 60), account=(0, 60))
+        self.assertEqual(self.client.get("auth/login").status_code, 200)
+
+    def test_fails_open_without_redis(self):
+        """>>> Test that requests are let through when redis is down"""
+        self.redis_store.broken = True
+        self.app.config["AUTH_RATE_LIMITS"] = dict(ip=(0, 60), account=(0, 60))
+        self.assertEqual(self.post_login().status_code, 200)
+
+
 if __name__ == '__main__':
     unittest.main()
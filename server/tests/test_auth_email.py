@@ -0,0 +1,103 @@
+"""
+Tests for the mail outbox, mail is suppressed while testing so no message leaves the test
+"""
+import smtplib
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask_mail import Connection
+from kombu.exceptions import OperationalError
+
+from app import mail
+# the task is not imported by name, pytest would evaluate it and finalize celery before it is configured
+from app.mod_auth import email
+from app.mod_auth.models import OutboxMessage
+from tests import BaseTestCase
+
+
+class OutboxTestCases(BaseTestCase):
+    """
+    Tests for queueing and sending mail
+    """
+
+    def queue(self, count=1):
+        for index in range(count):
+            self.db.session.add(OutboxMessage(recipient="user{}@picloud.com".format(index), subject="Hello",
+                                              html="<p>Hello</p>", sender="picloud@picloud.com"))
+        self.db.session.commit()
+
+    def test_send_mail_queues_and_sends(self):
+        """>>> Test that send_mail stores the message and the worker sends it"""
+        with mail.record_messages() as outbox:
+            message = email.send_mail("picloudman@picloud.com", "Welcome", "<p>Welcome</p>")
+        self.assertEqual([sent.recipients for sent in outbox], [["picloudman@picloud.com"]])
+        message = OutboxMessage.query.get(message.id)
+        self.assertEqual(message.status, "sent")
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNotNone(message.sent_at)
+
+    def test_send_mail_survives_broker_outage(self):
+        """>>> Test that mail stays in the outbox when the worker can not be reached"""
+        for error in (OSError("connection refused"), OperationalError("broker down"), RuntimeError("unexpected")):
+            with mock.patch.object(email.send_outbox, "apply_async", side_effect=error) as apply_async:
+                email.send_mail("picloudman@picloud.com", "Welcome", "<p>Welcome</p>")
+            apply_async.assert_called_once_with(retry=False)
+        self.assertEqual([message.status for message in OutboxMessage.query], ["pending"] * 3)
+
+    def test_batches_share_a_connection(self):
+        """>>> Test that messages are sent in batches, one connection per batch"""
+        self.app.config["MAIL_OUTBOX_BATCH_SIZE"] = 2
+        self.queue(3)
+        with mock.patch.object(mail, "connect", wraps=mail.connect) as connect:
+            self.assertEqual(email.send_outbox(), 3)
+        self.assertEqual(connect.call_count, 2)
+
+    def test_connection_failure_is_retried_with_backoff(self):
+        """>>> Test that a failed connection reschedules every unsent message with backoff"""
+        self.queue(2)
+        error = smtplib.SMTPServerDisconnected("gone")
+        with mock.patch.object(Connection, "send", side_effect=error):
+            self.assertEqual(email.send_outbox(), 0)
+
+        for message in OutboxMessage.query:
+            self.assertEqual(message.status, "pending")
+            self.assertEqual(message.attempts, 1)
+            self.assertEqual(message.last_error, "gone")
+            delay = (message.next_attempt_at - datetime.utcnow()).total_seconds()
+            self.assertAlmostEqual(delay, self.app.config["MAIL_OUTBOX_RETRY_DELAY"], delta=5)
+
+        # not due yet
+        self.assertEqual(email.send_outbox(), 0)
+
+    def test_refused_message_does_not_block_the_batch(self):
+        """>>> Test that a message refused by the server does not stop the others from being sent"""
+        self.queue(2)
+        refused = smtplib.SMTPRecipientsRefused({"user0@picloud.com": (550, b"no such user")})
+        with mock.patch.object(Connection, "send", side_effect=[refused, None]):
+            self.assertEqual(email.send_outbox(), 1)
+        statuses = {message.recipient: message.status for message in OutboxMessage.query}
+        self.assertEqual(statuses, {"user0@picloud.com": "pending", "user1@picloud.com": "sent"})
+
+    def test_gives_up_after_max_attempts(self):
+        """>>> Test that a message is marked as failed after the last attempt"""
+        self.queue()
+        message = OutboxMessage.query.one()
+        message.attempts = self.app.config["MAIL_OUTBOX_MAX_ATTEMPTS"] - 1
+        self.db.session.commit()
+
+        with mock.patch.object(Connection, "send", side_effect=OSError("unreachable")):
+            email.send_outbox()
+        self.assertEqual(OutboxMessage.query.one().status, "failed")
+
+    def test_claimed_messages_are_leased(self):
+        """>>> Test that a message claimed by a worker is not sent by another one"""
+        self.queue()
+        message = OutboxMessage.query.one()
+        message.next_attempt_at = datetime.utcnow() + timedelta(seconds=60)
+        self.db.session.commit()
+        self.assertEqual(email.send_outbox(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,15 @@
+import threading
+import time
 import unittest
 
-from werkzeug.security import check_password_hash
+from sqlalchemy import event
+from werkzeug.security import check_password_hash, generate_password_hash
 
-from app.mod_auth.models import PiCloudUserAccount
-from tests import BaseTestCase
+from app import db, user_cache, password_hasher
+from app.mod_auth.models import PiCloudUserAccount, load_user
+from app.password_hasher import PasswordHasher, PasswordHasherBusy
+from app.user_cache import KEY_PREFIX, UserCache
+from tests import BaseTestCase, FakeRedis
 
 
 class ModelTestCases(BaseTestCase):
@@ -44,5 +50,171 @@ class ModelTestCases(BaseTestCase):
         self.assertFalse(picloud_user.is_anonymous)
 
 
+class UserCacheTestCases(BaseTestCase):
+    """
+    Tests for the cache of the users loaded by the login manager
+    """
+
+    def setUp(self):
+        super(UserCacheTestCases, self).setUp()
+        self.user = PiCloudUserAccount.query.filter_by(email="picloudman@picloud.com").first()
+        self.user_id = self.user.get_id()
+        self.statements = []
+        event.listen(db.engine, "before_cursor_execute", self.count_statement)
+
+    def tearDown(self):
+        event.remove(db.engine, "before_cursor_execute", self.count_statement)
+        super(UserCacheTestCases, self).tearDown()
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def load_in_new_request(self):
+        db.session.remove()
+        return load_user(self.user_id)
+
+    def test_loaded_user_is_cached(self):
+        """>>> Test that a user is only queried the first time it is loaded"""
+        self.load_in_new_request()
+        self.statements = []
+        user = self.load_in_new_request()
+        self.assertEqual(self.statements, [])
+        self.assertEqual(user.email, "picloudman@picloud.com")
+        self.assertEqual(user.registered_on, self.user.registered_on)
+        self.assertIn(user, db.session)
+
+    def test_password_hash_is_not_cached(self):
+        """>>> Test that the password hash stays out of the shared cache and is loaded when a password is checked"""
+        self.load_in_new_request()
+        self.assertNotIn("password_hash", user_cache.get(self.user_id))
+
+        user = self.load_in_new_request()
+        self.statements = []
+        self.assertTrue(user.verify_password("picloudman"))
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual(user.password_hash, self.user.password_hash)
+
+    def test_changed_user_is_invalidated(self):
+        """>>> Test that a change to the account row is not hidden by the cache"""
+        self.load_in_new_request()
+        user = PiCloudUserAccount.query.get(int(self.user_id))
+        user.admin = True
+        db.session.commit()
+        self.assertIsNone(user_cache.get(self.user_id))
+        self.assertTrue(self.load_in_new_request().admin)
+
+    def test_invalidation_during_load(self):
+        """>>> Test that a process does not cache a user it read before invalidating it"""
+        version = user_cache.version(self.user_id)
+        user_cache.invalidate(self.user_id)
+        user_cache.set(self.user_id, self.user.to_cache(), version)
+        self.assertIsNone(user_cache.get(self.user_id))
+
+    def test_cached_user_expires(self):
+        """>>> Test that cached users expire after the TTL"""
+        user_cache.ttl = 0
+        self.load_in_new_request()
+        self.assertIsNone(user_cache.get(self.user_id))
+
+    def test_least_recently_used_user_is_evicted(self):
+        """>>> Test that the cache holds at most USER_CACHE_SIZE users"""
+        user_cache.max_size = 2
+        for user_id in ("1", "2", "3"):
+            user_cache.set(user_id, dict(user_id=int(user_id)))
+        self.assertIsNone(user_cache.get("1"))
+        self.assertIsNotNone(user_cache.get("3"))
+
+    def test_shared_redis_level(self):
+        """>>> Test that users cached by another process are read from redis"""
+        redis_store = FakeRedis()
+        self.app.config["USER_CACHE_REDIS_ENABLED"] = True
+        other_process, this_process = UserCache(redis_store, self.app), UserCache(redis_store, self.app)
+        other_process.set(self.user_id, self.user.to_cache())
+        self.assertEqual(this_process.get(self.user_id)["email"], "picloudman@picloud.com")
+
+        other_process.invalidate(self.user_id)
+        self.assertNotIn(KEY_PREFIX + self.user_id, redis_store.values)
+
+    def test_user_loaded_before_invalidation_is_not_cached(self):
+        """>>> Test that a user read from the database before it changed is not cached once the change is committed"""
+        redis_store = FakeRedis()
+        self.app.config["USER_CACHE_REDIS_ENABLED"] = True
+        reader, writer = UserCache(redis_store, self.app), UserCache(redis_store, self.app)
+        stale = self.user.to_cache()
+        version = reader.version(self.user_id)
+        writer.invalidate(self.user_id)
+        reader.set(self.user_id, stale, version)
+        self.assertIsNone(UserCache(redis_store, self.app).get(self.user_id))
+
+        reader.set(self.user_id, self.user.to_cache(), reader.version(self.user_id))
+        self.assertIsNotNone(UserCache(redis_store, self.app).get(self.user_id))
+
+    def test_redis_outage(self):
+        """>>> Test that the cache carries on without redis"""
+        self.app.config["USER_CACHE_REDIS_ENABLED"] = True
+        cache = UserCache(FakeRedis(broken=True), self.app)
+        cache.set(self.user_id, dict(user_id=1))
+        cache.invalidate(self.user_id)
+        self.assertIsNone(cache.get(self.user_id))
+
+
+class PasswordHasherTestCases(BaseTestCase):
+    """
+    Tests for hashing passwords off the request threads
+    """
+
+    def setUp(self):
+        super(PasswordHasherTestCases, self).setUp()
+        self.hasher = PasswordHasher(self.app)
+        self.hasher.workers = 1
+        self.hasher.queue_size = 1
+        self.hasher.timeout = 10
+
+    def tearDown(self):
+        self.hasher.shutdown()
+        super(PasswordHasherTestCases, self).tearDown()
+
+    def test_hashes_in_pool(self):
+        """>>> Test that passwords hashed in the pool use the configured parameters"""
+        password_hash = self.hasher.hash("picloudman")
+        self.assertTrue(password_hash.startswith(self.app.config["PASSWORD_HASH_METHOD"] + "$"))
+        self.assertTrue(self.hasher.verify(password_hash, "picloudman"))
+        self.assertFalse(self.hasher.verify(password_hash, "dog"))
+        self.assertFalse(self.hasher.needs_rehash(password_hash))
+
+    def test_hashes_many_in_pool(self):
+        """>>> Test that a batch of passwords is hashed in the pool in order, past the queue size"""
+        password_hashes = self.hasher.hash_many(["one", "two", "three"])
+        self.assertEqual([self.hasher.verify(password_hash, password) for password_hash, password
+                          in zip(password_hashes, ["one", "two", "three"])], [True, True, True])
+
+    def test_saturated_pool_is_busy(self):
+        """>>> Test that hashing fails fast once the pool is saturated"""
+        self.hasher.timeout = 0.2
+        self.hasher.hash("warm up")
+        worker = threading.Thread(target=self.hasher._run, args=(time.sleep, 1))
+        worker.start()
+        time.sleep(0.1)
+        with self.assertRaises(PasswordHasherBusy):
+            self.hasher.hash("picloudman")
+        worker.join()
+
+    def test_outdated_hash_needs_rehash(self):
+        """>>> Test that hashes with other cost parameters or salt length need a rehash"""
+        self.assertTrue(self.hasher.needs_rehash(generate_password_hash("x", "pbkdf2:sha256:500", 16)))
+        self.assertTrue(self.hasher.needs_rehash(generate_password_hash("x", self.hasher.method, 8)))
+
+    def test_login_rehashes_outdated_hash(self):
+        """>>> Test that a user is rehashed with the current parameters when logging in"""
+        user = PiCloudUserAccount.query.filter_by(email="picloudman@picloud.com").first()
+        user.password_hash = generate_password_hash("picloudman", "pbkdf2:sha256:500", 8)
+        db.session.commit()
+
+        self.login()
+        user = PiCloudUserAccount.query.filter_by(email="picloudman@picloud.com").first()
+        self.assertFalse(password_hasher.needs_rehash(user.password_hash))
+        self.assertTrue(user.verify_password("picloudman"))
+
+
 if __name__ == "__main__":
     unittest.main()
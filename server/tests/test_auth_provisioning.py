@@ -0,0 +1,69 @@
+"""
+Tests for the bulk import of user accounts
+"""
+import io
+import json
+import unittest
+
+from app.mod_auth.models import PiCloudUserAccount, PiCloudUserProfile
+from app.mod_auth.provisioning import read_users, import_users
+from tests import BaseTestCase
+
+CSV_USERS = """first_name,last_name,email,password,confirmed
+ada,lovelace,ada@picloud.com,adapassword,true
+alan,turing,alan@picloud.com,alanpassword,
+grace,hopper,grace@picloud.com,gracepassword,no
+"""
+
+
+class ImportUsersTestCases(BaseTestCase):
+    """
+    Tests for manage.py import_users
+    """
+
+    def test_import_csv(self):
+        """>>> Test that the accounts of a CSV file are imported with their profiles"""
+        result = import_users(read_users(io.StringIO(CSV_USERS), "csv"), batch_size=2)
+        self.assertEqual(result, dict(imported=3, duplicates=0, invalid=0))
+
+        ada = PiCloudUserAccount.query.filter_by(email="ada@picloud.com").one()
+        self.assertEqual(ada.user_profile.first_name, "ada")
+        self.assertEqual(ada.username, "ada@picloud.com")
+        self.assertTrue(ada.confirmed)
+        self.assertIsNotNone(ada.confirmed_on)
+        self.assertTrue(ada.verify_password("adapassword"))
+        self.assertFalse(ada.verify_password("alanpassword"))
+
+        alan = PiCloudUserAccount.query.filter_by(email="alan@picloud.com").one()
+        self.assertFalse(alan.confirmed)
+        self.assertNotEqual(ada.uid, alan.uid)
+
+    def test_import_ndjson(self):
+        """>>> Test that the accounts of an NDJSON file are imported"""
+        lines = [json.dumps(dict(first_name="ada", last_name="lovelace", email="ada@picloud.com",
+                                 password="adapassword", admin=True)), ""]
+        result = import_users(read_users(io.StringIO("\n".join(lines)), "ndjson"))
+        self.assertEqual(result["imported"], 1)
+        self.assertTrue(PiCloudUserAccount.query.filter_by(email="ada@picloud.com").one().admin)
+
+    def test_import_skips_duplicates_and_invalid_accounts(self):
+        """>>> Test that existing accounts, repeated accounts and accounts missing fields are skipped"""
+        users = [
+            dict(first_name="picloud", last_name="man", email="picloudman@picloud.com", password="picloudman"),
+            dict(first_name="ada", last_name="lovelace", email="ada@picloud.com", password="adapassword"),
+            dict(first_name="ada", last_name="lovelace", email=" ada@picloud.com ", password="adapassword"),
+            dict(first_name="alan", last_name="", email="alan@picloud.com", password="alanpassword"),
+        ]
+        result = import_users(users, batch_size=3)
+        self.assertEqual(result, dict(imported=1, duplicates=2, invalid=1))
+        self.assertEqual(PiCloudUserProfile.query.filter_by(email="ada@picloud.com").count(), 1)
+        self.assertEqual(PiCloudUserAccount.query.count(), 2)
+
+    def test_unknown_format_is_rejected(self):
+        """>>> Test that only CSV and NDJSON files can be read"""
+        with self.assertRaises(ValueError):
+            list(read_users(io.StringIO(""), "xml"))
+
+
+if __name__ == "__main__":
+    unittest.main()
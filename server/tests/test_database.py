@@ -0,0 +1,86 @@
+"""
+Tests for the engine options and the routing of reads to the replica
+"""
+import unittest
+
+from sqlalchemy import select, inspect
+from sqlalchemy.engine.url import make_url
+
+from app import db
+from app.database import REPLICA_BIND
+from app.mod_auth.models import PiCloudUserAccount
+from tests import BaseTestCase
+
+
+class EngineOptionsTestCases(BaseTestCase):
+    """
+    Tests for the pool and timeout options of the engines
+    """
+
+    def engine_options(self, uri):
+        options = {}
+        db.apply_pool_defaults(self.app, options)
+        db.apply_driver_hacks(self.app, make_url(uri), options)
+        return options
+
+    def test_postgres_options(self):
+        """>>> Test that the pool and the statement timeout of PostgreSQL come from the configuration"""
+        self.app.config.update(SQLALCHEMY_POOL_SIZE=3, SQLALCHEMY_MAX_OVERFLOW=2, SQLALCHEMY_POOL_RECYCLE=600,
+                               SQLALCHEMY_POOL_PRE_PING=True, SQLALCHEMY_STATEMENT_TIMEOUT=5000,
+                               DATABASE_CONNECT_OPTIONS=dict(connect_timeout=3))
+        options = self.engine_options("postgresql://picloud@localhost/picloud")
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_recycle"], 600)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"], dict(connect_timeout=3, options="-c statement_timeout=5000"))
+
+    def test_sqlite_options(self):
+        """>>> Test that the pool size options are not passed to the pools of SQLite"""
+        self.app.config.update(SQLALCHEMY_POOL_SIZE=3, SQLALCHEMY_MAX_OVERFLOW=2, SQLALCHEMY_POOL_PRE_PING=True)
+        options = self.engine_options("sqlite:///:memory:")
+        for option in ("pool_size", "max_overflow", "pool_pre_ping"):
+            self.assertNotIn(option, options)
+
+
+class ReplicaRoutingTestCases(BaseTestCase):
+    """
+    Tests for sending the reads of read only requests to the replica
+    """
+
+    def setUp(self):
+        self.app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: "sqlite://"}
+        super(ReplicaRoutingTestCases, self).setUp()
+        self.replica = db.get_engine(self.app, bind=REPLICA_BIND)
+        self.mapper = inspect(PiCloudUserAccount)
+        self.query = select([PiCloudUserAccount.__table__])
+        # every request starts with a new session, the one of setUp has written
+        db.session.remove()
+
+    def bind(self, clause):
+        return db.session.get_bind(self.mapper, clause)
+
+    def test_get_requests_read_from_replica(self):
+        """>>> Test that the reads of a GET request go to the replica"""
+        with self.app.test_request_context(method="GET"):
+            self.assertIs(self.bind(self.query), self.replica)
+            self.assertIs(self.bind(self.query.with_for_update()), db.engine)
+            db.session.remove()
+
+    def test_other_requests_use_primary(self):
+        """>>> Test that the reads of a POST request and outside of requests go to the primary"""
+        self.assertIs(self.bind(self.query), db.engine)
+        with self.app.test_request_context(method="POST"):
+            self.assertIs(self.bind(self.query), db.engine)
+            db.session.remove()
+
+    def test_reads_after_write_use_primary(self):
+        """>>> Test that a GET request that wrote reads its writes from the primary"""
+        with self.app.test_request_context(method="GET"):
+            self.assertIs(self.bind(PiCloudUserAccount.__table__.update().values(confirmed=True)), db.engine)
+            self.assertIs(self.bind(self.query), db.engine)
+            db.session.remove()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests for the logging pipeline, records are written by a background thread
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app import log_pipeline
+from app.log_pipeline import JsonFormatter, ThrottledMailHandler, create_handlers
+from tests import BaseTestCase
+
+
+class BlockingHandler(logging.Handler):
+    """
+    Handler that waits to be released before it handles a record, as a slow disk or mail server would
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.unblock = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.unblock.wait(5)
+        self.records.append(record)
+
+
+class LoggingTestCases(BaseTestCase):
+    """
+    Tests for queueing records and writing them as JSON lines
+    """
+
+    def setUp(self):
+        super(LoggingTestCases, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.addCleanup(log_pipeline.stop)
+
+    def configure(self, **config):
+        self.app.config.update(config)
+        log_pipeline.init_app(self.app)
+
+    def read_log(self):
+        log_pipeline.stop()
+        with open(self.app.config["LOG_FILE"]) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_json_lines(self):
+        """>>> Test that records are written as JSON with the request they were logged in and their traceback"""
+        self.configure(LOG_FILE=os.path.join(self.log_dir, "logs", "picloud.log"))
+        with self.app.test_request_context("/media/usb", method="POST"):
+            try:
+                raise ValueError("bad drive")
+            except ValueError:
+                self.app.logger.exception("Could not list %s", "usb", extra=dict(drive="usb"))
+
+        entry, = self.read_log()
+        self.assertEqual((entry["level"], entry["logger"], entry["message"]), ("ERROR", "app", "Could not list usb"))
+        self.assertEqual(entry["request"], dict(method="POST", path="/media/usb", remote_addr=None))
+        self.assertIn("ValueError: bad drive", entry["exception"])
+        self.assertEqual(entry["drive"], "usb")
+        self.assertTrue(entry["time"].endswith("Z"))
+
+    def test_login_is_logged(self):
+        """>>> Test that the auth views log to the pipeline instead of printing"""
+        self.configure(LOG_FILE=os.path.join(self.log_dir, "picloud.log"), LOG_LEVEL="INFO")
+        self.client.post("auth/login", data=dict(email="picloudman@picloud.com", password="wrong"))
+        messages = [entry["message"] for entry in self.read_log()]
+        self.assertIn("Failed login from 127.0.0.1", messages)
+        self.assertNotIn("picloudman", " ".join(messages))
+
+    def test_logging_does_not_wait(self):
+        """>>> Test that records are queued while the handlers are busy and dropped once the queue is full"""
+        self.configure(LOG_QUEUE_SIZE=2)
+        blocking = BlockingHandler()
+        log_pipeline.handlers = [blocking]
+        for number in range(5):
+            self.app.logger.error("error %d", number)
+        dropped = log_pipeline.dropped
+        self.assertGreater(dropped, 0)
+
+        blocking.unblock.set()
+        log_pipeline.stop()
+        self.app.logger.error("after")
+        log_pipeline.stop()
+        messages = [record.getMessage() for record in blocking.records]
+        self.assertEqual(messages[0], "error 0")
+        self.assertIn("log records were dropped as the queue was full", messages[-2])
+        self.assertEqual(messages[-1], "after")
+        # the records kept, the warning about the others and the last one
+        self.assertEqual(len(messages), 5 - dropped + 2)
+
+    def test_forked_process_starts_listener(self):
+        """>>> Test that a process without the background thread of the pipeline starts its own"""
+        self.configure()
+        self.app.logger.error("in the parent")
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            self.app.logger.error("in the child")
+            self.assertEqual(log_pipeline._pid, os.getpid())
+            self.assertTrue(log_pipeline._listener._thread.is_alive())
+
+    def test_handlers(self):
+        """>>> Test that errors are only mailed out of debug mode and when there are administrators"""
+        self.app.config.update(LOG_STREAM=True, LOG_MAIL_ADMINS=["admin@picloud.com"])
+        self.assertEqual([type(handler) for handler in create_handlers(self.app)], [logging.StreamHandler])
+        self.app.debug = False
+        handlers = create_handlers(self.app)
+        self.assertIsInstance(handlers[-1], ThrottledMailHandler)
+        self.assertEqual((handlers[-1].host, handlers[-1].port, handlers[-1].use_ssl),
+                         ("smtp.googlemail.com", 465, True))
+        self.assertIsInstance(handlers[0].formatter, JsonFormatter)
+
+
+class ThrottledMailTestCases(unittest.TestCase):
+    """
+    Tests for mailing errors without flooding the administrators
+    """
+
+    def setUp(self):
+        self.handler = ThrottledMailHandler("localhost", 25, "picloud@localhost", ["admin@localhost"],
+                                            interval=60, burst=2)
+        self.send = mock.patch.object(self.handler, "send").start()
+        self.addCleanup(mock.patch.stopall)
+        self.now = mock.patch("time.monotonic", return_value=1000.0).start()
+
+    @staticmethod
+    def record(message, lineno=10, exception=None):
+        exc_info = (exception, exception(), None) if exception else None
+        return logging.LogRecord("app", logging.ERROR, "views.py", lineno, message, None, exc_info)
+
+    def test_repeats_are_counted(self):
+        """>>> Test that an error is mailed once per interval with the number of times it repeated"""
+        for _ in range(3):
+            self.handler.handle(self.record("failed", exception=KeyError))
+        self.assertEqual(self.send.call_count, 1)
+
+        self.now.return_value += 61
+        self.handler.handle(self.record("failed", exception=KeyError))
+        self.assertEqual(self.send.call_count, 2)
+        self.assertEqual(self.send.call_args[0][1], 2)
+
+    def test_burst(self):
+        """>>> Test that at most burst mails are sent per interval whatever the errors"""
+        for lineno in range(5):
+            self.handler.handle(self.record("failed", lineno=lineno))
+        self.assertEqual(self.send.call_count, 2)
+        self.now.return_value += 61
+        self.handler.handle(self.record("failed", lineno=4))
+        self.assertEqual(self.send.call_args[0][1], 1)
+
+    def test_send_failure(self):
+        """>>> Test that a mail server that can not be reached does not raise"""
+        self.send.side_effect = OSError("connection refused")
+        with mock.patch.object(logging, "raiseExceptions", False):
+            self.handler.handle(self.record("failed"))
+
+    def test_message(self):
+        """>>> Test that the mail has the error in its subject and the repeats in its body"""
+        mock.patch.stopall()
+        with mock.patch("smtplib.SMTP") as smtp:
+            self.handler.send(self.record("disk full\nmore"), 3)
+        message = smtp.return_value.__enter__.return_value.send_message.call_args[0][0]
+        self.assertEqual(message["Subject"], "PiCloud app failure: disk full")
+        self.assertEqual(message["To"], "admin@localhost")
+        self.assertIn("Logged 3 more times", message.get_content())
+
+
+if __name__ == "__main__":
+    unittest.main()
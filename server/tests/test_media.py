@@ -0,0 +1,657 @@
+"""
+Tests for the media module, which serves the drives mounted in the media path
+"""
+import hashlib
+import io
+import json
+import os
+import unittest
+import zipfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import db, media_tree
+from app.media_tree import IGNORED_NAMES, UPLOADS_DIR_NAME
+from app.mod_media.content_store import prune_store
+from app.mod_media.derivatives import Image, derivative_path, evict, PENDING_SUFFIX
+from app.mod_media.models import ContentBlob, ContentBlobOwner
+from app.mod_media.uploads import expire_uploads
+from app.mod_auth.models import AsyncOperation, PiCloudUserAccount, PiCloudUserProfile
+from tests import MediaTreeTestCase
+
+
+class TestDirectoryListing(MediaTreeTestCase):
+    """
+    Tests for the paginated directory listing api
+    """
+
+    def setUp(self):
+        super(TestDirectoryListing, self).setUp()
+        for number in range(5):
+            self.write_file("usb/photos/photo{}.jpg".format(number), b"p" * (5 - number))
+
+    def get_listing(self, path, **params):
+        response = self.client.get(self.media_url("api/listing/" + path), query_string=params)
+        return response, json.loads(response.data.decode())
+
+    def test_lists_directory_entries(self):
+        """>>> Test that the listing returns the entries of a directory with their stat data"""
+        response, data = self.get_listing("usb")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["name"] for entry in data["entries"]], ["photos", "readme.txt"])
+        self.assertTrue(data["entries"][0]["is_dir"])
+        self.assertEqual(data["entries"][1]["size"], len(b"picloud"))
+        self.assertIsNone(data["next_cursor"])
+
+    def test_pages_with_cursor(self):
+        """>>> Test that following the cursor returns every entry exactly once"""
+        names, cursor = [], None
+        while True:
+            params = dict(limit=3)
+            if cursor:
+                params["cursor"] = cursor
+            _, data = self.get_listing("usb/photos", **params)
+            names.extend(entry["name"] for entry in data["entries"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(names), 7)
+
+    def test_sorts_by_size_descending(self):
+        """>>> Test that entries can be sorted by size in descending order across pages"""
+        _, first = self.get_listing("usb/photos", sort="size", order="desc", limit=2)
+        _, second = self.get_listing("usb/photos", sort="size", order="desc", limit=2, cursor=first["next_cursor"])
+        sizes = [entry["size"] for entry in first["entries"] + second["entries"]]
+        self.assertEqual(sizes, [20, 10, 5, 4])
+
+    def test_cursor_must_match_sort(self):
+        """>>> Test that a cursor can not be reused with a different sort order"""
+        _, data = self.get_listing("usb/photos", limit=2)
+        response, _ = self.get_listing("usb/photos", sort="size", cursor=data["next_cursor"])
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_directory(self):
+        """>>> Test that listing a missing directory returns 404"""
+        response, data = self.get_listing("usb/videos")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(data["success"])
+
+    def test_unchanged_directory_is_not_written(self):
+        """>>> Test that listing an unchanged, a missing or a file path does not open a write transaction"""
+        self.get_listing("usb")
+        self.get_listing("usb/photos")
+        with mock.patch.object(media_tree, "update") as update:
+            self.get_listing("usb")
+            self.get_listing("usb/photos")
+            self.get_listing("usb/videos")
+            self.get_listing("usb/readme.txt")
+        self.assertFalse(update.called)
+
+        self.touch_dir("usb/photos", 10)
+        with mock.patch.object(media_tree, "update", wraps=media_tree.update) as update:
+            self.get_listing("usb/photos")
+        update.assert_called_once_with(dirs=["usb/photos"], force=False)
+
+    def test_rejects_parent_directory(self):
+        """>>> Test that paths escaping the media path are rejected"""
+        response, _ = self.get_listing("usb/../../etc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_listing_not_modified(self):
+        """>>> Test that a client with the current page of an unchanged directory gets a 304"""
+        response, _ = self.get_listing("usb/photos", limit=2)
+        etag = response.headers["ETag"]
+        with mock.patch.object(media_tree, "list_page") as list_page:
+            response = self.client.get(self.media_url("api/listing/usb/photos"), query_string=dict(limit=2),
+                                       headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(list_page.called)
+
+        self.write_file("usb/photos/photo5.jpg", b"p")
+        self.touch_dir("usb/photos", 10)
+        response = self.client.get(self.media_url("api/listing/usb/photos"), query_string=dict(limit=2),
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_folder_page_not_modified(self):
+        """>>> Test that the page of a folder is not rendered again for a client that has the current one"""
+        etag = self.client.get(self.media_url("usb/photos")).headers["ETag"]
+        with mock.patch.object(media_tree, "children") as children:
+            response = self.client.get(self.media_url("usb/photos"), headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(children.called)
+
+
+class TestMediaSearch(MediaTreeTestCase):
+    """
+    Tests for searching the names of the files on the drives
+    """
+
+    def setUp(self):
+        super(TestMediaSearch, self).setUp()
+        for directory in ("docs", "videos", "holidays"):
+            os.makedirs(os.path.join(self.media_path, "usb", directory))
+        self.write_file("usb/photos/holiday_beach.JPG", b"b" * 100)
+        self.write_file("usb/docs/Holiday plan.txt", b"p" * 5)
+        self.write_file("usb/videos/holiday.mp4", b"v" * 1000)
+
+    def search(self, **params):
+        response = self.client.get(self.media_url("api/search"), query_string=params)
+        return response, json.loads(response.data.decode())
+
+    def paths(self, **params):
+        response, data = self.search(**params)
+        self.assertEqual(response.status_code, 200)
+        return [result["path"] for result in data["results"]]
+
+    def test_substring_search(self):
+        """>>> Test that a substring matches anywhere in a name regardless of case"""
+        self.assertEqual(self.paths(q="liday"), ["usb/docs/Holiday plan.txt", "usb/holidays",
+                                                 "usb/photos/holiday_beach.JPG", "usb/videos/holiday.mp4"])
+
+    def test_short_substring_search(self):
+        """>>> Test that terms shorter than a trigram are matched by scanning the names"""
+        self.assertEqual(self.paths(q="_b"), ["usb/photos/holiday_beach.JPG"])
+
+    def test_substring_search_without_trigram_index(self):
+        """>>> Test that searches still work when sqlite has no trigram index"""
+        media_tree.connection
+        media_tree._local.searchable = False
+        self.assertEqual(self.paths(q="beach"), ["usb/photos/holiday_beach.JPG"])
+
+    def test_prefix_search(self):
+        """>>> Test that a prefix only matches the start of a name"""
+        self.assertEqual(self.paths(q="holiday.", mode="prefix"), ["usb/videos/holiday.mp4"])
+        self.assertEqual(self.paths(q="liday", mode="prefix"), [])
+
+    def test_glob_search(self):
+        """>>> Test that glob patterns are matched against the whole name"""
+        self.assertEqual(self.paths(q="*day*.mp4", mode="glob"), ["usb/videos/holiday.mp4"])
+        self.assertEqual(self.paths(q="*.jpg", mode="glob"), ["usb/photos/one.jpg", "usb/photos/two.jpg"])
+
+    def test_filters(self):
+        """>>> Test the extension, size, modification time and type filters"""
+        self.assertEqual(self.paths(q="holiday", ext="jpg,.MP4"), ["usb/photos/holiday_beach.JPG",
+                                                                   "usb/videos/holiday.mp4"])
+        self.assertEqual(self.paths(min_size=10, max_size=100), ["usb/photos/holiday_beach.JPG",
+                                                                 "usb/photos/one.jpg", "usb/photos/two.jpg"])
+        self.assertEqual(self.paths(q="holiday", type="dir"), ["usb/holidays"])
+        self.assertEqual(self.paths(q="holiday", modified_before=0), [])
+
+    def test_search_below_path(self):
+        """>>> Test that a search can be limited to a directory"""
+        self.assertEqual(self.paths(q="holiday", path="usb/videos"), ["usb/videos/holiday.mp4"])
+
+    def test_search_picks_up_changes(self):
+        """>>> Test that the search index follows files being added and removed"""
+        self.assertEqual(self.paths(q="holiday", type="file", ext="mp4"), ["usb/videos/holiday.mp4"])
+        os.remove(os.path.join(self.media_path, "usb", "videos", "holiday.mp4"))
+        self.write_file("usb/videos/holiday2.mp4", b"v")
+        media_tree.refresh()
+        self.assertEqual(self.paths(q="holiday", type="file", ext="mp4"), ["usb/videos/holiday2.mp4"])
+
+    def test_pagination(self):
+        """>>> Test that the cursor returns the next page of results"""
+        _, data = self.search(q="holiday", limit=3)
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(self.paths(q="holiday", cursor=data["next_cursor"]), ["usb/videos/holiday.mp4"])
+
+    def test_invalid_search(self):
+        """>>> Test that invalid parameters are rejected"""
+        self.assertEqual(self.search(q="x", mode="regex")[0].status_code, 400)
+        self.assertEqual(self.search(min_size="big")[0].status_code, 400)
+        self.assertEqual(self.search(path="../etc")[0].status_code, 400)
+
+
+class TestFileDownload(MediaTreeTestCase):
+    """
+    Tests for downloading files with conditional and range requests
+    """
+
+    def setUp(self):
+        super(TestFileDownload, self).setUp()
+        self.content = bytes(range(256)) * 4
+        self.write_file("usb/video.mp4", self.content)
+        self.login()
+
+    def download(self, path="usb/video.mp4", **headers):
+        response = self.client.get(self.media_url("download/" + path), headers=headers)
+        response.direct_passthrough = False
+        return response
+
+    def test_download_requires_login(self):
+        """>>> Test that anonymous users can not download files"""
+        self.client.get("auth/logout")
+        response = self.client.get(self.media_url("download/usb/video.mp4"))
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_downloads_whole_file(self):
+        """>>> Test that the whole file is sent with validators"""
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+        self.assertIsNotNone(response.headers.get("ETag"))
+        self.assertIsNotNone(response.headers.get("Last-Modified"))
+
+    def test_missing_file(self):
+        """>>> Test that a missing file or a directory returns 404"""
+        self.assertEqual(self.download("usb/missing.mp4").status_code, 404)
+        self.assertEqual(self.download("usb/photos").status_code, 404)
+
+    def test_if_none_match_returns_304(self):
+        """>>> Test that a matching If-None-Match returns 304 without a body"""
+        etag = self.download().headers["ETag"]
+        response = self.download(**{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+    def test_single_range(self):
+        """>>> Test that a single range returns 206 with the requested bytes"""
+        response = self.download(Range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[10:20])
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/1024")
+
+    def test_suffix_range(self):
+        """>>> Test that a suffix range returns the end of the file"""
+        response = self.download(Range="bytes=-100")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[-100:])
+
+    def test_multiple_ranges(self):
+        """>>> Test that multiple ranges are sent as multipart/byteranges"""
+        response = self.download(Range="bytes=0-9,100-109")
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.headers["Content-Type"].startswith("multipart/byteranges; boundary="))
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertIn(b"Content-Range: bytes 0-9/1024\r\n\r\n" + self.content[:10], response.data)
+        self.assertIn(b"Content-Range: bytes 100-109/1024\r\n\r\n" + self.content[100:110], response.data)
+
+    def test_unsatisfiable_range(self):
+        """>>> Test that a range past the end of the file returns 416"""
+        response = self.download(Range="bytes=5000-6000")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */1024")
+
+    def test_if_range_mismatch_sends_whole_file(self):
+        """>>> Test that a stale If-Range validator returns the whole file"""
+        response = self.download(Range="bytes=10-19", **{"If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content)
+
+
+class TestFolderArchive(MediaTreeTestCase):
+    """
+    Tests for downloading folders as streamed ZIP archives
+    """
+
+    def setUp(self):
+        super(TestFolderArchive, self).setUp()
+        self.write_file("usb/notes.txt", b"notes " * 100)
+        os.makedirs(os.path.join(self.media_path, "usb", "empty"))
+        self.login()
+
+    def download(self, path="usb"):
+        return self.client.get(self.media_url("archive/" + path))
+
+    def test_archive_requires_login(self):
+        """>>> Test that anonymous users can not download folders"""
+        self.client.get("auth/logout")
+        self.assertNotEqual(self.download().status_code, 200)
+
+    def test_archives_folder(self):
+        """>>> Test that every file below the folder is in the archive with its content"""
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/zip")
+        self.assertIn('filename="usb.zip"', response.headers["Content-Disposition"])
+        self.assertIsNone(response.headers.get("Content-Length"))
+
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()), ["usb/empty/", "usb/notes.txt", "usb/photos/one.jpg",
+                                                      "usb/photos/two.jpg", "usb/readme.txt"])
+        self.assertEqual(archive.read("usb/notes.txt"), b"notes " * 100)
+        self.assertEqual(archive.read("usb/photos/two.jpg"), b"2" * 20)
+
+    def test_compressed_media_is_stored(self):
+        """>>> Test that already compressed media is stored and other files are deflated"""
+        archive = zipfile.ZipFile(io.BytesIO(self.download().data))
+        self.assertEqual(archive.getinfo("usb/photos/one.jpg").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo("usb/notes.txt").compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_archives_subfolder(self):
+        """>>> Test that archiving a subfolder only includes that folder"""
+        archive = zipfile.ZipFile(io.BytesIO(self.download("usb/photos").data))
+        self.assertEqual(sorted(archive.namelist()), ["photos/one.jpg", "photos/two.jpg"])
+
+    def test_skips_symlinks(self):
+        """>>> Test that symlinks are not followed out of the folder"""
+        outside = os.path.join(self.media_path, "secret.txt")
+        with open(outside, "wb") as f:
+            f.write(b"secret")
+        os.symlink(outside, os.path.join(self.media_path, "usb", "link.txt"))
+        archive = zipfile.ZipFile(io.BytesIO(self.download().data))
+        self.assertNotIn("usb/link.txt", archive.namelist())
+
+    def test_files_older_than_zip_dates(self):
+        """>>> Test that a file modified before 1980, which a ZIP can not date, is archived with the earliest date"""
+        old_file = os.path.join(self.media_path, "usb", "notes.txt")
+        os.utime(old_file, (0, 0))
+        archive = zipfile.ZipFile(io.BytesIO(self.download().data))
+        self.assertEqual(archive.getinfo("usb/notes.txt").date_time, (1980, 1, 1, 0, 0, 0))
+        self.assertEqual(archive.read("usb/notes.txt"), b"notes " * 100)
+
+    def test_non_ascii_folder_name(self):
+        """>>> Test that the name of a folder with accents and quotes is sent in UTF-8 with an ASCII fallback"""
+        os.makedirs(os.path.join(self.media_path, "usb", 'Fotos "Año"'))
+        response = self.download('usb/Fotos "Año"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Disposition"],
+                         "attachment; filename=\"Fotos Ano.zip\"; filename*=UTF-8''Fotos%20%22A%C3%B1o%22.zip")
+
+    def test_missing_folder(self):
+        """>>> Test that a missing folder or a file returns 404"""
+        self.assertEqual(self.download("usb/missing").status_code, 404)
+        self.assertEqual(self.download("usb/readme.txt").status_code, 404)
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class TestImageDerivatives(MediaTreeTestCase):
+    """
+    Tests for serving thumbnails and previews of images
+    """
+
+    def setUp(self):
+        super(TestImageDerivatives, self).setUp()
+        self.cache_path = os.path.join(self.tmp_dir, "derivatives")
+        self.app.config["MEDIA_DERIVATIVE_CACHE_PATH"] = self.cache_path
+        Image.new("RGB", (2000, 1000), (200, 10, 10)).save(os.path.join(self.media_path, "usb", "photos",
+                                                                         "big.jpg"))
+        self.login()
+
+    def get(self, path="usb/photos/big.jpg", variant="thumbnail", **headers):
+        response = self.client.get(self.media_url("derivatives/{}/{}".format(variant, path)), headers=headers)
+        response.direct_passthrough = False
+        return response
+
+    def test_derivatives_require_login(self):
+        """>>> Test that anonymous users can not fetch thumbnails"""
+        self.client.get("auth/logout")
+        self.assertNotEqual(self.get().status_code, 200)
+
+    def test_builds_thumbnail(self):
+        """>>> Test that a thumbnail is built, fits in its box and is cached"""
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/jpeg")
+        image = Image.open(io.BytesIO(response.data))
+        self.assertEqual(image.size, (256, 128))
+
+        cached = self.get(**{"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(cached.status_code, 304)
+
+    def test_build_is_tracked(self):
+        """>>> Test that building a derivative is recorded as an operation of the user that requested it"""
+        self.get()
+        operation = AsyncOperation.query.filter_by(operation="derivative").one()
+        self.assertEqual((operation.target, operation.status_code), ("usb/photos/big.jpg", "ok"))
+        self.assertEqual((operation.completed, operation.total), (1, 1))
+        self.assertEqual(operation.user_profile.email, "picloudman@picloud.com")
+
+        self.get()
+        self.assertEqual(AsyncOperation.query.filter_by(operation="derivative").count(), 1)
+
+    def test_variants_have_their_own_size(self):
+        """>>> Test that previews are larger than thumbnails"""
+        image = Image.open(io.BytesIO(self.get(variant="preview").data))
+        self.assertEqual(image.size, (1280, 640))
+
+    def test_pending_derivative(self):
+        """>>> Test that a derivative that is being built returns 202"""
+        path = derivative_path(os.stat(os.path.join(self.media_path, "usb", "photos", "big.jpg")), "thumbnail")
+        os.makedirs(os.path.dirname(path))
+        open(path + PENDING_SUFFIX, "w").close()
+        response = self.get()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    def test_unreadable_image(self):
+        """>>> Test that images that can not be decoded are reported instead of rebuilt"""
+        self.assertEqual(self.get("usb/photos/one.jpg").status_code, 415)
+        self.assertEqual(self.get("usb/photos/one.jpg").status_code, 415)
+
+    def test_no_derivatives(self):
+        """>>> Test that unknown variants, files that are not images and missing files return 404"""
+        self.assertEqual(self.get(variant="poster").status_code, 404)
+        self.assertEqual(self.get("usb/readme.txt").status_code, 404)
+        self.assertEqual(self.get("usb/photos/missing.jpg").status_code, 404)
+
+    def test_evicts_least_recently_used(self):
+        """>>> Test that the least recently used derivatives are evicted once the cache is too large"""
+        os.makedirs(os.path.join(self.cache_path, "ab"))
+        for index in range(4):
+            path = os.path.join(self.cache_path, "ab", "{}.jpg".format(index))
+            with open(path, "wb") as f:
+                f.write(b"d" * 100)
+            os.utime(path, (1000 + index, 1000))
+
+        self.assertEqual(evict(self.cache_path, 400), 0)
+        self.assertEqual(evict(self.cache_path, 300), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_path, "ab"))), ["2.jpg", "3.jpg"])
+
+
+class TestResumableUpload(MediaTreeTestCase):
+    """
+    Tests for resumable chunked uploads
+    """
+
+    def setUp(self):
+        super(TestResumableUpload, self).setUp()
+        self.content = os.urandom(1000)
+        self.login()
+
+    def start_upload(self, path="usb/photos/new.jpg", size=None, **data):
+        data.update(path=path, size=len(self.content) if size is None else size)
+        response = self.client.post(self.media_url("uploads"), data=json.dumps(data),
+                                    content_type="application/json")
+        return response, json.loads(response.data.decode())
+
+    def send_chunk(self, upload_id, start, stop):
+        response = self.client.put(self.media_url("uploads/{}".format(upload_id)),
+                                   query_string=dict(offset=start), data=self.content[start:stop])
+        return response, json.loads(response.data.decode())
+
+    def finalize(self, upload_id):
+        response = self.client.post(self.media_url("uploads/{}/finalize".format(upload_id)))
+        return response, json.loads(response.data.decode())
+
+    def test_upload_in_chunks_out_of_order(self):
+        """>>> Test that chunks sent out of order are assembled into the target file"""
+        response, upload = self.start_upload()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(upload["status"], "pending")
+
+        self.send_chunk(upload["id"], 600, 1000)
+        _, state = self.send_chunk(upload["id"], 0, 600)
+        self.assertEqual(state["received"], [[0, 1000]])
+        self.assertEqual(state["completed"], 1000)
+
+        response, state = self.finalize(upload["id"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(state["status"], "ok")
+        with open(os.path.join(self.media_path, "usb", "photos", "new.jpg"), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_progress_reports_missing_ranges(self):
+        """>>> Test that the progress of an interrupted upload shows what has been received"""
+        _, upload = self.start_upload()
+        self.send_chunk(upload["id"], 0, 100)
+        self.send_chunk(upload["id"], 500, 700)
+
+        response = self.client.get(self.media_url("uploads/{}".format(upload["id"])))
+        state = json.loads(response.data.decode())
+        self.assertEqual(state["received"], [[0, 100], [500, 700]])
+        self.assertEqual(state["completed"], 300)
+
+    def test_incomplete_upload_can_not_be_finalized(self):
+        """>>> Test that an upload missing chunks is not finalized"""
+        _, upload = self.start_upload()
+        self.send_chunk(upload["id"], 0, 100)
+        response, _ = self.finalize(upload["id"])
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(os.path.exists(os.path.join(self.media_path, "usb", "photos", "new.jpg")))
+
+    def test_chunk_outside_upload(self):
+        """>>> Test that a chunk past the end of the upload is rejected"""
+        _, upload = self.start_upload(size=10)
+        response, _ = self.send_chunk(upload["id"], 0, 100)
+        self.assertEqual(response.status_code, 416)
+
+    def test_existing_target_is_rejected(self):
+        """>>> Test that an upload can not overwrite an existing file"""
+        response, _ = self.start_upload(path="usb/readme.txt")
+        self.assertEqual(response.status_code, 409)
+
+    def test_target_outside_media_path_is_rejected(self):
+        """>>> Test that an upload can not be written through a symlink that leaves the media path"""
+        outside = os.path.join(self.tmp_dir, "outside")
+        os.makedirs(outside)
+        os.symlink(outside, os.path.join(self.media_path, "usb", "link"))
+        response, _ = self.start_upload(path="usb/link/new.jpg")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_internal_directories_are_rejected(self):
+        """>>> Test that an upload can not target the directories kept on the drive for uploads and content"""
+        for directory in IGNORED_NAMES:
+            os.makedirs(os.path.join(self.media_path, "usb", directory), exist_ok=True)
+            response, _ = self.start_upload(path="usb/{}/new.jpg".format(directory))
+            self.assertEqual(response.status_code, 400)
+
+    def test_cancel_upload(self):
+        """>>> Test that a cancelled upload can not receive chunks"""
+        _, upload = self.start_upload()
+        self.client.delete(self.media_url("uploads/{}".format(upload["id"])))
+        response, _ = self.send_chunk(upload["id"], 0, 100)
+        self.assertEqual(response.status_code, 409)
+
+    def test_abandoned_upload_expires(self):
+        """>>> Test that uploads left without chunks are cancelled and stray temporary files removed"""
+        _, abandoned = self.start_upload()
+        _, active = self.start_upload(path="usb/photos/other.jpg")
+        AsyncOperation.query.filter_by(id=abandoned["id"]).update(
+            dict(date_modified=datetime.utcnow() - timedelta(hours=2)), synchronize_session=False)
+        db.session.commit()
+        uploads_dir = os.path.join(self.media_path, "usb", UPLOADS_DIR_NAME)
+        temp_files = os.listdir(uploads_dir)
+        stray = os.path.join(uploads_dir, "stray.part")
+        open(stray, "w").close()
+        os.utime(stray, (0, 0))
+
+        self.assertEqual(expire_uploads(3600), 1)
+        self.assertEqual(AsyncOperation.query.get(abandoned["id"]).status_code, "error")
+        self.assertEqual(AsyncOperation.query.get(active["id"]).status_code, "pending")
+        self.assertEqual(len(os.listdir(uploads_dir)), 1)
+        self.assertIn(os.listdir(uploads_dir)[0], temp_files)
+        response, _ = self.send_chunk(active["id"], 0, len(self.content))
+        self.assertEqual(response.status_code, 200)
+
+
+class TestDeduplicatedUpload(TestResumableUpload):
+    """
+    Runs the upload tests with the content addressed store enabled, plus tests for deduplication
+    """
+
+    def setUp(self):
+        super(TestDeduplicatedUpload, self).setUp()
+        self.app.config["MEDIA_DEDUP_ENABLED"] = True
+        self.app.config["MEDIA_DEDUP_BLOCK_SIZE"] = 256
+
+    def content_hash(self):
+        blocks = [hashlib.sha256(self.content[start:start + 256]).digest()
+                  for start in range(0, len(self.content), 256)]
+        return hashlib.sha256(b"".join(blocks)).hexdigest()
+
+    def upload(self, path, **data):
+        _, upload = self.start_upload(path=path, **data)
+        if upload["status"] == "pending":
+            self.send_chunk(upload["id"], 0, len(self.content))
+            _, upload = self.finalize(upload["id"])
+        return upload
+
+    def test_identical_content_is_linked(self):
+        """>>> Test that identical uploads share the same content on disk"""
+        self.upload("usb/photos/first.jpg")
+        self.upload("usb/photos/second.jpg")
+        first = os.stat(os.path.join(self.media_path, "usb", "photos", "first.jpg"))
+        second = os.stat(os.path.join(self.media_path, "usb", "photos", "second.jpg"))
+        self.assertEqual(first.st_ino, second.st_ino)
+        self.assertEqual(ContentBlob.query.filter_by(drive="usb").count(), 1)
+
+    def test_known_content_hash_skips_upload(self):
+        """>>> Test that an upload of stored content completes without sending any chunk"""
+        self.upload("usb/photos/first.jpg")
+        _, upload = self.start_upload(path="usb/photos/second.jpg", content_hash=self.content_hash())
+        self.assertEqual(upload["status"], "ok")
+        self.assertTrue(upload["deduplicated"])
+        with open(os.path.join(self.media_path, "usb", "photos", "second.jpg"), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_content_of_other_users_is_not_linked_by_hash(self):
+        """>>> Test that knowing the hash of content uploaded by someone else is not enough to get a copy of it"""
+        self.upload("usb/photos/first.jpg")
+        profile = PiCloudUserProfile(first_name="other", last_name="user", email="other@picloud.com")
+        db.session.add(PiCloudUserAccount(username="other", email=profile.email, password="otherpass",
+                                          registered_on=datetime.now(), user_profile=profile))
+        db.session.commit()
+        self.client.get("auth/logout")
+        self.client.post("auth/login", data=dict(email="other@picloud.com", password="otherpass"))
+
+        _, upload = self.start_upload(path="usb/photos/second.jpg", content_hash=self.content_hash())
+        self.assertEqual(upload["status"], "pending")
+        self.assertFalse(os.path.exists(os.path.join(self.media_path, "usb", "photos", "second.jpg")))
+
+        # once the bytes have been sent the content is still stored only once
+        self.send_chunk(upload["id"], 0, len(self.content))
+        self.finalize(upload["id"])
+        self.assertEqual(ContentBlobOwner.query.count(), 2)
+        _, upload = self.start_upload(path="usb/photos/third.jpg", content_hash=self.content_hash())
+        self.assertEqual(upload["status"], "ok")
+
+    def test_rewritten_range_is_hashed_again(self):
+        """>>> Test that content sent again with other bytes is stored under the hash of the bytes received"""
+        genuine = self.content
+        _, upload = self.start_upload(path="usb/photos/first.jpg")
+        self.send_chunk(upload["id"], 0, len(self.content))
+        self.content = os.urandom(300) + genuine[300:]
+        self.send_chunk(upload["id"], 0, 300)
+        self.finalize(upload["id"])
+        self.assertEqual(ContentBlob.query.one().content_hash, self.content_hash())
+
+        # the genuine content is not linked to the other bytes
+        self.content = genuine
+        self.upload("usb/photos/second.jpg")
+        with open(os.path.join(self.media_path, "usb", "photos", "second.jpg"), "rb") as f:
+            self.assertEqual(f.read(), genuine)
+
+    def test_content_hash_mismatch(self):
+        """>>> Test that an upload not matching its declared content hash is not finalized"""
+        _, upload = self.start_upload(content_hash="0" * 64)
+        self.send_chunk(upload["id"], 0, len(self.content))
+        response, _ = self.finalize(upload["id"])
+        self.assertEqual(response.status_code, 422)
+
+    def test_prune_removes_unused_content(self):
+        """>>> Test that content no longer linked from any file is pruned"""
+        self.upload("usb/photos/first.jpg")
+        os.remove(os.path.join(self.media_path, "usb", "photos", "first.jpg"))
+        self.assertEqual(prune_store("usb"), 1)
+        self.assertEqual(ContentBlob.query.count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,256 @@
+"""
+Tests for the persistent media tree index and the home view that is served from it
+"""
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import unittest
+from unittest import mock
+
+from app import media_tree
+from app.media_watcher import Inotify, MediaWatcher
+from tests import MediaTreeTestCase
+
+
+class TestMediaTree(MediaTreeTestCase):
+    """
+    Tests for building and refreshing the index
+    """
+
+    def test_refresh_builds_summary(self):
+        """>>> Test that the first refresh indexes all directories and files"""
+        self.assertTrue(media_tree.refresh())
+        summary = media_tree.summary()
+        self.assertEqual(summary["directories"], 2)
+        self.assertEqual(summary["files"], 3)
+        self.assertEqual(summary["media"], ["usb"])
+        self.assertEqual(summary["directory_tree"]["usb"]["files"], ["readme.txt"])
+        self.assertEqual(summary["directory_tree"]["usb"]["file_num"], 3)
+        self.assertEqual(summary["directory_tree"]["usb"]["dirs"], 1)
+
+    def test_unchanged_tree_keeps_generation(self):
+        """>>> Test that refreshing an unchanged tree does not bump the generation"""
+        media_tree.refresh()
+        generation = media_tree.generation()
+        self.assertFalse(media_tree.refresh())
+        self.assertEqual(media_tree.generation(), generation)
+
+    def test_refresh_picks_up_changed_directories(self):
+        """>>> Test that added and removed files are picked up on refresh"""
+        media_tree.refresh()
+        generation = media_tree.generation()
+
+        self.write_file("usb/photos/three.jpg", b"3")
+        os.remove(os.path.join(self.media_path, "usb", "readme.txt"))
+        self.touch_dir("usb/photos", 10)
+        self.touch_dir("usb", 10)
+
+        self.assertTrue(media_tree.refresh())
+        summary = media_tree.summary()
+        self.assertEqual(summary["files"], 3)
+        self.assertEqual(summary["directory_tree"]["usb"]["files"], [])
+        self.assertGreater(media_tree.generation(), generation)
+
+    def test_removed_directory_is_dropped(self):
+        """>>> Test that a removed directory and its contents are removed from the index"""
+        media_tree.refresh()
+        shutil.rmtree(os.path.join(self.media_path, "usb", "photos"))
+        self.touch_dir("usb", 10)
+
+        media_tree.refresh()
+        summary = media_tree.summary()
+        self.assertEqual(summary["directories"], 1)
+        self.assertEqual(summary["files"], 1)
+
+    def totals(self, path):
+        parent, _, name = path.rpartition("/")
+        entry = next(entry for entry in media_tree.list_page(parent) if entry["name"] == name)
+        return entry["size"], entry["file_count"]
+
+    def test_directory_totals(self):
+        """>>> Test that directories store the total size and file count of everything below them"""
+        media_tree.refresh()
+        self.assertEqual(self.totals("usb/photos"), (30, 2))
+        self.assertEqual(self.totals("usb"), (37, 3))
+        summary = media_tree.summary()
+        self.assertEqual(summary["size"], 37)
+        self.assertEqual(summary["directory_tree"]["usb"]["size"], 37)
+
+    def test_directory_totals_roll_up_changes(self):
+        """>>> Test that added, resized and removed files update the totals of all ancestors"""
+        media_tree.refresh()
+        os.makedirs(os.path.join(self.media_path, "usb", "photos", "nested"))
+        self.write_file("usb/photos/nested/three.jpg", b"3" * 5)
+        self.write_file("usb/photos/one.jpg", b"1" * 15)
+        os.remove(os.path.join(self.media_path, "usb", "readme.txt"))
+        self.touch_dir("usb", 10)
+        self.touch_dir("usb/photos", 10)
+
+        media_tree.update(dirs=["usb/photos"], trees=["usb"], force=True)
+        self.assertEqual(self.totals("usb/photos/nested"), (5, 1))
+        self.assertEqual(self.totals("usb/photos"), (40, 3))
+        self.assertEqual(self.totals("usb"), (40, 3))
+
+        shutil.rmtree(os.path.join(self.media_path, "usb", "photos"))
+        self.touch_dir("usb", 20)
+        media_tree.refresh()
+        self.assertEqual(self.totals("usb"), (0, 0))
+        self.assertEqual(media_tree.summary()["size"], 0)
+
+    def test_directory_listed_before_the_index(self):
+        """>>> Test that a directory synced before the first refresh is counted in the totals of its ancestors"""
+        media_tree.sync_dir("usb/photos")
+        self.assertEqual(self.totals("usb/photos"), (30, 2))
+        self.assertEqual(self.totals("usb"), (30, 2))
+
+        media_tree.refresh()
+        self.assertEqual(self.totals("usb/photos"), (30, 2))
+        self.assertEqual(self.totals("usb"), (37, 3))
+        self.assertEqual(media_tree.summary()["size"], 37)
+
+    def test_index_with_old_schema_is_rebuilt(self):
+        """>>> Test that an index created with an older schema is dropped and rebuilt"""
+        index_path = os.path.join(self.tmp_dir, "old_index.db")
+        conn = sqlite3.connect(index_path)
+        conn.execute("CREATE TABLE node (path TEXT PRIMARY KEY, parent TEXT, name TEXT)")
+        conn.execute("INSERT INTO node VALUES ('usb', '', 'usb')")
+        conn.commit()
+        conn.close()
+
+        media_tree.index_path = index_path
+        self.assertIsNone(media_tree.summary())
+        media_tree.refresh()
+        self.assertEqual(media_tree.summary()["files"], 3)
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class TestMediaWatcher(MediaTreeTestCase):
+    """
+    Tests for applying inotify events to the index
+    """
+
+    def setUp(self):
+        super(TestMediaWatcher, self).setUp()
+        media_tree.refresh()
+        self.watcher = MediaWatcher(media_tree)
+        self.watcher.inotify = Inotify()
+        self.watcher.watch_tree("")
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        super(TestMediaWatcher, self).tearDown()
+
+    def apply_events(self):
+        self.watcher.handle_events(self.watcher.inotify.read_events())
+        self.watcher.apply_batch()
+
+    def test_watches_all_directories(self):
+        """>>> Test that every directory in the index is watched"""
+        self.assertEqual(sorted(self.watcher.watched_paths), ["", "usb", "usb/photos"])
+
+    def test_new_file_is_indexed(self):
+        """>>> Test that a file written into a watched directory is added to the index"""
+        self.write_file("usb/photos/three.jpg", b"3")
+        self.apply_events()
+        self.assertIn("three.jpg", media_tree.children("usb/photos"))
+
+    def test_new_directory_is_indexed_and_watched(self):
+        """>>> Test that a new directory tree is indexed and watched"""
+        os.makedirs(os.path.join(self.media_path, "usb", "videos"))
+        self.apply_events()
+        self.assertIn("usb/videos", self.watcher.watched_paths)
+
+        self.write_file("usb/videos/clip.mp4", b"clip")
+        self.apply_events()
+        self.assertEqual(media_tree.children("usb/videos"), ["clip.mp4"])
+
+    def test_directory_created_while_scanning_is_watched(self):
+        """>>> Test that a new directory is watched before it is scanned, so nothing created meanwhile is missed"""
+        os.makedirs(os.path.join(self.media_path, "usb", "videos"))
+        update = media_tree.update
+
+        def update_then_create(*args, **kwargs):
+            changed = update(*args, **kwargs)
+            if not os.path.exists(os.path.join(self.media_path, "usb", "videos", "clips")):
+                os.makedirs(os.path.join(self.media_path, "usb", "videos", "clips"))
+            return changed
+
+        with mock.patch.object(media_tree, "update", side_effect=update_then_create):
+            self.apply_events()
+            self.apply_events()
+        self.assertEqual(media_tree.children("usb/videos"), ["clips"])
+        self.assertIn("usb/videos/clips", self.watcher.watched_paths)
+
+    def test_moved_directory_is_watched_under_its_new_path(self):
+        """>>> Test that the watches of a moved directory follow it and that its old path can be watched again"""
+        os.makedirs(os.path.join(self.media_path, "usb", "photos", "nested"))
+        self.apply_events()
+        os.rename(os.path.join(self.media_path, "usb", "photos"), os.path.join(self.media_path, "usb", "albums"))
+        self.apply_events()
+        self.assertEqual(sorted(self.watcher.watched_paths), ["", "usb", "usb/albums", "usb/albums/nested"])
+
+        os.makedirs(os.path.join(self.media_path, "usb", "photos", "nested"))
+        self.apply_events()
+        self.assertIn("usb/photos/nested", self.watcher.watched_paths)
+        self.write_file("usb/photos/nested/three.jpg", b"3")
+        self.apply_events()
+        self.assertEqual(media_tree.children("usb/photos/nested"), ["three.jpg"])
+
+    def test_removed_file_is_dropped(self):
+        """>>> Test that a deleted file is removed from the index"""
+        os.remove(os.path.join(self.media_path, "usb", "photos", "one.jpg"))
+        self.apply_events()
+        self.assertEqual(media_tree.children("usb/photos"), ["two.jpg"])
+
+
+class TestHomeIndex(MediaTreeTestCase):
+    """
+    Tests for the home view
+    """
+
+    def test_index_returns_tree(self):
+        """>>> Test that the index view returns the media tree"""
+        response = self.client.get("/")
+        data = json.loads(response.data.decode())
+        self.assertTrue(data["success"])
+        self.assertEqual(data["files"], 3)
+        self.assertEqual(data["root_path"], self.media_path)
+
+    def test_index_without_media(self):
+        """>>> Test that the index view reports when nothing is mounted"""
+        shutil.rmtree(os.path.join(self.media_path, "usb"))
+        response = self.client.get("/")
+        data = json.loads(response.data.decode())
+        self.assertFalse(data["success"])
+        self.assertEqual(data["message"], "No media mounted")
+
+    def test_index_not_modified(self):
+        """>>> Test that a client with the current tree gets a 304 without the summary being read or rebuilt"""
+        etag = self.client.get("/").headers["ETag"]
+        with mock.patch.object(media_tree, "refresh") as refresh, mock.patch.object(media_tree, "summary") as summary:
+            response = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data, b"")
+        self.assertFalse(refresh.called or summary.called)
+
+        self.write_file("usb/notes.txt", b"notes")
+        self.touch_dir("usb", 10)
+        media_tree.refresh()
+        response = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(json.loads(response.data.decode())["files"], 4)
+
+    def test_etag_changes_when_index_is_rebuilt(self):
+        """>>> Test that a rebuilt index whose generation starts over does not reuse the etags of the old one"""
+        etag = self.client.get("/").headers["ETag"]
+        self.app.config["MEDIA_INDEX_PATH"] = os.path.join(self.tmp_dir, "rebuilt_index.db")
+        media_tree.init_app(self.app)
+        self.assertEqual(self.client.get("/", headers={"If-None-Match": etag}).status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Tests for the request metrics exposed on /metrics
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import metrics
+from app.metrics import MmapValues, read_values, render, sample_key
+from tests import MediaTreeTestCase
+
+
+def parse_metrics(text):
+    """
+    :return: value of each sample of an exposition
+    :rtype: dict
+    """
+    return {line.rpartition(" ")[0]: float(line.rpartition(" ")[2]) for line in text.splitlines()
+            if line and not line.startswith("#")}
+
+
+class MetricsTestCases(MediaTreeTestCase):
+    """
+    Tests for recording requests and reporting them in the Prometheus text format
+    """
+
+    def setUp(self):
+        super(MetricsTestCases, self).setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.use_directory(None)
+        shutil.rmtree(self.metrics_dir)
+        super(MetricsTestCases, self).tearDown()
+
+    def scrape(self):
+        response = self.client.get("metrics")
+        return response, parse_metrics(response.get_data(as_text=True))
+
+    def test_records_requests(self):
+        """>>> Test that the latency, status and size of requests are reported"""
+        login_page = self.client.get("auth/login")
+        self.client.get("auth/login")
+        self.client.get("missing/page")
+
+        response, samples = self.scrape()
+        self.assertEqual(response.content_type, "text/plain; version=0.0.4; charset=utf-8")
+        labels = 'endpoint="auth.login",method="GET"'
+        self.assertEqual(samples['picloud_http_requests_total{{{},status="200"}}'.format(labels)], 2)
+        self.assertEqual(samples['picloud_http_requests_total{endpoint="none",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['picloud_http_request_duration_seconds_count{{{}}}'.format(labels)], 2)
+        self.assertEqual(samples['picloud_http_request_duration_seconds_bucket{{{},le="+Inf"}}'.format(labels)], 2)
+        self.assertEqual(samples['picloud_http_response_bytes_total{endpoint="auth.login"}'],
+                         2 * len(login_page.data))
+        # the scrape itself is in flight
+        self.assertEqual(samples["picloud_http_requests_in_flight"], 1)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """>>> Test that every bucket is reported, in order, with the values at or below its bound"""
+        self.app.config["METRICS_BUCKETS"] = (0.1, 1.0)
+        metrics.init_app(self.app)
+        for value in (0.05, 0.5, 5):
+            metrics.observe("picloud_fs_walk_duration_seconds", (("operation", "refresh"),), value)
+        text = render(metrics.collect())
+        self.assertIn("# TYPE picloud_fs_walk_duration_seconds histogram\n"
+                      'picloud_fs_walk_duration_seconds_bucket{operation="refresh",le="0.1"} 1.0\n'
+                      'picloud_fs_walk_duration_seconds_bucket{operation="refresh",le="1.0"} 2.0\n'
+                      'picloud_fs_walk_duration_seconds_bucket{operation="refresh",le="+Inf"} 3.0\n'
+                      'picloud_fs_walk_duration_seconds_count{operation="refresh"} 3.0\n'
+                      'picloud_fs_walk_duration_seconds_sum{operation="refresh"} 5.55\n', text)
+
+    def test_records_walks(self):
+        """>>> Test that the walks of the media path done by the views are timed"""
+        self.login()
+        self.client.get("/")
+        self.client.get(self.media_url("api/listing/usb"))
+        _, samples = self.scrape()
+        self.assertEqual(samples['picloud_fs_walk_duration_seconds_count{endpoint="home.index",'
+                                 'operation="ensure_fresh"}'], 1)
+        self.assertEqual(samples['picloud_fs_walk_duration_seconds_count{endpoint="media.list_directory",'
+                                 'operation="sync_dir"}'], 1)
+
+    def test_streamed_bytes_are_counted(self):
+        """>>> Test that the size of a streamed body is counted once it has been sent"""
+        self.login()
+        archive = self.client.get(self.media_url("archive/usb")).data
+        _, samples = self.scrape()
+        self.assertEqual(samples['picloud_http_response_bytes_total{endpoint="media.download_archive"}'],
+                         len(archive))
+
+    def test_token(self):
+        """>>> Test that the metrics require the token when one is configured"""
+        self.app.config["METRICS_TOKEN"] = "secret"
+        self.assertEqual(self.client.get("metrics").status_code, 401)
+        self.assertEqual(self.client.get("metrics", headers={"Authorization": "Bearer wrong"}).status_code, 401)
+        self.assertEqual(self.client.get("metrics", headers={"Authorization": "Bearer secret"}).status_code, 200)
+
+    def test_mmap_values(self):
+        """>>> Test that values written to a file grow it as needed and are read back by other processes"""
+        path = os.path.join(self.metrics_dir, "counter_1.db")
+        values = MmapValues(path)
+        for number in range(1000):
+            values.inc(sample_key("picloud_test_total", (("number", number),)), number)
+        values.inc('picloud_test_total{number="7"}', 0.5)
+        values.close()
+
+        read = dict(read_values(path))
+        self.assertEqual(len(read), 1000)
+        self.assertEqual(read['picloud_test_total{number="7"}'], 7.5)
+        self.assertGreater(os.path.getsize(path), MmapValues.initial_size)
+        # reopened by a process with the same pid
+        MmapValues(path).inc('picloud_test_total{number="999"}', 1)
+        self.assertEqual(dict(read_values(path))['picloud_test_total{number="999"}'], 1000)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_totals_of_all_processes(self):
+        """>>> Test that the counters of all the processes are summed and the gauges of exited ones dropped"""
+        metrics.use_directory(self.metrics_dir)
+        metrics.inc("picloud_http_requests_total", (("endpoint", "home.index"),), 2)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.inc("picloud_http_requests_total", (("endpoint", "home.index"),), 3)
+                metrics.inc("picloud_http_requests_in_flight", amount=4, live=True)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        metrics.inc("picloud_http_requests_in_flight", live=True)
+        samples = metrics.collect()
+        self.assertEqual(samples['picloud_http_requests_total{endpoint="home.index"}'], 5)
+        self.assertEqual(samples["picloud_http_requests_in_flight"], 1)
+        self.assertEqual(sorted(os.listdir(self.metrics_dir)), sorted(
+            "{}_{}.db".format(kind, process) for kind in ("counter", "live") for process in (os.getpid(), pid)))
+
+        metrics.mark_process_dead(pid)
+        self.assertNotIn("live_{}.db".format(pid), os.listdir(self.metrics_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Checks the query plans of the queries run on hot paths, each of them must be answered from an index instead of
+scanning a whole table. The plans are checked with SQLite by default, set TEST_DATABASE_URL to check them
+against a local PostgreSQL database, where sequential scans are disabled so that the planner picks an index
+even though the test tables are tiny.
+"""
+import json
+import os
+import unittest
+from datetime import datetime
+
+from app import db
+from app.mod_auth.models import PiCloudUserAccount, PiCloudUserProfile, AsyncOperation, AsyncOperationStatus, \
+    OutboxMessage
+from app.mod_media.models import ContentBlob
+from tests import BaseTestCase
+
+
+def explain(query):
+    """
+    :param query: an ORM query
+    :return: the steps of the plan of the query that scan a whole table
+    :rtype: list
+    """
+    connection = db.session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+
+    if connection.dialect.name == "postgresql":
+        connection.execute("SET LOCAL enable_seqscan = off")
+        plan = connection.execute("EXPLAIN (FORMAT JSON) " + str(compiled), params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return [node["Node Type"] + " on " + node.get("Relation Name", "")
+                for node in _plan_nodes(plan[0]["Plan"]) if node["Node Type"] == "Seq Scan"]
+
+    rows = connection.execute("EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+    return [row[-1] for row in rows if row[-1].startswith("SCAN")]
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        for descendant in _plan_nodes(child):
+            yield descendant
+
+
+class QueryPlanTestCases(BaseTestCase):
+    """
+    Each test runs one of the hot queries through EXPLAIN
+    """
+
+    def setUp(self):
+        if os.environ.get("TEST_DATABASE_URL"):
+            self.app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("TEST_DATABASE_URL")
+        super(QueryPlanTestCases, self).setUp()
+
+    def assertUsesIndexes(self, query):
+        scans = explain(query)
+        self.assertEqual(scans, [], "{} scans a whole table".format(query.statement))
+
+    def test_account_by_email(self):
+        """>>> Test that login, password recovery and registration find the account by its email"""
+        self.assertUsesIndexes(PiCloudUserAccount.query.filter_by(email="picloudman@picloud.com"))
+
+    def test_account_by_id(self):
+        """>>> Test that the login manager loads the account by its id"""
+        self.assertUsesIndexes(PiCloudUserAccount.query.filter_by(user_id=1))
+
+    def test_account_by_profile(self):
+        """>>> Test that the account of a profile is found without a scan"""
+        self.assertUsesIndexes(PiCloudUserAccount.query.filter_by(user_profile_id=1))
+
+    def test_profile_by_email(self):
+        """>>> Test that the profile of the logged in user is found by its email"""
+        self.assertUsesIndexes(PiCloudUserProfile.query.filter_by(email="picloudman@picloud.com"))
+
+    def test_operations_of_user(self):
+        """>>> Test that the async operations of a user are found without a scan"""
+        self.assertUsesIndexes(AsyncOperation.query.filter_by(user_profile_id=1))
+
+    def test_operations_by_status(self):
+        """>>> Test that the async operations with a status are found without a scan"""
+        self.assertUsesIndexes(AsyncOperation.query.filter_by(async_operation_status_id=1))
+
+    def test_upload_lookup(self):
+        """>>> Test that the upload of a chunk is found by its id"""
+        self.assertUsesIndexes(AsyncOperation.query.filter_by(id=1, operation="upload", user_profile_id=1))
+
+    def test_status_by_code(self):
+        """>>> Test that async operation statuses are found by their code"""
+        self.assertUsesIndexes(AsyncOperationStatus.query.filter_by(code="pending"))
+
+    def test_due_outbox_messages(self):
+        """>>> Test that the mail worker finds the due messages without a scan or a sort"""
+        query = OutboxMessage.query.filter(OutboxMessage.status == "pending",
+                                           OutboxMessage.next_attempt_at <= datetime.utcnow()) \
+            .order_by(OutboxMessage.next_attempt_at).limit(50)
+        self.assertUsesIndexes(query)
+
+    def test_blob_by_hash(self):
+        """>>> Test that uploads find the blob with the same content by its hash"""
+        self.assertUsesIndexes(ContentBlob.query.filter_by(drive="drive", content_hash="0" * 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
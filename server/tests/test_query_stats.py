@@ -0,0 +1,51 @@
+"""
+Tests for counting the SQL statements of requests and for the query budgets of the views
+"""
+import unittest
+
+from app import db, query_stats
+from app.mod_auth.models import PiCloudUserAccount
+from tests import BaseTestCase
+
+
+class QueryStatsTestCases(BaseTestCase):
+    """
+    Tests for the Server-Timing header and the query budget helper
+    """
+
+    def test_server_timing_header(self):
+        """>>> Test that the statements of a request are reported in its Server-Timing header"""
+        with self.assertQueryBudget() as log:
+            response = self.login()
+        self.assertGreater(log.count, 0)
+        self.assertEqual(response.headers["Server-Timing"],
+                         'db;dur={:.1f};desc="{} queries"'.format(log.duration * 1000, log.count))
+
+    def test_server_timing_disabled(self):
+        """>>> Test that nothing is reported when the statistics are disabled"""
+        query_stats.enabled = False
+        response = self.client.get("auth/login")
+        self.assertNotIn("Server-Timing", response.headers)
+
+    def test_query_budget_catches_repeated_statements(self):
+        """>>> Test that running the same statement in a loop goes over the budget"""
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(max_repeats=2):
+                for user_id in range(3):
+                    PiCloudUserAccount.query.filter_by(user_id=user_id).first()
+
+    def test_query_budget_catches_too_many_statements(self):
+        """>>> Test that a block running more statements than its budget fails"""
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(max_queries=1):
+                PiCloudUserAccount.query.first()
+                db.session.execute("SELECT 1")
+
+    def test_login_query_budget(self):
+        """>>> Test that signing in looks the account up once"""
+        with self.assertQueryBudget(max_queries=3, max_repeats=1):
+            self.login()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Tests for the gunicorn settings of manage.py serve
+"""
+import inspect
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from app import db, metrics
+from app.server import PiCloudServer, default_workers, post_fork, server_options
+from tests import BaseTestCase
+
+
+class ServerTestCases(BaseTestCase):
+    """
+    Tests for deriving the gunicorn settings from the configuration
+    """
+
+    def test_default_workers(self):
+        """>>> Test that there is a worker per processor plus one"""
+        self.assertEqual(default_workers(4), 5)
+        self.assertGreaterEqual(default_workers(), 2)
+
+    def test_options_from_config(self):
+        """>>> Test that unset workers and threads are derived from the processors and THREADS_PER_PAGE"""
+        self.app.config.update(SERVER_WORKERS=0, SERVER_THREADS=0, THREADS_PER_PAGE=2)
+        options = server_options(self.app)
+        self.assertEqual(options["workers"], default_workers())
+        self.assertEqual((options["threads"], options["worker_class"]), (2, "gthread"))
+        self.assertTrue(options["preload_app"])
+        self.assertEqual(options["max_requests"], self.app.config["SERVER_MAX_REQUESTS"])
+
+    def test_options_overrides(self):
+        """>>> Test that the options of the command take precedence over the configuration"""
+        self.app.config.update(SERVER_WORKERS=8, SERVER_THREADS=4)
+        options = server_options(self.app, bind="127.0.0.1:8000", workers=3, threads=1)
+        self.assertEqual((options["bind"], options["workers"], options["threads"]), ("127.0.0.1:8000", 3, 1))
+        self.assertEqual(options["worker_class"], "sync")
+
+    def test_gunicorn_settings(self):
+        """>>> Test that the settings reach gunicorn and that it serves the application"""
+        server = PiCloudServer(self.app, server_options(self.app, bind="127.0.0.1:8000", workers=3))
+        self.assertEqual(server.cfg.workers, 3)
+        self.assertEqual(server.cfg.bind, ["127.0.0.1:8000"])
+        self.assertTrue(server.cfg.preload_app)
+        self.assertIs(server.load(), self.app)
+
+    def test_post_fork(self):
+        """>>> Test that the fork hook takes the arguments gunicorn 19 checks for and drops the connections"""
+        server = PiCloudServer(self.app, server_options(self.app))
+        self.assertIs(server.cfg.post_fork, post_fork)
+        self.assertEqual(len(inspect.getfullargspec(post_fork).args), 2)
+        engine = db.get_engine(self.app)
+        with mock.patch.object(engine, "dispose") as dispose:
+            server.cfg.post_fork(mock.Mock(app=server), mock.Mock())
+        dispose.assert_called_once_with()
+
+    def test_metrics_of_workers(self):
+        """>>> Test that the workers keep their metrics in files that are cleared when the server starts"""
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        self.addCleanup(metrics.use_directory, None)
+        open(os.path.join(metrics_dir, "counter_1.db"), "wb").close()
+        self.app.config["METRICS_DIR"] = metrics_dir
+
+        server = PiCloudServer(self.app, server_options(self.app))
+        self.assertEqual(len(inspect.getfullargspec(server.cfg.on_starting).args), 1)
+        server.cfg.on_starting(mock.Mock(app=server))
+        self.assertEqual(os.listdir(metrics_dir), [])
+        metrics.inc("picloud_http_requests_in_flight", live=True)
+        self.assertEqual(metrics.collect()["picloud_http_requests_in_flight"], 1)
+
+        server.cfg.child_exit(None, mock.Mock(pid=os.getpid()))
+        self.assertNotIn("picloud_http_requests_in_flight", metrics.collect())
+
+
+if __name__ == "__main__":
+    unittest.main()
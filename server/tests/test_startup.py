@@ -0,0 +1,78 @@
+"""
+Tests for the start up of the application, heavy modules must only be imported once they are needed
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+from app.startup_profile import format_report, parse_importtime, profile_startup
+from tests import BaseTestCase
+
+SERVER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that create_app must not import, they are imported with the blueprints or on first use
+DEFERRED_MODULES = ("celery.app", "flask_mail", "flask_migrate", "flask_wtf", "PIL.Image")
+
+IMPORTED_SCRIPT = """
+import sys
+from app import create_app
+app = create_app("testing")
+deferred = sys.argv[1:]
+print(",".join(module for module in deferred if module in sys.modules))
+app.load_blueprints()
+print(",".join(module for module in deferred if module in sys.modules))
+"""
+
+
+class StartupTestCases(BaseTestCase):
+    """
+    Tests for deferring heavy imports and for profiling the start up
+    """
+
+    def test_heavy_modules_are_deferred(self):
+        """>>> Test that create_app does not import celery, mail, migrate and the views"""
+        output = subprocess.check_output([sys.executable, "-c", IMPORTED_SCRIPT] + list(DEFERRED_MODULES),
+                                         cwd=SERVER_PATH, universal_newlines=True)
+        after_create_app, after_blueprints = output.splitlines()
+        self.assertEqual(after_create_app, "")
+        self.assertIn("celery.app", after_blueprints)
+        self.assertNotIn("flask_migrate", after_blueprints)
+
+    def test_blueprints_are_loaded_on_first_request(self):
+        """>>> Test that the blueprints are registered by the first request"""
+        app = self.create_app()
+        self.assertNotIn("media", app.blueprints)
+        self.assertEqual(app.test_client().get("auth/login").status_code, 200)
+        self.assertIn("media", app.blueprints)
+        self.assertEqual(app.lazy_blueprints, [])
+
+    def test_url_for_loads_blueprints(self):
+        """>>> Test that building the url of a view that is not loaded yet loads the blueprints"""
+        app = self.create_app()
+        with app.test_request_context():
+            from flask import url_for
+            self.assertEqual(url_for("auth.login"), "/auth/login")
+
+    def test_parse_importtime(self):
+        """>>> Test that the report of -X importtime is parsed with the depth of each module"""
+        imports = parse_importtime("import time: self [us] | cumulative | imported package\n"
+                                   "import time:       120 |        120 |     jinja2.utils\n"
+                                   "import time:       303 |        423 |   jinja2\n"
+                                   "import time:        50 |        473 | flask\n")
+        self.assertEqual(imports, [("jinja2.utils", 120, 120, 2), ("jinja2", 303, 423, 1), ("flask", 50, 473, 0)])
+
+    def test_profile_startup(self):
+        """>>> Test that the phases of the start up are timed and the imports are grouped by package"""
+        profile = profile_startup("testing", cwd=SERVER_PATH)
+        self.assertEqual(set(profile["phases"]), {"import_app", "create_app", "load_blueprints"})
+        self.assertAlmostEqual(profile["total"], sum(profile["phases"].values()))
+        report = format_report(profile, limit=5)
+        self.assertTrue(report[3].startswith("total"))
+        if sys.version_info >= (3, 7):
+            self.assertIn("flask", [name for name, _, _, _ in profile["imports"]])
+            self.assertEqual(len(report), 4 + 2 + 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
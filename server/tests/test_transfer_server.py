@@ -0,0 +1,174 @@
+"""
+Tests for the transfers served from the event loop of manage.py transfer
+"""
+import asyncio
+import json
+import os
+import unittest
+
+from app.transfer_server import TransferServer, parse_request_head
+from tests import MediaTreeTestCase
+
+USER_AGENT = "picloud-tests"
+
+
+class TransferServerTestCases(MediaTreeTestCase):
+    """
+    Tests for downloading files and uploading chunks through the transfer server
+    """
+
+    def setUp(self):
+        super(TransferServerTestCases, self).setUp()
+        self.content = os.urandom(600 * 1024)
+        self.write_file("usb/video.mp4", self.content)
+        self.app.config["TRANSFER_IDLE_TIMEOUT"] = 1
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transfer = TransferServer(self.app, threads=1)
+        self.server = self.loop.run_until_complete(self.transfer.start("127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        # the session is bound to the address and user agent of the client that logged in
+        self.client.post("auth/login", data=dict(email="picloudman@picloud.com", password="picloudman"),
+                         headers={"User-Agent": USER_AGENT})
+        self.cookie = "; ".join("{}={}".format(cookie.name, cookie.value) for cookie in self.client.cookie_jar)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.transfer.executor.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(TransferServerTestCases, self).tearDown()
+
+    def request(self, method, path, body=b"", headers=None, body_length=None, requests=1):
+        """
+        Sends requests over one connection and reads the responses until the server closes it
+        :param body_length: Content-Length to send, defaults to the length of the body
+        :param requests: number of times the request is sent
+        :return: list of (status, headers, body) of the responses
+        """
+        headers = dict(headers or {}, **{"User-Agent": USER_AGENT, "Host": "localhost"})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if body or body_length is not None:
+            headers["Content-Length"] = str(len(body) if body_length is None else body_length)
+        head = "{} {} HTTP/1.1\r\n{}\r\n".format(method, path, "".join(
+            "{}: {}\r\n".format(name, value) for name, value in headers.items())).encode()
+
+        async def exchange():
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            writer.write((head + body) * requests)
+            if body_length is not None:
+                # the client goes away before sending the whole body
+                writer.write_eof()
+            data = await reader.read()
+            writer.close()
+            return data
+
+        data = self.loop.run_until_complete(exchange())
+        responses = []
+        while data:
+            head, _, data = data.partition(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            response_headers = dict(line.split(": ", 1) for line in lines[1:])
+            status = int(lines[0].split(" ")[1])
+            length = 0 if method == "HEAD" or status < 200 else int(response_headers.get("Content-Length", len(data)))
+            responses.append((status, response_headers, data[:length]))
+            data = data[length:]
+        return responses
+
+    def start_upload(self, size):
+        response = self.client.post(self.media_url("uploads"), data=json.dumps(dict(path="usb/new.mp4", size=size)),
+                                    content_type="application/json", headers={"User-Agent": USER_AGENT})
+        return json.loads(response.data.decode())["id"]
+
+    def test_parse_request_head(self):
+        """>>> Test that the request line and headers are turned into a WSGI environ"""
+        environ = parse_request_head(b"GET /media/a%20b?x=1 HTTP/1.1\r\nHost: pi\r\nContent-Length: 4\r\n"
+                                     b"Accept: a\r\nAccept: b", ("10.0.0.2", 5000), ("0.0.0.0", 5001))
+        self.assertEqual((environ["PATH_INFO"], environ["QUERY_STRING"]), ("/media/a b", "x=1"))
+        self.assertEqual((environ["HTTP_HOST"], environ["CONTENT_LENGTH"]), ("pi", "4"))
+        self.assertEqual(environ["HTTP_ACCEPT"], "a,b")
+        self.assertEqual(environ["REMOTE_ADDR"], "10.0.0.2")
+        with self.assertRaises(ValueError):
+            parse_request_head(b"GET / SPDY/3", ("10.0.0.2", 5000), ("0.0.0.0", 5001))
+
+    def test_downloads_file(self):
+        """>>> Test that a file is sent whole and in ranges, on a connection that is kept open"""
+        responses = self.request("GET", self.media_url("download/usb/video.mp4"), requests=2)
+        self.assertEqual(len(responses), 2)
+        for status, headers, body in responses:
+            self.assertEqual(status, 200)
+            self.assertEqual(int(headers["Content-Length"]), len(self.content))
+            self.assertEqual(body, self.content)
+
+        [(status, headers, body)] = self.request("GET", self.media_url("download/usb/video.mp4"),
+                                                 headers={"Range": "bytes=1000-299999", "Connection": "close"})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.content[1000:300000])
+
+        [(status, headers, body)] = self.request("HEAD", self.media_url("download/usb/video.mp4"),
+                                                 headers={"Connection": "close"})
+        self.assertEqual((status, body), (200, b""))
+
+    def test_download_is_checked_by_the_application(self):
+        """>>> Test that downloads need a session and that other requests are not served"""
+        self.assertEqual(self.request("GET", self.media_url("download/usb/missing.mp4"))[0][0], 404)
+        self.assertEqual(self.request("GET", self.media_url("api/listing/usb"))[0][0], 404)
+        self.cookie = None
+        self.assertNotEqual(self.request("GET", self.media_url("download/usb/video.mp4"))[0][0], 200)
+
+    def test_uploads_chunk(self):
+        """>>> Test that an upload chunk is received and recorded"""
+        upload_id = self.start_upload(1000)
+        continued, (status, _, body) = self.request("PUT", self.media_url("uploads/{}?offset=200".format(upload_id)),
+                                                    body=self.content[200:1000],
+                                                    headers={"Expect": "100-continue", "Connection": "close"})
+        self.assertEqual((continued[0], status), (100, 200))
+        self.assertEqual(json.loads(body.decode())["received"], [[200, 1000]])
+
+        [(status, _, body)] = self.request("PUT", self.media_url("uploads/{}?offset=0".format(upload_id)),
+                                           body=self.content[:200], headers={"Connection": "close"})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())["completed"], 1000)
+
+        self.client.post(self.media_url("uploads/{}/finalize".format(upload_id)), headers={"User-Agent": USER_AGENT})
+        with open(os.path.join(self.media_path, "usb", "new.mp4"), "rb") as f:
+            self.assertEqual(f.read(), self.content[:1000])
+
+    def test_dropped_upload_is_recorded(self):
+        """>>> Test that the part of a chunk received before the client went away is recorded"""
+        upload_id = self.start_upload(1000)
+        self.request("PUT", self.media_url("uploads/{}?offset=0".format(upload_id)), body=self.content[:400],
+                     body_length=1000)
+        response = self.client.get(self.media_url("uploads/{}".format(upload_id)),
+                                   headers={"User-Agent": USER_AGENT})
+        self.assertEqual(json.loads(response.data.decode())["received"], [[0, 400]])
+
+    def test_rejected_chunk(self):
+        """>>> Test that a chunk the upload can not take is rejected before its body is read"""
+        upload_id = self.start_upload(10)
+        [(status, headers, body)] = self.request("PUT", self.media_url("uploads/{}?offset=0".format(upload_id)),
+                                                 body=self.content[:100])
+        self.assertEqual(status, 416)
+        self.assertEqual(headers["Connection"], "close")
+        self.assertFalse(json.loads(body.decode())["success"])
+
+    def test_idle_connection_is_closed(self):
+        """>>> Test that a client that sends nothing is disconnected"""
+        self.app.config["TRANSFER_IDLE_TIMEOUT"] = 0.1
+        self.transfer.idle_timeout = 0.1
+
+        async def idle():
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return data
+
+        self.assertEqual(self.loop.run_until_complete(idle()), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()